@@ -1,50 +1,155 @@
+from collections import namedtuple
 from datetime import datetime
-from . import settings, signature
+from django.utils.module_loading import import_string
+from types import MappingProxyType
+from . import rest, settings, signature
 import random
+import requests
 import time
 import re
 
 
+class FullLineItems(object):
+    """
+    Send every basket line as a line item.
+    """
+    def line_items(self, basket):
+        for line in basket.all_lines():
+            yield line.product.title, line.stockrecord.partner_sku, line.quantity, line.unit_price_incl_tax
+
+
+class TopLineItems(object):
+    """
+    Send the most expensive lines as line items, and roll the rest up into a single line, so that large
+    baskets stay within ``max_items``. The line items still add up to the basket total.
+    """
+    rollup_name = 'Other items (%s)'
+
+    def __init__(self, max_items=None):
+        self.max_items = max_items or settings.LINE_ITEM_MAX
+
+    def line_items(self, basket):
+        lines = list(basket.all_lines())
+        if len(lines) <= self.max_items:
+            for item in FullLineItems().line_items(basket):
+                yield item
+            return
+
+        lines.sort(key=lambda line: line.line_price_incl_tax, reverse=True)
+        kept, rest = lines[:self.max_items - 1], lines[self.max_items - 1:]
+        for line in kept:
+            yield line.product.title, line.stockrecord.partner_sku, line.quantity, line.unit_price_incl_tax
+        yield self.rollup_name % sum(line.quantity for line in rest), '', 1, sum(line.line_price_incl_tax for line in rest)
+
+
+class TotalsOnly(object):
+    """
+    Don't send any line items, only the order amount.
+    """
+    def line_items(self, basket):
+        return []
+
+
+LINE_ITEM_STRATEGIES = {
+    'full': FullLineItems,
+    'top': TopLineItems,
+    'totals': TotalsOnly,
+}
+
+
+def get_line_item_strategy():
+    """
+    Return the LINE_ITEM_STRATEGY: one of the names in LINE_ITEM_STRATEGIES, or the dotted path to a class.
+    """
+    name = settings.LINE_ITEM_STRATEGY
+    strategy_class = LINE_ITEM_STRATEGIES[name] if name in LINE_ITEM_STRATEGIES else import_string(name)
+    return strategy_class()
+
+
+# The field names of an action class, worked out once per class rather than on every request
+FieldSchema = namedtuple('FieldSchema', ('names', 'signed_field_names'))
+
+SIGNATURE_FIELDS = frozenset(['signed_date_time', 'signed_field_names', 'unsigned_field_names'])
+
+# The Secure Acceptance profile settings
+Profile = namedtuple('Profile', ('profile_id', 'access_key', 'secret_key', 'currency', 'locale', 'date_format'))
+
+# The parts of an action's requests which only depend on its class and the profile. Built once per class
+# and profile and shared by every thread, so nothing in it may be mutated.
+ActionTemplate = namedtuple('ActionTemplate', ('profile', 'base_data', 'signer'))
+
+
+def get_profile():
+    return Profile(
+        profile_id=settings.PROFILE,
+        access_key=settings.ACCESS,
+        secret_key=settings.SECRET,
+        currency=settings.DEFAULT_CURRENCY,
+        locale=settings.LOCALE,
+        date_format=settings.DATE_FORMAT)
+
+
 class SecureAcceptanceAction(object):
-    access_key = settings.ACCESS
-    currency = settings.DEFAULT_CURRENCY
-    date_format = settings.DATE_FORMAT
-    locale = settings.LOCALE
-    profile_id = settings.PROFILE
     signed_field_names = set()
     transaction_type = ''
     unsigned_field_names = set()
 
 
+    @classmethod
+    def get_schema(cls):
+        # Look in the class' own __dict__, so that subclasses don't inherit their parent's schema
+        schema = cls.__dict__.get('_schema')
+        if schema is None:
+            schema = FieldSchema(
+                names=frozenset(cls.signed_field_names | cls.unsigned_field_names),
+                signed_field_names=frozenset(cls.signed_field_names))
+            cls._schema = schema
+        return schema
+
+
+    @classmethod
+    def get_template(cls):
+        # Rebuilt only when the profile settings change
+        profile = get_profile()
+        template = cls.__dict__.get('_template')
+        if template is None or template.profile != profile:
+            template = ActionTemplate(
+                profile=profile,
+                base_data=MappingProxyType({
+                    'access_key': profile.access_key,
+                    'currency': profile.currency,
+                    'locale': profile.locale,
+                    'profile_id': profile.profile_id,
+                    'transaction_type': cls.transaction_type,
+                }),
+                signer=signature.get_signer())
+            cls._template = template
+        return template
+
+
     def fields(self):
-        names = self.signed_field_names | self.unsigned_field_names
-        fields = { name: '' for name in names }
+        template = self.get_template()
+        fields = dict.fromkeys(self.get_schema().names, '')
 
-        data, signed_fields = self.build_request_data()
+        data, signed_fields = self.build_request_data(template)
         fields.update(data)
 
-        signed_fields = signed_fields | set(['signed_date_time', 'signed_field_names', 'unsigned_field_names'])
+        signed_fields = signed_fields | SIGNATURE_FIELDS
         unsigned_fields = set(fields.keys()) - signed_fields
-        fields['signed_date_time'] = datetime.utcnow().strftime(self.date_format)
+        fields['signed_date_time'] = datetime.utcnow().strftime(template.profile.date_format)
         fields['signed_field_names'] = ','.join(signed_fields)
         fields['unsigned_field_names'] = ','.join(unsigned_fields)
 
-        signer = signature.SecureAcceptanceSigner()
-        fields['signature'] = signer.sign(fields, signed_fields)
+        fields['signature'] = template.signer.sign(fields, signed_fields).decode()
         return fields
 
-    def build_request_data(self):
-        data = {
-            'access_key': self.access_key,
-            'currency': self.currency,
-            'locale': self.locale,
-            'profile_id': self.profile_id,
-            'transaction_type': self.transaction_type,
-            'transaction_uuid': self.generate_uuid(),
-        }
+    def build_request_data(self, template=None):
+        template = template or self.get_template()
+        data = dict(template.base_data)
+        data['transaction_uuid'] = self.generate_uuid()
 
         data.update( self.build_signed_data() )
-        signed_fields = self.signed_field_names | set(data.keys())
+        signed_fields = self.get_schema().signed_field_names | set(data.keys())
         data.update( self.build_unsigned_data() )
         return data, signed_fields
 
@@ -103,7 +208,7 @@ class CreateAndAuthorizePaymentToken(SecureAcceptanceAction):
         'card_cvn',
     ])
     transaction_type = 'authorization,create_payment_token'
-    url = settings.ENDPOINT_PAY
+    url = settings.SettingAttribute('ENDPOINT_PAY')
 
 
     def __init__(self, order_number, order_total, basket, **kwargs):
@@ -150,11 +255,11 @@ class CreateAndAuthorizePaymentToken(SecureAcceptanceAction):
 
         # Add line item info
         i = 0
-        for line in self.basket.all_lines():
-            data['item_%s_name' % i] = line.product.title
-            data['item_%s_sku' % i] = line.stockrecord.partner_sku
-            data['item_%s_quantity' % i] = str(line.quantity)
-            data['item_%s_unit_price' % i] = str(line.unit_price_incl_tax)
+        for name, sku, quantity, unit_price in get_line_item_strategy().line_items(self.basket):
+            data['item_%s_name' % i] = name
+            data['item_%s_sku' % i] = sku
+            data['item_%s_quantity' % i] = str(quantity)
+            data['item_%s_unit_price' % i] = str(unit_price)
             i += 1
         data['line_item_count'] = str(i)
 
@@ -166,3 +271,211 @@ class CreateAndAuthorizePaymentToken(SecureAcceptanceAction):
         data.update(self.extra_fields)
 
         return data
+
+
+
+class AuthorizePaymentToken(object):
+    """
+    Authorize a payment with a previously created payment token. Unlike the Secure Acceptance actions, this
+    is sent server-side through the REST API, so the customer's browser never talks to CyberSource.
+
+    The REST response is translated into the same fields as a Secure Acceptance reply, so that it can be
+    logged and recorded the same way.
+    """
+    path = '/pts/v2/payments'
+    transaction_type = 'authorization,token'
+
+    DECISIONS = {
+        'AUTHORIZED': 'ACCEPT',
+        'AUTHORIZED_PENDING_REVIEW': 'REVIEW',
+        'PENDING_REVIEW': 'REVIEW',
+        'DECLINED': 'DECLINE',
+        'AUTHORIZED_RISK_DECLINED': 'DECLINE',
+        'INVALID_REQUEST': 'ERROR',
+    }
+
+    # Equivalent Secure Acceptance reason codes for the REST API's error reasons
+    REASON_CODES = {
+        'MISSING_FIELD': '101',
+        'INVALID_DATA': '102',
+        'DUPLICATE_REQUEST': '104',
+        'SYSTEM_ERROR': '150',
+        'SERVER_TIMEOUT': '151',
+        'SERVICE_TIMEOUT': '152',
+        'AVS_FAILED': '200',
+        'CONTACT_PROCESSOR': '201',
+        'EXPIRED_CARD': '202',
+        'PROCESSOR_DECLINED': '203',
+        'INSUFFICIENT_FUND': '204',
+        'STOLEN_LOST_CARD': '205',
+        'ISSUER_UNAVAILABLE': '207',
+        'UNAUTHORIZED_CARD': '208',
+        'EXCEEDS_CREDIT_LIMIT': '210',
+        'CVN_NOT_MATCH': '211',
+        'CV_FAILED': '230',
+        'INVALID_ACCOUNT': '231',
+        'DECISION_PROFILE_REJECT': '481',
+    }
+
+    def __init__(self, order_number, order_total, basket, token, **kwargs):
+        self.order_number = order_number
+        self.order_total = order_total
+        self.basket = basket
+        self.token = token
+        self.shipping_address = kwargs.get('shipping_address')
+        self.billing_address = kwargs.get('billing_address')
+        self.email = kwargs.get('email')
+        self.customer_ip_address = kwargs.get('customer_ip_address')
+        self.device_fingerprint_id = kwargs.get('fingerprint_session_id')
+
+
+    def build_request_body(self):
+        order_information = {
+            'amountDetails': {
+                'totalAmount': str(self.order_total.incl_tax),
+                'currency': self.order_total.currency,
+            },
+            'lineItems': [{
+                'productName': name,
+                'productSku': sku,
+                'quantity': quantity,
+                'unitPrice': str(unit_price),
+            } for name, sku, quantity, unit_price in get_line_item_strategy().line_items(self.basket)],
+        }
+
+        # Without an address, CyberSource uses the one stored with the token
+        if self.billing_address:
+            order_information['billTo'] = {
+                'firstName': self.billing_address.first_name,
+                'lastName': self.billing_address.last_name,
+                'address1': self.billing_address.line1,
+                'address2': self.billing_address.line2,
+                'locality': self.billing_address.line4,
+                'administrativeArea': self.billing_address.state,
+                'postalCode': self.billing_address.postcode,
+                'country': self.billing_address.country.code,
+                'email': self.email or '',
+            }
+        if self.shipping_address:
+            order_information['shipTo'] = {
+                'firstName': self.shipping_address.first_name,
+                'lastName': self.shipping_address.last_name,
+                'address1': self.shipping_address.line1,
+                'address2': self.shipping_address.line2,
+                'locality': self.shipping_address.line4,
+                'administrativeArea': self.shipping_address.state,
+                'postalCode': self.shipping_address.postcode,
+                'country': self.shipping_address.country.code,
+                'phoneNumber': re.sub('[^0-9]', '', self.shipping_address.phone_number.as_rfc3966),
+            }
+
+        body = {
+            'clientReferenceInformation': {'code': self.order_number},
+            'paymentInformation': {'customer': {'customerId': self.token.token}},
+            'orderInformation': order_information,
+        }
+        device_information = {}
+        if self.customer_ip_address:
+            device_information['ipAddress'] = self.customer_ip_address
+        if self.device_fingerprint_id:
+            device_information['fingerprintSessionId'] = self.device_fingerprint_id
+        if device_information:
+            body['deviceInformation'] = device_information
+        return body
+
+
+    def authorize(self, client=None):
+        """
+        Send the authorization and return the reply data. Authorizations are never retried, since a retry
+        of a request which timed out after reaching CyberSource would authorize the card twice.
+        """
+        client = client or rest.get_client()
+        try:
+            status_code, response = client.post(self.path, self.build_request_body(), timeout=settings.TOKEN_AUTH_TIMEOUT)
+        except requests.RequestException as e:
+            reason = 'SERVER_TIMEOUT' if isinstance(e, requests.Timeout) else 'SYSTEM_ERROR'
+            status_code, response = None, {'status': 'ERROR', 'reason': reason, 'message': str(e)}
+        return self.build_reply_data(status_code, response)
+
+
+    def build_reply_data(self, status_code, response):
+        error = response.get('errorInformation', {})
+        processor = response.get('processorInformation', {})
+        amount = response.get('orderInformation', {}).get('amountDetails', {})
+        decision = self.DECISIONS.get(response.get('status'), 'ERROR')
+        if decision == 'ACCEPT':
+            reason_code = '100'
+        elif decision == 'REVIEW':
+            reason_code = '480'
+        else:
+            reason = error.get('reason') or response.get('reason')
+            reason_code = self.REASON_CODES.get(reason, '203' if decision == 'DECLINE' else '150')
+
+        data = rest.flatten(response)
+        data.update({
+            'decision': decision,
+            'reason_code': reason_code,
+            'message': error.get('message') or response.get('message', ''),
+            'http_status': str(status_code or ''),
+            'transaction_id': response.get('id', ''),
+            'request_token': '',
+            'payment_token': self.token.token,
+            'auth_amount': amount.get('authorizedAmount') or str(self.order_total.incl_tax),
+            'auth_code': processor.get('approvalCode', ''),
+            'auth_avs_code': processor.get('avs', {}).get('code', ''),
+            'req_amount': str(self.order_total.incl_tax),
+            'req_currency': self.order_total.currency,
+            'req_reference_number': self.order_number,
+            'req_card_number': self.token.masked_card_number,
+            'req_card_type': self.token.card_type,
+            'req_transaction_type': self.transaction_type,
+            'signed_date_time': response.get('submitTimeUtc') or datetime.utcnow().strftime(settings.DATE_FORMAT),
+        })
+        return data
+
+
+class ReverseAuthorization(object):
+    """
+    Reverse a token authorization through the REST API, releasing the hold on the customer's card. Used when
+    the order can't be placed after the card was authorized.
+    """
+    path = '/pts/v2/payments/%s/reversals'
+    transaction_type = 'authorization_reversal'
+
+    def __init__(self, order_number, amount, transaction_id, reason=''):
+        self.order_number = order_number
+        self.amount = amount
+        self.transaction_id = transaction_id
+        self.reason = reason
+
+    def build_request_body(self):
+        return {
+            'clientReferenceInformation': {'code': self.order_number},
+            'reversalInformation': {
+                'amountDetails': {'totalAmount': str(self.amount)},
+                'reason': self.reason,
+            },
+        }
+
+    def reverse(self, client=None):
+        """
+        Send the reversal and return the response translated into reply log fields. ``decision`` is ACCEPT
+        if the authorization was reversed.
+        """
+        client = client or rest.get_client()
+        try:
+            status_code, response = client.post(self.path % self.transaction_id, self.build_request_body(),
+                timeout=settings.TOKEN_AUTH_TIMEOUT)
+        except requests.RequestException as e:
+            status_code, response = None, {'status': 'ERROR', 'reason': e.__class__.__name__, 'message': str(e)}
+        data = rest.flatten(response)
+        data.update({
+            'decision': 'ACCEPT' if response.get('status') == 'REVERSED' else 'ERROR',
+            'http_status': str(status_code or ''),
+            'transaction_id': response.get('id', ''),
+            'req_amount': str(self.amount),
+            'req_authorization_id': self.transaction_id,
+            'req_reference_number': self.order_number,
+            'req_transaction_type': self.transaction_type,
+        })
+        return data
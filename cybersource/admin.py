@@ -1,9 +1,31 @@
 from django.contrib import admin
-from . import models
+from django.contrib.admin.views.main import ChangeList
+from . import models, routers
+
+
+class ReplicaChangeList(ChangeList):
+    """
+    Change list which reads from the replica, if there is one.
+    """
+    def get_queryset(self, request):
+        return routers.replica(super().get_queryset(request))
+
+    def get_results(self, request):
+        self.root_queryset = routers.replica(self.root_queryset)
+        super().get_results(request)
+
+
+class ReplicaListingMixin(object):
+    def get_changelist(self, request, **kwargs):
+        return ReplicaChangeList
+
+    def response_action(self, request, queryset):
+        # Actions, like deleting the selected rows, write to the primary
+        return super().response_action(request, routers.primary(queryset))
 
 
 @admin.register(models.PaymentToken)
-class PaymentTokenAdmin(admin.ModelAdmin):
+class PaymentTokenAdmin(ReplicaListingMixin, admin.ModelAdmin):
     list_filter = ['card_type', 'log__date_created']
     search_fields = ['token', 'card_type', 'masked_card_number']
     fields = ['token', 'card_type', 'masked_card_number', 'log']
@@ -12,8 +34,17 @@ class PaymentTokenAdmin(admin.ModelAdmin):
 
 
 @admin.register(models.CyberSourceReply)
-class CyberSourceReplyAdmin(admin.ModelAdmin):
+class CyberSourceReplyAdmin(ReplicaListingMixin, admin.ModelAdmin):
     list_filter = ['date_modified', 'date_created']
     list_display = ['date_created', 'user', 'date_modified']
     fields = ['user', 'data', 'date_modified', 'date_created']
     readonly_fields = fields
+
+
+@admin.register(models.ReplyDecisionStat)
+class ReplyDecisionStatAdmin(ReplicaListingMixin, admin.ModelAdmin):
+    list_filter = ['decision', 'reason_code', 'card_type', 'currency']
+    list_display = ['hour', 'decision', 'reason_code', 'avs_code', 'card_type', 'currency', 'count', 'amount']
+    date_hierarchy = 'hour'
+    fields = list_display
+    readonly_fields = fields
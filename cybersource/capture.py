@@ -0,0 +1,252 @@
+"""
+Capture authorized orders in batches through the CyberSource REST payments API.
+
+Secure Acceptance only authorizes cards, so orders in ``ORDER_STATUS_SUCCESS`` still have to be captured
+before they settle. Capture requests are sent concurrently over a single pooled keep-alive HTTP session, and
+each result is recorded as a ``payment.Transaction`` as soon as it arrives. Requests are only retried when
+CyberSource can't have processed them: connection failures, and 429 and 503 responses. Captures whose
+outcome is unknown, after a read timeout or another 5xx response, are recorded as ``UNKNOWN`` and left for
+reconciliation rather than sent again. Only one run captures at a time.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from django.db import connections, router, transaction
+from django.db.models import F
+from django_statsd.clients import statsd
+from requests.packages.urllib3.exceptions import MaxRetryError
+from . import lookups, rest, settings
+from .loading import get_model
+from .models import CyberSourceReply
+import logging
+import requests
+import time
+
+logger = logging.getLogger(__name__)
+
+Line = get_model('order', 'Line')
+PaymentEvent = get_model('order', 'PaymentEvent')
+PaymentEventQuantity = get_model('order', 'PaymentEventQuantity')
+Source = get_model('payment', 'Source')
+Transaction = get_model('payment', 'Transaction')
+
+CAPTURE_PATH = '/pts/v2/payments/%s/captures'
+CAPTURE_SUCCESS_STATUSES = ('PENDING', 'TRANSMITTED')
+CAPTURE_UNKNOWN_STATUS = 'UNKNOWN'
+RETRY_STATUS_CODES = (429, 503)
+UNKNOWN_STATUS_CODES = (500, 502, 504)
+
+# Key of the Postgres advisory lock held by a capture run
+CAPTURE_LOCK_ID = 0x63796263
+
+CaptureResult = namedtuple('CaptureResult', ('authorization', 'status_code', 'data', 'attempts'))
+
+
+class CaptureInProgress(Exception):
+    pass
+
+
+def get_authorizations(limit=None):
+    """
+    Accepted authorizations for orders in ORDER_STATUS_SUCCESS which haven't been captured yet. Those with a
+    capture of unknown outcome are left out until it's been reconciled.
+    """
+    captured = Transaction.objects.filter(txn_type=Transaction.DEBIT,
+        status__in=CAPTURE_SUCCESS_STATUSES + (CAPTURE_UNKNOWN_STATUS, ))
+    qs = Transaction.objects\
+        .filter(txn_type=Transaction.AUTHORISE, status='ACCEPT', source__order__status=settings.ORDER_STATUS_SUCCESS)\
+        .exclude(source_id__in=captured.values('source_id'))\
+        .select_related('source', 'source__order', 'token')\
+        .order_by('id')
+    if limit:
+        qs = qs[:limit]
+    return qs
+
+
+@contextmanager
+def capture_lock():
+    """
+    Hold the capture advisory lock for the block, so that concurrent runs can't capture the same
+    authorizations. Raises CaptureInProgress if another run holds it.
+    """
+    connection = connections[router.db_for_write(Transaction)]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [CAPTURE_LOCK_ID])
+        if not cursor.fetchone()[0]:
+            raise CaptureInProgress('Another capture run is in progress')
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [CAPTURE_LOCK_ID])
+
+
+def is_connect_error(e):
+    """
+    Whether a request failed before reaching CyberSource, so that sending it again can't capture twice.
+    Connection resets and read timeouts happen after the request may have been received.
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    return isinstance(e, requests.ConnectionError) and bool(e.args) and isinstance(e.args[0], MaxRetryError)
+
+
+def build_capture_body(authorization):
+    return {
+        'clientReferenceInformation': {
+            'code': authorization.source.order.number,
+        },
+        'orderInformation': {
+            'amountDetails': {
+                'totalAmount': str(authorization.amount),
+                'currency': authorization.source.currency,
+            },
+        },
+    }
+
+
+class CaptureClient(rest.RESTClient):
+    """
+    REST client which retries capture requests, but only when they can't have been processed.
+    """
+    def __init__(self, concurrency=None, max_retries=None, backoff=None, **kwargs):
+        self.concurrency = concurrency or settings.CAPTURE_CONCURRENCY
+        self.max_retries = settings.CAPTURE_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = settings.CAPTURE_RETRY_BACKOFF if backoff is None else backoff
+        kwargs.setdefault('pool_size', self.concurrency)
+        super().__init__(**kwargs)
+
+    def capture(self, authorization_id, body):
+        """
+        POST a capture request, retrying connection failures and 429 and 503 responses with exponential
+        backoff. Return the last response's status code and JSON body, and the number of attempts made. The
+        status code is None if no response was received.
+        """
+        path = CAPTURE_PATH % authorization_id
+        status_code, data = None, {}
+        for attempt in range(1, self.max_retries + 2):
+            try:
+                status_code, data = self.post(path, body)
+            except requests.RequestException as e:
+                status_code, data = None, {'status': 'ERROR', 'reason': e.__class__.__name__, 'message': str(e)}
+                if not is_connect_error(e):
+                    data['status'] = CAPTURE_UNKNOWN_STATUS
+                    return status_code, data, attempt
+            else:
+                if status_code not in RETRY_STATUS_CODES:
+                    return status_code, data, attempt
+            if attempt <= self.max_retries:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+        return status_code, data, attempt
+
+
+def capture_orders(authorizations=None, client=None, limit=None):
+    """
+    Capture every pending authorization (or those of the given ones which are still pending), recording
+    each result as it arrives. Returns a list of CaptureResult tuples, in the order of the authorizations.
+    Raises CaptureInProgress if another run is capturing.
+    """
+    with capture_lock():
+        # Only read the authorizations once the lock is held, so none captured by another run are included
+        pending = get_authorizations()
+        if authorizations is not None:
+            pending = pending.filter(pk__in=[authorization.pk for authorization in authorizations])
+        if limit:
+            pending = pending[:limit]
+        pending = list(pending)
+        if not pending:
+            return []
+
+        own_client = client is None
+        client = client or CaptureClient()
+        # Build every request body up front, so the worker threads only do network I/O
+        jobs = [(authorization, build_capture_body(authorization)) for authorization in pending]
+
+        def send(job):
+            authorization, body = job
+            return CaptureResult(authorization, *client.capture(authorization.reference, body))
+
+        results = [None] * len(jobs)
+        try:
+            with ThreadPoolExecutor(max_workers=client.concurrency) as executor:
+                futures = {executor.submit(send, job): i for i, job in enumerate(jobs)}
+                # Record results in this thread as they complete, so that an interrupted run loses at most
+                # the captures still in flight
+                for future in as_completed(futures):
+                    result = future.result()
+                    record_capture(result)
+                    results[futures[future]] = result
+        finally:
+            if own_client:
+                client.close()
+    return results
+
+
+def is_success(result):
+    return result.status_code == 201 and result.data.get('status') in CAPTURE_SUCCESS_STATUSES
+
+
+def is_unknown(result):
+    return result.data.get('status') == CAPTURE_UNKNOWN_STATUS or result.status_code in UNKNOWN_STATUS_CODES
+
+
+@transaction.atomic
+def record_capture(result):
+    """
+    Record a DEBIT Transaction for a capture attempt, and a PaymentEvent if it succeeded.
+    """
+    authorization = result.authorization
+    order = authorization.source.order
+    data = rest.flatten(result.data)
+    data['http_status'] = str(result.status_code or '')
+    data['req_reference_number'] = order.number
+    data['req_transaction_type'] = 'capture'
+    log = CyberSourceReply.objects.create(data=data)
+
+    status = CAPTURE_UNKNOWN_STATUS if is_unknown(result) else (result.data.get('status') or 'ERROR')
+    try:
+        processed = datetime.strptime(result.data.get('submitTimeUtc', ''), settings.DATE_FORMAT)
+    except ValueError:
+        processed = datetime.utcnow()
+    Transaction.objects.create(
+        log=log,
+        source=authorization.source,
+        token=authorization.token,
+        txn_type=Transaction.DEBIT,
+        amount=authorization.amount,
+        reference=result.data.get('id', ''),
+        status=status,
+        request_token='',
+        processed_datetime=processed)
+
+    statsd.incr('checkout.cybersource-capture.%s' % status.lower())
+    if status == CAPTURE_UNKNOWN_STATUS:
+        logger.error('Capture of order %s has an unknown outcome and must be reconciled: %s %s',
+            order.number, result.status_code, result.data.get('reason', ''))
+        return
+    if not is_success(result):
+        logger.warning('Capture of order %s failed after %d attempt(s): %s %s',
+            order.number, result.attempts, result.status_code, result.data.get('reason', status))
+        return
+
+    Source.objects.filter(pk=authorization.source_id).update(amount_debited=F('amount_debited') + authorization.amount)
+    event = PaymentEvent.objects.create(
+        order=order,
+        amount=authorization.amount,
+        reference=result.data.get('id', ''),
+        event_type=lookups.get_payment_event_type(Transaction.DEBIT))
+    PaymentEventQuantity.objects.bulk_create([
+        PaymentEventQuantity(event=event, line=line, quantity=line.quantity)
+        for line in Line.objects.filter(order_id=order.pk)
+    ])
+
+
+def summarize(results):
+    return {
+        'captured': sum(1 for result in results if is_success(result)),
+        'failed': sum(1 for result in results if not is_success(result) and not is_unknown(result)),
+        'unknown': sum(1 for result in results if is_unknown(result)),
+        'amount': sum((result.authorization.amount for result in results if is_success(result)), Decimal('0.00')),
+    }
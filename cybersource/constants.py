@@ -3,3 +3,6 @@ CHECKOUT_ORDER_ID = 'checkout_order_id'
 CHECKOUT_ORDER_NUM = 'checkout_order_num'
 CHECKOUT_SHIPPING_CODE = 'checkout_shipping_code'
 CHECKOUT_FINGERPRINT_SESSION_ID = 'cybersource_fingerprint_session_id'
+CHECKOUT_SIGN_STARTED = 'cybersource_sign_started'
+CHECKOUT_PRIMARY_UNTIL = 'cybersource_primary_until'
+CHECKOUT_TOKEN_AUTH_ORDER_NUM = 'cybersource_token_auth_order_num'
@@ -0,0 +1,30 @@
+from functools import wraps
+from django.http import HttpResponseBadRequest
+from django_statsd.clients import statsd
+from . import metrics
+from .signature import get_signer
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def reject_unsigned_post(view_func):
+    """
+    Reject POSTs which aren't correctly signed by CyberSource before the view does any parsing, session,
+    or authentication work. Only the form body is read, so forged requests never touch the database.
+    """
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        if request.method == 'POST':
+            reason = None
+            if not request.POST.get('signed_field_names') or not request.POST.get('signature'):
+                reason = 'unsigned'
+            elif not get_signer().verify_data(request.POST):
+                reason = 'bad-signature'
+            if reason:
+                logger.warning('Rejected %s CyberSource reply from %s', reason, request.META.get('REMOTE_ADDR'))
+                statsd.incr('checkout.cybersource-reply.rejected.%s' % reason)
+                metrics.SIGNATURE_FAILURES.inc(reason=reason)
+                return HttpResponseBadRequest('Bad Signature')
+        return view_func(request, *args, **kwargs)
+    return wrapped_view
@@ -0,0 +1,127 @@
+from django.db import connections, transaction
+from django.utils.encoding import force_text
+from . import routers
+from .loading import get_model
+import csv
+import json
+import uuid
+
+Transaction = get_model('payment', 'Transaction')
+
+
+TRANSACTION_FIELDS = (
+    ('id', 'id'),
+    ('reference', 'reference'),
+    ('txn_type', 'txn_type'),
+    ('status', 'status'),
+    ('amount', 'amount'),
+    ('currency', 'source__currency'),
+    ('order_number', 'source__order__number'),
+    ('request_token', 'request_token'),
+    ('processed_datetime', 'processed_datetime'),
+    ('date_created', 'date_created'),
+    ('token', 'token__token'),
+    ('card_type', 'token__card_type'),
+    ('masked_card_number', 'token__masked_card_number'),
+    ('reply_id', 'log_id'),
+)
+
+REPLY_FIELDS = (
+    'decision',
+    'reason_code',
+    'auth_code',
+    'auth_amount',
+    'auth_avs_code',
+)
+
+
+def get_transactions(start=None, end=None):
+    """
+    Transactions to export, filtered on the indexed date_created column and ordered by primary key. Read
+    from the replica, if there is one.
+    """
+    qs = routers.replica(Transaction.objects.order_by('id'))
+    if start:
+        qs = qs.filter(date_created__gte=start)
+    if end:
+        qs = qs.filter(date_created__lt=end)
+    return qs
+
+
+def iter_server_side(queryset, fields, batch_size=2000):
+    """
+    Yield value tuples for the queryset using a server-side (named) cursor, so that only
+    ``batch_size`` rows are ever held in memory at once.
+    """
+    qs = queryset.values_list(*fields)
+    sql, params = qs.query.sql_with_params()
+    return iter_sql(sql, params, using=qs.db, batch_size=batch_size)
+
+
+def iter_sql(sql, params=None, using='default', batch_size=2000):
+    """
+    Yield the result rows of a raw SQL query using a server-side (named) cursor.
+    """
+    conn = connections[using]
+    with transaction.atomic(using=using):
+        cursor = conn.connection.cursor(name='cybersource_export_%s' % uuid.uuid4().hex)
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+
+def iter_transaction_rows(start=None, end=None, batch_size=2000):
+    """
+    Yield one dict per transaction, joined to its payment token and selected reply log fields.
+    """
+    names = [name for name, lookup in TRANSACTION_FIELDS]
+    lookups = [lookup for name, lookup in TRANSACTION_FIELDS] + ['log__data']
+    for row in iter_server_side(get_transactions(start, end), lookups, batch_size):
+        data = dict(zip(names, row))
+        reply_data = row[-1] or {}
+        for field in REPLY_FIELDS:
+            data[field] = reply_data.get(field, '')
+        yield data
+
+
+def get_columns():
+    return [name for name, lookup in TRANSACTION_FIELDS] + list(REPLY_FIELDS)
+
+
+class Echo(object):
+    """
+    File-like object which just returns what is written to it, for use with csv.writer.
+    """
+    def write(self, value):
+        return value
+
+
+def _text(value):
+    return '' if value is None else force_text(value)
+
+
+def iter_csv(rows):
+    columns = get_columns()
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([_text(row[column]) for column in columns])
+
+
+def iter_jsonl(rows):
+    for row in rows:
+        yield json.dumps({key: (value if isinstance(value, (int, type(None))) else _text(value)) for key, value in row.items()}, sort_keys=True) + '\n'
+
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'jsonl': (iter_jsonl, 'application/x-ndjson'),
+}
@@ -0,0 +1,98 @@
+"""
+Indexes on the columns this package looks rows up by.
+
+``Transaction`` lives in the host project's forked payment app, so its indexes can't be created by this
+package's migrations. ``create_index`` can be used in the host's own migrations, and the
+``cybersource_check_indexes`` management command reports any index which is still missing.
+
+Indexes are built with ``CREATE INDEX CONCURRENTLY`` when the migration isn't run in a transaction (Django
+1.10+ with ``atomic = False``). Django 1.8 always runs migrations in a transaction, so on large tables run
+the SQL printed by ``cybersource_check_indexes`` by hand before migrating; migrations skip indexes which
+already exist.
+"""
+from collections import namedtuple
+from django.apps import apps
+from django.db import connections, migrations
+
+# Model, field, and index method
+INDEXES = (
+    ('cybersource', 'CyberSourceReply', 'date_created', 'brin'),
+    ('cybersource', 'CyberSourceReply', 'date_modified', 'btree'),
+    ('cybersource', 'PaymentToken', 'token', 'btree'),
+    ('payment', 'Transaction', 'reference', 'btree'),
+    ('payment', 'Transaction', 'request_token', 'btree'),
+    ('payment', 'Transaction', 'processed_datetime', 'btree'),
+)
+
+MissingIndex = namedtuple('MissingIndex', ('table', 'column', 'method', 'sql'))
+
+
+def get_index_name(table, column):
+    return '%s_%s_idx' % (table, column)
+
+
+def get_method(connection, method):
+    # BRIN indexes need PostgreSQL 9.5
+    if method == 'brin' and connection.pg_version < 90500:
+        return 'btree'
+    return method
+
+
+def get_create_sql(connection, table, column, method='btree', concurrently=True):
+    qn = connection.ops.quote_name
+    return 'CREATE INDEX %s%s ON %s USING %s (%s)' % (
+        'CONCURRENTLY ' if concurrently else '',
+        qn(get_index_name(table, column)),
+        qn(table),
+        get_method(connection, method),
+        qn(column))
+
+
+def has_index(connection, cursor, table, column):
+    """
+    Whether the column is the leading column of any index, unique constraint or primary key.
+    """
+    constraints = connection.introspection.get_constraints(cursor, table)
+    for constraint in constraints.values():
+        is_index = constraint['index'] or constraint['unique'] or constraint['primary_key']
+        if is_index and constraint['columns'] and constraint['columns'][0] == column:
+            return True
+    return False
+
+
+def create_index(app_label, model_name, field_name, method='btree'):
+    """
+    Migration operation which indexes a field unless it's already indexed.
+    """
+    def forwards(state_apps, schema_editor):
+        connection = schema_editor.connection
+        opts = state_apps.get_model(app_label, model_name)._meta
+        column = opts.get_field(field_name).column
+        with connection.cursor() as cursor:
+            if has_index(connection, cursor, opts.db_table, column):
+                return
+        concurrently = not connection.in_atomic_block
+        schema_editor.execute(get_create_sql(connection, opts.db_table, column, method, concurrently))
+
+    def backwards(state_apps, schema_editor):
+        opts = state_apps.get_model(app_label, model_name)._meta
+        column = opts.get_field(field_name).column
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % schema_editor.quote_name(get_index_name(opts.db_table, column)))
+
+    return migrations.RunPython(forwards, backwards)
+
+
+def find_missing_indexes(using='default'):
+    """
+    List the indexes from INDEXES which don't exist in the database, using the host project's models.
+    """
+    connection = connections[using]
+    missing = []
+    with connection.cursor() as cursor:
+        for app_label, model_name, field_name, method in INDEXES:
+            opts = apps.get_model(app_label, model_name)._meta
+            column = opts.get_field(field_name).column
+            if not has_index(connection, cursor, opts.db_table, column):
+                sql = get_create_sql(connection, opts.db_table, column, method)
+                missing.append(MissingIndex(opts.db_table, column, get_method(connection, method), sql))
+    return missing
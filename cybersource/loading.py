@@ -0,0 +1,45 @@
+"""
+Lazy versions of Oscar's ``get_class`` and ``get_model``.
+
+Resolving a class through Oscar's loader imports every candidate module of every installed app, which adds
+up when it's done for a dozen classes at import time by each worker and management command. These return a
+proxy which resolves the class the first time it's called, one of its attributes is used, or it's passed
+to ``isinstance``. Classes which are subclassed, or caught in an ``except`` clause, still need the real
+class from ``oscar.core.loading``.
+"""
+from oscar.core import loading
+
+
+class LazyClass(object):
+    def __init__(self, loader, *args):
+        self._loader = loader
+        self._args = args
+        self._class = None
+
+    def resolve(self):
+        if self._class is None:
+            self._class = self._loader(*self._args)
+        return self._class
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self.resolve())
+
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self.resolve())
+
+    def __repr__(self):
+        return '<LazyClass %s>' % '.'.join(self._args)
+
+
+def get_class(module_label, classname):
+    return LazyClass(loading.get_class, module_label, classname)
+
+
+def get_model(app_label, model_name):
+    return LazyClass(loading.get_model, app_label, model_name)
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from django.db.models.signals import post_delete, post_save
+from . import settings
+from .loading import get_model
+import threading
+import time
+
+Country = get_model('address', 'Country')
+PaymentEventType = get_model('order', 'PaymentEventType')
+SourceType = get_model('payment', 'SourceType')
+
+
+class LRUCache(object):
+    """
+    Small thread-safe, process-local LRU cache with a TTL, for reference data which rarely changes.
+    """
+
+    def __init__(self, name, maxsize=None, ttl=None):
+        self.name = name
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Read from settings on use, since the caches are built at import time
+    @property
+    def maxsize(self):
+        return self._maxsize or settings.LOOKUP_CACHE_SIZE
+
+    @property
+    def ttl(self):
+        return self._ttl or settings.LOOKUP_CACHE_TTL
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else None,
+            }
+
+
+countries = LRUCache('countries')
+source_types = LRUCache('source_types')
+payment_event_types = LRUCache('payment_event_types')
+
+
+def get_country(code):
+    """
+    Return the Country with the given ISO code. Raises Country.DoesNotExist if there isn't one.
+    """
+    country = countries.get(code)
+    if country is None:
+        country = Country.objects.get(pk=code)
+        countries.set(code, country)
+    return country
+
+
+def _get_or_create_by_name(cache, model, name):
+    instance = cache.get(name)
+    if instance is None:
+        instance, created = model.objects.get_or_create(name=name)
+        # Don't cache rows created in the current transaction, since it could still be rolled back
+        if not created:
+            cache.set(name, instance)
+    return instance
+
+
+def get_source_type(name):
+    return _get_or_create_by_name(source_types, SourceType, name)
+
+
+def get_payment_event_type(name):
+    return _get_or_create_by_name(payment_event_types, PaymentEventType, name)
+
+
+def clear_all():
+    for cache in (countries, source_types, payment_event_types):
+        cache.invalidate()
+
+
+def stats():
+    return {cache.name: cache.stats() for cache in (countries, source_types, payment_event_types)}
+
+
+def _invalidate(sender, **kwargs):
+    # Names and codes can change on save, so drop the whole (small) cache for the model
+    for model, cache in ((Country, countries), (SourceType, source_types), (PaymentEventType, payment_event_types)):
+        if sender is model.resolve():
+            cache.invalidate()
+
+
+# Connected for every sender, since the models are only resolved once the first signal is sent
+post_save.connect(_invalidate, dispatch_uid='cybersource.lookups')
+post_delete.connect(_invalidate, dispatch_uid='cybersource.lookups')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from cybersource import capture
+
+
+class Command(BaseCommand):
+    help = "Capture the authorized orders which haven't been captured yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of orders to capture')
+        parser.add_argument('--concurrency', type=int, default=None, help='Number of concurrent capture requests. Defaults to CYBERSOURCE_CAPTURE_CONCURRENCY.')
+        parser.add_argument('--dry-run', action='store_true', default=False, dest='dry_run', help='List the orders which would be captured')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            authorizations = list(capture.get_authorizations(options['limit']))
+            for authorization in authorizations:
+                self.stdout.write('%s\t%s %s' % (authorization.source.order.number, authorization.amount, authorization.source.currency))
+            self.stdout.write('%d orders to capture' % len(authorizations))
+            return
+
+        client = capture.CaptureClient(concurrency=options['concurrency'])
+        try:
+            results = capture.capture_orders(client=client, limit=options['limit'])
+        except capture.CaptureInProgress as e:
+            raise CommandError(str(e))
+        finally:
+            client.close()
+        summary = capture.summarize(results)
+        self.stdout.write('Captured %(captured)d orders totalling %(amount)s, %(failed)d failed, %(unknown)d unknown' % summary)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from cybersource.indexes import find_missing_indexes
+
+
+class Command(BaseCommand):
+    help = "Check that the columns CyberSource replies and transactions are looked up by are indexed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database alias to check')
+
+    def handle(self, *args, **options):
+        missing = find_missing_indexes(options['database'])
+        if not missing:
+            self.stdout.write('All indexes exist')
+            return
+        for index in missing:
+            self.stdout.write('Missing %s index on %s.%s:' % (index.method, index.table, index.column))
+            self.stdout.write('    %s;' % index.sql)
+        raise CommandError('%d missing indexes' % len(missing))
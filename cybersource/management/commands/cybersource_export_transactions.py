@@ -0,0 +1,35 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from cybersource import export
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError('Invalid date: %s' % value)
+
+
+class Command(BaseCommand):
+    help = "Stream transactions, joined to their payment tokens and reply logs, as CSV or JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', default='csv', choices=sorted(export.FORMATS.keys()))
+        parser.add_argument('--start', default=None, help='Only export transactions created on or after YYYY-MM-DD')
+        parser.add_argument('--end', default=None, help='Only export transactions created before YYYY-MM-DD')
+        parser.add_argument('--output', default=None, help='File to write to. Defaults to stdout.')
+        parser.add_argument('--batch-size', type=int, default=2000, dest='batch_size')
+
+    def handle(self, *args, **options):
+        start = parse_date(options['start']) if options['start'] else None
+        end = parse_date(options['end']) if options['end'] else None
+        writer, content_type = export.FORMATS[options['format']]
+        rows = export.iter_transaction_rows(start, end, options['batch_size'])
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as out:
+                for chunk in writer(rows):
+                    out.write(chunk)
+        else:
+            for chunk in writer(rows):
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from cybersource import settings
+import os
+import pstats
+
+
+class Command(BaseCommand):
+    help = "Aggregate the checkout view profile dumps into a report of the hottest functions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Profile directory. Defaults to CYBERSOURCE_PROFILE_DIR.')
+        parser.add_argument('--view', default=None, help='Only include dumps for this view class name')
+        parser.add_argument('--top', type=int, default=25, help='Number of functions to show')
+        parser.add_argument('--sort', default='cumulative', help='pstats sort key, e.g. cumulative, tottime, ncalls')
+
+    def handle(self, *args, **options):
+        profile_dir = options['dir'] or settings.PROFILE_DIR
+        if not profile_dir or not os.path.isdir(profile_dir):
+            raise CommandError('Profile directory does not exist: %s' % profile_dir)
+
+        views = [options['view']] if options['view'] else sorted(os.listdir(profile_dir))
+        for view_name in views:
+            view_dir = os.path.join(profile_dir, view_name)
+            if not os.path.isdir(view_dir):
+                continue
+            dumps = sorted(os.path.join(view_dir, name) for name in os.listdir(view_dir) if name.endswith('.prof'))
+            if not dumps:
+                continue
+
+            self.stdout.write('%s: %d profiled requests' % (view_name, len(dumps)))
+            stats = pstats.Stats(*dumps, stream=self.stdout)
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['top'])
@@ -0,0 +1,26 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from cybersource import stats
+
+
+def parse_datetime(value):
+    for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise CommandError('Invalid date: %s' % value)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hourly reply decision statistics from the reply log"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', default=None, help='Only rebuild hours starting at YYYY-MM-DD[THH:MM]')
+        parser.add_argument('--end', default=None, help='Only rebuild hours before YYYY-MM-DD[THH:MM]')
+
+    def handle(self, *args, **options):
+        start = parse_datetime(options['start']) if options['start'] else None
+        end = parse_datetime(options['end']) if options['end'] else None
+        num_rows = stats.rebuild(start, end)
+        self.stdout.write('Rebuilt %d decision statistic rows' % num_rows)
@@ -0,0 +1,53 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from cybersource import reconcile
+import csv
+import os
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError('Invalid date: %s' % value)
+
+
+class Command(BaseCommand):
+    help = "Reconcile a CyberSource transaction detail report (CSV or XML) against our transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('report', help='Transaction detail report file')
+        parser.add_argument('--format', default=None, choices=sorted(reconcile.PARSERS.keys()),
+            help='Report format. Defaults to the file extension.')
+        parser.add_argument('--start', default=None, help='Also report our transactions created on or after YYYY-MM-DD which are missing from the report')
+        parser.add_argument('--end', default=None, help='Also report our transactions created before YYYY-MM-DD which are missing from the report')
+        parser.add_argument('--output', default=None, help='File to write mismatches to. Defaults to stdout.')
+        parser.add_argument('--batch-size', type=int, default=10000, dest='batch_size')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or os.path.splitext(options['report'])[1].lstrip('.').lower()
+        if fmt not in reconcile.PARSERS:
+            raise CommandError('Unknown report format: %s' % fmt)
+        start = parse_date(options['start']) if options['start'] else None
+        end = parse_date(options['end']) if options['end'] else None
+
+        if fmt == 'xml':
+            report = open(options['report'], 'rb')
+        else:
+            report = open(options['report'], 'r', newline='', encoding='utf-8-sig')
+        out = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        counts = {}
+        try:
+            writer = csv.writer(out)
+            writer.writerow(reconcile.MISMATCH_FIELDS)
+            rows = reconcile.PARSERS[fmt](report)
+            for mismatch in reconcile.reconcile(rows, start, end, options['batch_size']):
+                writer.writerow(['' if value is None else value for value in mismatch])
+                counts[mismatch.mismatch] = counts.get(mismatch.mismatch, 0) + 1
+        finally:
+            report.close()
+            if options['output']:
+                out.close()
+
+        summary = ', '.join('%s %s' % (count, name) for name, count in sorted(counts.items())) or 'no mismatches'
+        self.stderr.write('Reconciliation finished: %s' % summary)
@@ -0,0 +1,41 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from cybersource import routers
+from cybersource.models import CyberSourceReply
+from cybersource.projection import get_projection
+
+
+class Command(BaseCommand):
+    help = "Report the bytes stored per reply log field and how many the reply log field projection saves"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+            help='Only inspect the most recent N replies')
+
+    def handle(self, *args, **options):
+        proj = get_projection()
+        sizes = defaultdict(int)
+        counts = defaultdict(int)
+
+        replies = routers.replica(CyberSourceReply.objects.order_by('-id')).values_list('data', flat=True)
+        if options['limit']:
+            replies = replies[:options['limit']]
+
+        num_replies = 0
+        for data in replies.iterator():
+            num_replies += 1
+            for key, value in data.items():
+                sizes[key] += len(key.encode('utf-8')) + len((value or '').encode('utf-8'))
+                counts[key] += 1
+
+        total = sum(sizes.values())
+        saved = sum(size for key, size in sizes.items() if not proj.keeps(key))
+
+        self.stdout.write('%-40s %10s %12s %8s' % ('field', 'replies', 'bytes', 'stored'))
+        for key in sorted(sizes, key=lambda k: (-sizes[k], k)):
+            self.stdout.write('%-40s %10d %12d %8s' % (key, counts[key], sizes[key], 'yes' if proj.keeps(key) else 'no'))
+
+        self.stdout.write('')
+        self.stdout.write('Replies inspected: %d' % num_replies)
+        self.stdout.write('Total bytes: %d' % total)
+        self.stdout.write('Bytes saved by projection: %d (%.1f%%)' % (saved, (100.0 * saved / total) if total else 0))
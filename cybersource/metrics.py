@@ -0,0 +1,293 @@
+from collections import defaultdict
+from . import settings
+import atexit
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Holds the summed values of the processes which have exited
+AGGREGATE_FILENAME = 'metrics-aggregate.json'
+LOCK_FILENAME = 'metrics.lock'
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(merged, snapshot):
+    for name, values in snapshot.items():
+        for labels, value in values.items():
+            current = merged[name].get(labels)
+            if current is None:
+                merged[name][labels] = value
+            elif isinstance(value, list):
+                merged[name][labels] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[name][labels] = current + value
+    return merged
+
+
+def _read_snapshot(path):
+    with open(path) as f:
+        data = json.load(f)
+    return {name: {tuple(labels): value for labels, value in values} for name, values in data.items()}
+
+
+def _write_snapshot(path, snapshot):
+    data = {name: [[list(labels), value] for labels, value in values.items()]
+            for name, values in snapshot.items()}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class Registry(object):
+    """
+    In-process metric registry. Values are kept in memory and protected by a lock, so they're thread
+    safe. When METRICS_DIR is set, each process also periodically writes a snapshot of its values to
+    its own file in that directory, and the exposition sums the snapshots of every process.
+
+    A forked worker starts with an empty registry, since the values it inherits are still counted by its
+    parent. Each process writes to a file named after its pid and a random token, so a process which is
+    given the pid of an exited one doesn't overwrite its values. Processes write their values when they
+    exit, and the exposition merges the files of exited processes into a single aggregate file.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._values = defaultdict(dict)
+        self._last_flush = 0
+        self._start_process()
+        if hasattr(os, 'register_at_fork'):
+            ref = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: ref() and ref()._start_process())
+        atexit.register(lambda ref=weakref.ref(self): ref() and ref().flush())
+
+    def _start_process(self):
+        self._lock = threading.Lock()
+        self._values.clear()
+        self._last_flush = 0
+        self._pid = os.getpid()
+        self._filename = 'metrics-%s-%s.json' % (self._pid, uuid.uuid4().hex)
+
+    def _check_pid(self):
+        # Catches forks on Pythons without os.register_at_fork
+        if self._pid != os.getpid():
+            self._start_process()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def update(self, name, labels, fn):
+        self._check_pid()
+        with self._lock:
+            values = self._values[name]
+            values[labels] = fn(values.get(labels))
+        self.maybe_flush()
+
+    def snapshot(self):
+        self._check_pid()
+        with self._lock:
+            return {name: dict(values) for name, values in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def _path(self):
+        self._check_pid()
+        return os.path.join(settings.METRICS_DIR, self._filename)
+
+    def maybe_flush(self):
+        if settings.METRICS_DIR and time.monotonic() - self._last_flush >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if not settings.METRICS_DIR:
+            return
+        self._last_flush = time.monotonic()
+        snapshot = self.snapshot()
+        if not snapshot:
+            return
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        _write_snapshot(self._path(), snapshot)
+
+    def collect(self):
+        """
+        Return the summed values of every process, as {name: {labels: value}}.
+        """
+        merged = _merge(defaultdict(dict), self.snapshot())
+        if not settings.METRICS_DIR or not os.path.isdir(settings.METRICS_DIR):
+            return merged
+
+        # Lock out other scrapes while the files of exited processes are merged, so none are counted twice
+        with open(os.path.join(settings.METRICS_DIR, LOCK_FILENAME), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._merge_exited()
+                for filename in os.listdir(settings.METRICS_DIR):
+                    if not filename.startswith('metrics-') or not filename.endswith('.json') or filename == self._filename:
+                        continue
+                    try:
+                        _merge(merged, _read_snapshot(os.path.join(settings.METRICS_DIR, filename)))
+                    except (OSError, ValueError):
+                        continue
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return merged
+
+    def _merge_exited(self):
+        """
+        Merge the files of exited processes into the aggregate file, and delete them.
+        """
+        exited = []
+        for filename in os.listdir(settings.METRICS_DIR):
+            parts = filename[:-len('.json')].split('-') if filename.endswith('.json') else []
+            if len(parts) == 3 and parts[0] == 'metrics' and parts[1].isdigit() and not _pid_exists(int(parts[1])):
+                exited.append(os.path.join(settings.METRICS_DIR, filename))
+        if not exited:
+            return
+
+        aggregate_path = os.path.join(settings.METRICS_DIR, AGGREGATE_FILENAME)
+        aggregate = defaultdict(dict)
+        if os.path.exists(aggregate_path):
+            _merge(aggregate, _read_snapshot(aggregate_path))
+        for path in exited:
+            try:
+                _merge(aggregate, _read_snapshot(path))
+            except (OSError, ValueError):
+                pass
+        _write_snapshot(aggregate_path, aggregate)
+        for path in exited:
+            os.remove(path)
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        collected = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(collected.get(metric.name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def _labels(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self, values):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        for labels in sorted(values):
+            lines.extend(self.render_sample(labels, values[labels]))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.update(self.name, self._labels(labels), lambda value: (value or 0) + amount)
+
+    def render_sample(self, labels, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, labels), _format_value(value))]
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets. Values are stored as a list of per-bucket counts, then the sum and count.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, amount, **labels):
+        def update(value):
+            value = list(value or [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    value[i] += 1
+                    break
+            value[-2] += amount
+            value[-1] += 1
+            return value
+        self.registry.update(self.name, self._labels(labels), update)
+
+    def render_sample(self, labels, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(self.labelnames, labels, [('le', _format_value(bound))]), _format_value(cumulative)))
+        lines.append('%s_bucket%s %s' % (self.name, _format_labels(self.labelnames, labels, [('le', '+Inf')]), _format_value(value[-1])))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, labels), _format_value(value[-2])))
+        lines.append('%s_count%s %s' % (self.name, _format_labels(self.labelnames, labels), _format_value(value[-1])))
+        return lines
+
+
+REGISTRY = Registry()
+
+REQUESTS = Counter('cybersource_requests_total', 'Requests handled by the CyberSource views', ('view', 'status'))
+REQUEST_LATENCY = Histogram('cybersource_request_duration_seconds', 'Time spent handling CyberSource view requests', ('view', ))
+DECISIONS = Counter('cybersource_reply_decisions_total', 'CyberSource reply decisions', ('decision', 'reason_code'))
+SIGNATURE_FAILURES = Counter('cybersource_signature_failures_total', 'CyberSource replies rejected for a missing or bad signature', ('reason', ))
+THROTTLED = Counter('cybersource_throttled_requests_total', 'Sign requests refused by a throttle', ('scope', ))
+
+
+class MetricsMixin(object):
+    """
+    Count requests to the view and measure their latency.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            view = self.__class__.__name__
+            REQUEST_LATENCY.observe(time.perf_counter() - start, view=view)
+            REQUESTS.inc(view=view, status=status)
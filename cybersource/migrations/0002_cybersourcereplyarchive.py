@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cybersource', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CyberSourceReplyArchive',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, verbose_name='ID', auto_created=True)),
+                ('data', models.BinaryField()),
+                ('reply', models.OneToOneField(related_name='archive', to='cybersource.CyberSourceReply', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+    ]
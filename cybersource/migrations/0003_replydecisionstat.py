@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cybersource', '0002_cybersourcereplyarchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplyDecisionStat',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, verbose_name='ID', auto_created=True)),
+                ('hour', models.DateTimeField(db_index=True)),
+                ('decision', models.CharField(max_length=20, blank=True)),
+                ('reason_code', models.CharField(max_length=10, blank=True)),
+                ('avs_code', models.CharField(max_length=10, blank=True)),
+                ('card_type', models.CharField(max_length=10, blank=True)),
+                ('currency', models.CharField(max_length=12, blank=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=14, default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='replydecisionstat',
+            unique_together=set([('hour', 'decision', 'reason_code', 'avs_code', 'card_type', 'currency')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from cybersource.indexes import create_index
+
+
+class Migration(migrations.Migration):
+    # Lets the indexes be built concurrently on Django 1.10+. Ignored by older versions.
+    atomic = False
+
+    dependencies = [
+        ('cybersource', '0003_replydecisionstat'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='cybersourcereply',
+                    name='date_modified',
+                    field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Date Modified'),
+                ),
+            ],
+            database_operations=[
+                create_index('cybersource', 'CyberSourceReply', 'date_modified'),
+            ],
+        ),
+        # Replies are only ever appended, so a BRIN index on their creation date stays tiny
+        create_index('cybersource', 'CyberSourceReply', 'date_created', 'brin'),
+    ]
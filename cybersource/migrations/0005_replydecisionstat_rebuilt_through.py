@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cybersource', '0004_reply_log_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replydecisionstat',
+            name='rebuilt_through',
+            field=models.IntegerField(default=0),
+        ),
+    ]
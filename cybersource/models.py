@@ -1,22 +1,72 @@
 from django.db import models
 from django.contrib.postgres.fields import HStoreField
 from oscar.core.compat import AUTH_USER_MODEL
+import json
+import zlib
 
 
 class CyberSourceReply(models.Model):
     user = models.ForeignKey(AUTH_USER_MODEL,
         related_name='cybersource_replies', null=True, blank=True, on_delete=models.SET_NULL)
     data = HStoreField()
-    date_modified = models.DateTimeField("Date Modified", auto_now=True)
+    date_modified = models.DateTimeField("Date Modified", auto_now=True, db_index=True)
     date_created = models.DateTimeField("Date Received", auto_now_add=True)
 
     def __str__(self):
         return 'CyberSource Reply %s' % self.date_created
 
+    def get_field(self, key, default=''):
+        if key in self.data:
+            return self.data[key]
+        try:
+            return self.archive.get_data().get(key, default)
+        except CyberSourceReplyArchive.DoesNotExist:
+            return default
+
+
+class CyberSourceReplyArchive(models.Model):
+    """
+    Cold storage for the reply fields dropped from CyberSourceReply.data by the reply log field projection.
+    """
+    reply = models.OneToOneField(CyberSourceReply, related_name='archive', on_delete=models.CASCADE)
+    data = models.BinaryField()
+
+    @staticmethod
+    def compress(data):
+        return zlib.compress(json.dumps(data, sort_keys=True).encode('utf-8'))
+
+    def get_data(self):
+        return json.loads(zlib.decompress(bytes(self.data)).decode('utf-8'))
+
+    def __str__(self):
+        return 'CyberSource Reply Archive %s' % self.reply_id
+
+
+class ReplyDecisionStat(models.Model):
+    """
+    Hourly reply counts, maintained incrementally as replies are logged. See cybersource.stats.
+    """
+    hour = models.DateTimeField(db_index=True)
+    decision = models.CharField(max_length=20, blank=True)
+    reason_code = models.CharField(max_length=10, blank=True)
+    avs_code = models.CharField(max_length=10, blank=True)
+    card_type = models.CharField(max_length=10, blank=True)
+    currency = models.CharField(max_length=12, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(decimal_places=2, max_digits=14, default=0)
+    # ID of the last reply counted by the rebuild which wrote the row. Replies up to it aren't counted again.
+    rebuilt_through = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('hour', 'decision', 'reason_code', 'avs_code', 'card_type', 'currency')
+
+    def __str__(self):
+        return '%s %s/%s: %s' % (self.hour, self.decision, self.reason_code, self.count)
+
 
 class ReplyLogMixin(object):
     def log_field(self, key, default = ''):
-        return self.log.data.get(key, default)
+        return self.log.get_field(key, default)
 
 
 class PaymentToken(ReplyLogMixin, models.Model):
@@ -82,8 +132,10 @@ class TransactionMixin(ReplyLogMixin, models.Model):
         null=True,
         blank=True,
         on_delete=models.SET_NULL)
-    request_token = models.CharField(max_length=200)
-    processed_datetime = models.DateTimeField()
+    request_token = models.CharField(max_length=200, db_index=True)
+    processed_datetime = models.DateTimeField(db_index=True)
 
     class Meta:
         abstract = True
+        # Replies are matched to transactions by reference. See cybersource.indexes.
+        index_together = [('reference', )]
@@ -0,0 +1,219 @@
+"""
+Order placement for CyberSource replies.
+
+Oscar's ``OrderCreator`` saves every order line, line price and line attribute individually, and
+allocates stock one line at a time, so the number of queries grows with the size of the basket. Placing
+orders with ``BulkOrderCreator`` inserts each kind of row in a single statement and allocates all of the
+order's stock in one statement, so the query count stays flat however many lines the order has.
+"""
+from decimal import Decimal as D
+from django.conf import settings
+from django.db import connections, router
+from django.utils.translation import ugettext_lazy as _
+from oscar.apps.order.signals import order_placed
+from oscar.core import loading
+from .loading import get_class, get_model
+
+try:
+    from django.db.models import prefetch_related_objects
+except ImportError:
+    # Django < 1.10 takes the lookups as a list
+    from django.db.models.query import prefetch_related_objects as _prefetch_related_objects
+
+    def prefetch_related_objects(objs, *lookups):
+        _prefetch_related_objects(objs, lookups)
+
+# Subclassed below, so it can't be loaded lazily
+OrderCreator = loading.get_class('order.utils', 'OrderCreator')
+
+OrderNumberGenerator = get_class('order.utils', 'OrderNumberGenerator')
+UnableToPlaceOrder = get_class('order.exceptions', 'UnableToPlaceOrder')
+
+Line = get_model('order', 'Line')
+LineAttribute = get_model('order', 'LineAttribute')
+LinePrice = get_model('order', 'LinePrice')
+Order = get_model('order', 'Order')
+StockAlert = get_model('partner', 'StockAlert')
+StockRecord = get_model('partner', 'StockRecord')
+
+# Everything read from a basket line while building its order line
+BASKET_LINE_LOOKUPS = (
+    'stockrecord__partner',
+    'product__product_class',
+    'product__parent__product_class',
+    'attributes__option',
+)
+
+
+class BulkOrderCreator(OrderCreator):
+    """
+    Order creator which writes the order's lines in bulk. ``place_order`` follows Oscar's, except that the
+    per-line loop is replaced by ``create_lines``.
+    """
+    def place_order(self, basket, total, shipping_method, shipping_charge, user=None,
+                    shipping_address=None, billing_address=None, order_number=None, status=None, **kwargs):
+        if basket.is_empty:
+            raise ValueError(_("Empty baskets cannot be submitted"))
+        if not order_number:
+            order_number = OrderNumberGenerator().order_number(basket)
+        if not status and hasattr(settings, 'OSCAR_INITIAL_ORDER_STATUS'):
+            status = getattr(settings, 'OSCAR_INITIAL_ORDER_STATUS')
+        if Order._default_manager.filter(number=order_number).exists():
+            raise ValueError(_("There is already an order with number %s") % order_number)
+
+        order = self.create_order_model(
+            user, basket, shipping_address, shipping_method, shipping_charge,
+            billing_address, total, order_number, status, **kwargs)
+        self.create_lines(order, basket)
+
+        # Record any discounts associated with this order
+        for application in basket.offer_applications:
+            application['message'] = application['offer'].apply_deferred_benefit(basket, order, application)
+            if application['result'].affects_shipping:
+                # Skip zero shipping discounts
+                shipping_discount = shipping_method.discount(basket)
+                if shipping_discount <= D('0.00'):
+                    continue
+                application['discount'] = shipping_discount
+            self.create_discount_model(order, application)
+            self.record_discount(application)
+
+        for voucher in basket.vouchers.all():
+            self.record_voucher_usage(order, voucher, user)
+
+        order_placed.send(sender=self, order=order, user=user)
+        return order
+
+
+    def create_lines(self, order, basket):
+        """
+        Create the order's lines, line prices and line attributes, and allocate their stock.
+        """
+        basket_lines = list(basket.all_lines())
+        prefetch_related_objects(basket_lines, *BASKET_LINE_LOOKUPS)
+
+        order_lines = [self.build_line_model(order, basket_line) for basket_line in basket_lines]
+        order_lines = Line._default_manager.bulk_create(order_lines)
+        if any(order_line.pk is None for order_line in order_lines):
+            # Django < 1.10 doesn't set the primary keys of bulk created rows. The lines were all inserted
+            # by the same statement, so their ids were assigned in order.
+            ids = Line._default_manager.filter(order=order).order_by('pk').values_list('pk', flat=True)
+            for order_line, pk in zip(order_lines, ids):
+                order_line.pk = pk
+
+        prices = []
+        attributes = []
+        for order_line, basket_line in zip(order_lines, basket_lines):
+            prices.extend(self.build_line_price_models(order, order_line, basket_line))
+            attributes.extend(self.build_line_attribute_models(order, order_line, basket_line))
+            self.create_additional_line_models(order, order_line, basket_line)
+        LinePrice._default_manager.bulk_create(prices)
+        if attributes:
+            LineAttribute._default_manager.bulk_create(attributes)
+
+        self.allocate_stock(basket_lines)
+        return order_lines
+
+
+    def build_line_model(self, order, basket_line, extra_line_fields=None):
+        """
+        Build an unsaved order line, with the same data as ``OrderCreator.create_line_models``.
+        """
+        product = basket_line.product
+        stockrecord = basket_line.stockrecord
+        if not stockrecord:
+            raise UnableToPlaceOrder("Basket line #%d has no stockrecord" % basket_line.id)
+        partner = stockrecord.partner
+        line_data = {
+            'order': order,
+            'partner': partner,
+            'partner_name': partner.name,
+            'partner_sku': stockrecord.partner_sku,
+            'stockrecord': stockrecord,
+            'product': product,
+            'title': product.get_title(),
+            'upc': product.upc,
+            'quantity': basket_line.quantity,
+            'line_price_excl_tax': basket_line.line_price_excl_tax_incl_discounts,
+            'line_price_incl_tax': basket_line.line_price_incl_tax_incl_discounts,
+            'line_price_before_discounts_excl_tax': basket_line.line_price_excl_tax,
+            'line_price_before_discounts_incl_tax': basket_line.line_price_incl_tax,
+            'unit_cost_price': stockrecord.cost_price,
+            'unit_price_incl_tax': basket_line.unit_price_incl_tax,
+            'unit_price_excl_tax': basket_line.unit_price_excl_tax,
+            'unit_retail_price': stockrecord.price_retail,
+            'est_dispatch_date': basket_line.purchase_info.availability.dispatch_date,
+        }
+        extra_line_fields = extra_line_fields or {}
+        if hasattr(settings, 'OSCAR_INITIAL_LINE_STATUS') and 'status' not in extra_line_fields:
+            extra_line_fields['status'] = getattr(settings, 'OSCAR_INITIAL_LINE_STATUS')
+        line_data.update(extra_line_fields)
+        return Line(**line_data)
+
+
+    def build_line_price_models(self, order, order_line, basket_line):
+        return [
+            LinePrice(order=order, line=order_line, quantity=quantity,
+                      price_incl_tax=price_incl_tax, price_excl_tax=price_excl_tax)
+            for price_incl_tax, price_excl_tax, quantity in basket_line.get_price_breakdown()
+        ]
+
+
+    def build_line_attribute_models(self, order, order_line, basket_line):
+        return [
+            LineAttribute(line=order_line, option=attr.option, type=attr.option.code, value=attr.value)
+            for attr in basket_line.attributes.all()
+        ]
+
+
+    def allocate_stock(self, basket_lines):
+        """
+        Allocate stock for every line of the order in a single statement, and open any low stock alerts
+        the allocation causes.
+
+        The stock records are locked in id order before they're updated. Every order takes its locks in the
+        same order, so concurrent orders for the same products wait for each other instead of deadlocking.
+        """
+        quantities = {}
+        for basket_line in basket_lines:
+            if basket_line.product.get_product_class().track_stock:
+                quantities[basket_line.stockrecord_id] = quantities.get(basket_line.stockrecord_id, 0) + basket_line.quantity
+                stockrecord = basket_line.stockrecord
+                stockrecord.num_allocated = (stockrecord.num_allocated or 0) + basket_line.quantity
+        if not quantities:
+            return
+
+        allocations = sorted(quantities.items())
+        sql = """
+            WITH locked AS (
+                SELECT id FROM {table} WHERE id IN ({ids}) ORDER BY id FOR UPDATE
+            )
+            UPDATE {table} s
+            SET num_allocated = COALESCE(s.num_allocated, 0) + a.quantity
+            FROM locked JOIN (VALUES {values}) AS a (id, quantity) ON a.id = locked.id
+            WHERE s.id = locked.id
+        """.format(
+            table=StockRecord._meta.db_table,
+            ids=', '.join(['%s'] * len(allocations)),
+            values=', '.join(['(%s, %s)'] * len(allocations)))
+        params = [pk for pk, quantity in allocations]
+        for allocation in allocations:
+            params.extend(allocation)
+        with connections[router.db_for_write(StockRecord)].cursor() as cursor:
+            cursor.execute(sql, params)
+        self.update_stock_alerts([pk for pk, quantity in allocations])
+
+
+    def update_stock_alerts(self, stockrecord_ids):
+        # Allocating stock can only lower the net stock level, so alerts are only ever opened here
+        records = StockRecord._default_manager.filter(pk__in=stockrecord_ids, low_stock_threshold__isnull=False)
+        below = [record for record in records if record.is_below_threshold]
+        if not below:
+            return
+        alerted = set(StockAlert._default_manager
+            .filter(stockrecord__in=below, status=StockAlert.OPEN)
+            .values_list('stockrecord_id', flat=True))
+        StockAlert._default_manager.bulk_create([
+            StockAlert(stockrecord=record, threshold=record.low_stock_threshold)
+            for record in below if record.pk not in alerted
+        ])
@@ -0,0 +1,61 @@
+from datetime import datetime
+from . import settings
+import cProfile
+import logging
+import os
+import random
+
+logger = logging.getLogger(__name__)
+
+
+def should_profile(request):
+    if not settings.PROFILE_DIR:
+        return False
+    if request.META.get(settings.PROFILE_HEADER):
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_staff)
+    return random.random() < settings.PROFILE_SAMPLE_RATE
+
+
+def get_view_dir(view_name):
+    return os.path.join(settings.PROFILE_DIR, view_name)
+
+
+def dump_stats(profiler, view_name):
+    """
+    Write the profiler's stats to the view's profile directory, removing the oldest dumps beyond PROFILE_MAX_FILES.
+    """
+    view_dir = get_view_dir(view_name)
+    os.makedirs(view_dir, exist_ok=True)
+    filename = '%s-%s.prof' % (datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), os.getpid())
+    path = os.path.join(view_dir, filename)
+    profiler.dump_stats(path)
+
+    dumps = sorted(name for name in os.listdir(view_dir) if name.endswith('.prof'))
+    for name in dumps[:-settings.PROFILE_MAX_FILES]:
+        try:
+            os.remove(os.path.join(view_dir, name))
+        except OSError:
+            pass
+    return path
+
+
+class ProfilingMixin(object):
+    """
+    Profile a sample of requests to the view (or requests from staff users carrying the profile header)
+    with cProfile, dumping the stats to PROFILE_DIR.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not should_profile(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            profiler.disable()
+            try:
+                dump_stats(profiler, self.__class__.__name__)
+            except OSError:
+                logger.exception('Could not write profile for %s', self.__class__.__name__)
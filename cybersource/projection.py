@@ -0,0 +1,43 @@
+from fnmatch import fnmatchcase
+from . import settings
+
+
+class FieldProjection(object):
+    """
+    Decide which reply fields get stored in the hot reply log. Field names are matched against
+    glob patterns: a field is kept when it matches an include pattern and doesn't match any
+    exclude pattern.
+    """
+
+    def __init__(self, include=('*', ), exclude=()):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self._decisions = {}
+
+    def keeps(self, name):
+        if name not in self._decisions:
+            included = any(fnmatchcase(name, pattern) for pattern in self.include)
+            excluded = any(fnmatchcase(name, pattern) for pattern in self.exclude)
+            self._decisions[name] = included and not excluded
+        return self._decisions[name]
+
+    def split(self, data):
+        kept, dropped = {}, {}
+        for key, value in data.items():
+            if self.keeps(key):
+                kept[key] = value
+            else:
+                dropped[key] = value
+        return kept, dropped
+
+
+_projection = None
+
+
+def get_projection():
+    global _projection
+    include = tuple(settings.REPLY_LOG_FIELDS_INCLUDE)
+    exclude = tuple(settings.REPLY_LOG_FIELDS_EXCLUDE)
+    if _projection is None or _projection.include != include or _projection.exclude != exclude:
+        _projection = FieldProjection(include, exclude)
+    return _projection
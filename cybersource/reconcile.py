@@ -0,0 +1,266 @@
+"""
+Reconcile CyberSource transaction detail reports against our payment transactions.
+
+Reports are parsed as a stream and bulk loaded into a temporary table with COPY, in batches, so memory use
+doesn't depend on the size of the report. Mismatches are then found with an indexed join in the database,
+and streamed back out through a server-side cursor.
+"""
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from django.db import connections, transaction
+from xml.etree import ElementTree
+from . import actions, export
+from .loading import get_model
+from .models import CyberSourceReply
+import csv
+import io
+import re
+import uuid
+
+Order = get_model('order', 'Order')
+Source = get_model('payment', 'Source')
+Transaction = get_model('payment', 'Transaction')
+
+
+ReportRow = namedtuple('ReportRow', ('reference', 'order_number', 'amount', 'currency', 'status'))
+
+MISMATCH_FIELDS = ('mismatch', 'reference', 'order_number', 'report_amount', 'amount', 'report_status', 'status')
+Mismatch = namedtuple('Mismatch', MISMATCH_FIELDS)
+
+MISSING = 'missing'
+AMOUNT = 'amount'
+STATUS = 'status'
+UNREPORTED = 'unreported'
+
+# Report columns, by their normalized (lower case, alphanumeric only) header name
+CSV_COLUMNS = {
+    'reference': ('requestid', 'transactionrequestid', 'transactionid'),
+    'order_number': ('merchantreferencenumber', 'merchantrefnumber', 'referencenumber'),
+    'amount': ('amount', 'grandtotalamount', 'authamount'),
+    'currency': ('currency', 'currencycode'),
+    'status': ('decision', 'status'),
+}
+
+# Our transaction statuses which are equivalent to a report's decision
+STATUS_EQUIVALENTS = {
+    'PENDING': 'ACCEPT',
+    'TRANSMITTED': 'ACCEPT',
+}
+
+
+def _normalize(name):
+    return re.sub('[^a-z0-9]', '', name.lower())
+
+
+def _amount(value):
+    try:
+        return Decimal(value.replace(',', ''))
+    except (InvalidOperation, AttributeError):
+        return None
+
+
+def _map_columns(header):
+    normalized = [_normalize(name) for name in header]
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        columns[field] = next((normalized.index(name) for name in names if name in normalized), None)
+    return columns
+
+
+def iter_csv_report(f):
+    """
+    Yield the rows of a CSV transaction detail report. Any title lines before the column header are skipped.
+    """
+    columns = None
+    for row in csv.reader(f):
+        if columns is None:
+            mapped = _map_columns(row)
+            if mapped['reference'] is not None:
+                columns = mapped
+            continue
+
+        values = {}
+        for field, index in columns.items():
+            values[field] = row[index].strip() if index is not None and index < len(row) else ''
+        if not values['reference']:
+            continue
+        values['amount'] = _amount(values['amount'])
+        values['status'] = values['status'].upper()
+        yield ReportRow(**values)
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _find_text(elem, name):
+    for child in elem.iter():
+        if _local_name(child.tag) == name and child.text:
+            return child.text.strip()
+    return ''
+
+
+def _status_from_rflag(rflag):
+    if rflag == 'SOK':
+        return 'ACCEPT'
+    if rflag == 'DREVIEW':
+        return 'REVIEW'
+    if rflag.startswith('D'):
+        return 'DECLINE'
+    return 'ERROR' if rflag else ''
+
+
+def iter_xml_report(f):
+    """
+    Yield the rows of an XML transaction detail report. Each ``Request`` element is discarded as soon as
+    it's been read, so the document is never held in memory.
+    """
+    parents = []
+    for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if _local_name(elem.tag) != 'Request':
+            continue
+
+        reference = elem.get('RequestID', '')
+        if reference:
+            yield ReportRow(
+                reference=reference,
+                order_number=elem.get('MerchantReferenceNumber', ''),
+                amount=_amount(_find_text(elem, 'Amount')),
+                currency=_find_text(elem, 'CurrencyCode'),
+                status=(_find_text(elem, 'Decision') or _status_from_rflag(_find_text(elem, 'RFlag'))).upper())
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+PARSERS = {
+    'csv': iter_csv_report,
+    'xml': iter_xml_report,
+}
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy_rows(cursor, table, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+    buf.seek(0)
+    cursor.copy_expert('COPY %s (reference, order_number, amount, currency, status) FROM STDIN WITH CSV' % table, buf)
+
+
+def load_report(cursor, rows, table, batch_size=10000):
+    """
+    Load report rows into a new temporary table, ``batch_size`` rows at a time, and index it.
+    """
+    cursor.execute("""
+        CREATE TEMPORARY TABLE %s (
+            reference varchar(128) NOT NULL,
+            order_number varchar(128),
+            amount numeric(12, 2),
+            currency varchar(12),
+            status varchar(128)
+        ) ON COMMIT DROP
+    """ % table)
+    count = 0
+    for batch in _batches(rows, batch_size):
+        _copy_rows(cursor, table, batch)
+        count += len(batch)
+    cursor.execute('CREATE INDEX %s_reference ON %s (reference)' % (table, table))
+    cursor.execute('ANALYZE %s' % table)
+    return count
+
+
+def load_reversals(cursor, table):
+    """
+    Load the references of the logged authorization reversals into a new temporary table, along with the
+    authorizations they reversed. Neither has a transaction of ours, since the order was never placed.
+    """
+    cursor.execute("""
+        CREATE TEMPORARY TABLE {table}_reversals ON COMMIT DROP AS
+        SELECT data -> 'transaction_id' AS reference
+        FROM {reply}
+        WHERE data -> 'req_transaction_type' = %s
+        UNION
+        SELECT data -> 'req_authorization_id'
+        FROM {reply}
+        WHERE data -> 'req_transaction_type' = %s AND data -> 'decision' = 'ACCEPT'
+    """.format(table=table, reply=CyberSourceReply._meta.db_table), [actions.ReverseAuthorization.transaction_type] * 2)
+    cursor.execute('CREATE INDEX {table}_reversals_reference ON {table}_reversals (reference)'.format(table=table))
+    cursor.execute('ANALYZE {table}_reversals'.format(table=table))
+
+
+def _our_status_sql():
+    cases = ' '.join("WHEN '%s' THEN '%s'" % item for item in sorted(STATUS_EQUIVALENTS.items()))
+    return 'CASE t.status %s ELSE t.status END' % cases
+
+
+def get_mismatch_sql(table, start=None, end=None):
+    txn = Transaction._meta.db_table
+    our_status = _our_status_sql()
+    sql = """
+        SELECT '{missing}', r.reference, r.order_number, r.amount, NULL, r.status, NULL
+        FROM {table} r
+        WHERE NOT EXISTS (SELECT 1 FROM {txn} t WHERE t.reference = r.reference)
+          AND NOT EXISTS (SELECT 1 FROM {table}_reversals v WHERE v.reference = r.reference)
+        UNION ALL
+        SELECT '{amount}', r.reference, r.order_number, r.amount, t.amount, r.status, t.status
+        FROM {table} r JOIN {txn} t ON t.reference = r.reference
+        WHERE r.amount IS NOT NULL AND r.amount <> t.amount
+        UNION ALL
+        SELECT '{status}', r.reference, r.order_number, r.amount, t.amount, r.status, t.status
+        FROM {table} r JOIN {txn} t ON t.reference = r.reference
+        WHERE r.status IS NOT NULL AND r.status <> {our_status}
+    """.format(missing=MISSING, amount=AMOUNT, status=STATUS, table=table, txn=txn, our_status=our_status)
+    params = []
+
+    # Our transactions in the reported period which aren't in the report. Those without a reference are
+    # captures which never got one from CyberSource, so there's nothing in the report to match them to.
+    if start or end:
+        sql += """
+            UNION ALL
+            SELECT '{unreported}', t.reference, o.number, NULL, t.amount, NULL, t.status
+            FROM {txn} t
+            JOIN {source} s ON s.id = t.source_id
+            JOIN {order} o ON o.id = s.order_id
+            WHERE t.reference <> ''
+              AND NOT EXISTS (SELECT 1 FROM {table} r WHERE r.reference = t.reference)
+        """.format(unreported=UNREPORTED, table=table, txn=txn,
+                   source=Source._meta.db_table, order=Order._meta.db_table)
+        if start:
+            sql += ' AND t.date_created >= %s'
+            params.append(start)
+        if end:
+            sql += ' AND t.date_created < %s'
+            params.append(end)
+    return sql, params
+
+
+def reconcile(rows, start=None, end=None, batch_size=10000, using='default'):
+    """
+    Yield a Mismatch for every report row which we don't have a transaction or logged reversal for, or whose
+    amount or status differs from ours. If ``start`` or ``end`` are given, also yield our transactions
+    created in that period which aren't in the report.
+    """
+    table = 'cybersource_reconcile_%s' % uuid.uuid4().hex[:12]
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            load_report(cursor, rows, table, batch_size)
+            load_reversals(cursor, table)
+        sql, params = get_mismatch_sql(table, start, end)
+        for row in export.iter_sql(sql, params, using=using, batch_size=batch_size):
+            yield Mismatch(*row)
@@ -0,0 +1,235 @@
+"""
+Backends for the CyberSource reply log.
+
+Accepted replies are referenced by the payment token and transaction created from them, so every backend
+stores those in CyberSourceReply straight away. Replies which nothing references (declines, errors,
+reviews) can be deferred or kept out of the database entirely, so the reply hot path only writes what it
+must. The backend is chosen with ``CYBERSOURCE_REPLY_LOG_BACKEND``.
+"""
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from . import projection, settings
+from .models import CyberSourceReply, CyberSourceReplyArchive
+import atexit
+import json
+import os
+import threading
+import time
+
+
+def build_reply(data, user=None):
+    """
+    Build an unsaved reply log entry holding the projected fields, and return it along with the fields
+    the projection dropped.
+    """
+    kept, dropped = projection.get_projection().split(data)
+    reply = CyberSourceReply(user=user, data=kept, date_created=timezone.now())
+    return reply, dropped
+
+
+def build_archive(reply, dropped):
+    if dropped and settings.REPLY_LOG_ARCHIVE_DROPPED:
+        return CyberSourceReplyArchive(reply=reply, data=CyberSourceReplyArchive.compress(dropped))
+    return None
+
+
+class DatabaseBackend(object):
+    """
+    Save every reply to CyberSourceReply as soon as it's received.
+    """
+    def log(self, data, user=None, referenced=True):
+        reply, dropped = build_reply(data, user)
+        self.save(reply, dropped)
+        return reply
+
+    def save(self, reply, dropped):
+        reply.save()
+        archive = build_archive(reply, dropped)
+        if archive is not None:
+            archive.save()
+
+    def flush(self):
+        pass
+
+
+class BufferedDatabaseBackend(DatabaseBackend):
+    """
+    Save referenced replies straight away, and buffer the rest in memory. The buffer is written with
+    ``bulk_create`` once it holds ``REPLY_LOG_BUFFER_SIZE`` replies, by a timer thread once a reply has
+    waited ``REPLY_LOG_FLUSH_INTERVAL`` seconds, or when the process exits. Buffered replies are lost if the
+    process is killed before then.
+    """
+    def __init__(self, buffer_size=None, flush_interval=None):
+        self.buffer_size = buffer_size or settings.REPLY_LOG_BUFFER_SIZE
+        self.flush_interval = settings.REPLY_LOG_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.flush)
+
+    def log(self, data, user=None, referenced=True):
+        if referenced:
+            return super().log(data, user, referenced)
+        reply, dropped = build_reply(data, user)
+        with self._lock:
+            self._pending.append((reply, dropped))
+            is_due = len(self._pending) >= self.buffer_size or time.monotonic() - self._last_flush >= self.flush_interval
+            if not is_due and self._timer is None:
+                # Write the buffer out even if no other reply is logged in the meantime
+                self._timer = threading.Timer(self.flush_interval, self._scheduled_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if is_due:
+            self.flush()
+        return reply
+
+    def _scheduled_flush(self):
+        try:
+            self.flush()
+        finally:
+            # The timer's thread has database connections of its own
+            for conn in connections.all():
+                conn.close()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        if not pending:
+            return
+
+        # Take the primary keys from the sequence up front, so that the archives can refer to the replies.
+        # Django < 1.10 doesn't set the primary keys of bulk created rows.
+        using = router.db_for_write(CyberSourceReply)
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [CyberSourceReply._meta.db_table, len(pending)])
+            ids = [row[0] for row in cursor.fetchall()]
+
+        replies = []
+        archives = []
+        for pk, (reply, dropped) in zip(ids, pending):
+            reply.pk = pk
+            replies.append(reply)
+            archive = build_archive(reply, dropped)
+            if archive is not None:
+                archives.append(archive)
+        with transaction.atomic(using=using):
+            CyberSourceReply.objects.using(using).bulk_create(replies)
+            if archives:
+                CyberSourceReplyArchive.objects.using(using).bulk_create(archives)
+
+
+class FileBackend(DatabaseBackend):
+    """
+    Append every reply to ``REPLY_LOG_FILE`` as a JSON line. Only referenced replies are also saved to the
+    database. Lines hold the fields kept by the reply log projection, and the dropped ones under
+    ``archived`` when ``REPLY_LOG_ARCHIVE_DROPPED`` is set.
+
+    Writes are fsync'd in batches, every ``REPLY_LOG_FSYNC_EVERY`` replies or ``REPLY_LOG_FSYNC_INTERVAL``
+    seconds. The file is rotated once it grows past ``REPLY_LOG_FILE_MAX_BYTES``, keeping
+    ``REPLY_LOG_FILE_BACKUP_COUNT`` old files. Other processes writing to the same file notice the
+    rotation and reopen it.
+    """
+    def __init__(self, path=None, max_bytes=None, backup_count=None, fsync_every=None, fsync_interval=None):
+        self.path = path or settings.REPLY_LOG_FILE
+        self.max_bytes = settings.REPLY_LOG_FILE_MAX_BYTES if max_bytes is None else max_bytes
+        self.backup_count = settings.REPLY_LOG_FILE_BACKUP_COUNT if backup_count is None else backup_count
+        self.fsync_every = fsync_every or settings.REPLY_LOG_FSYNC_EVERY
+        self.fsync_interval = settings.REPLY_LOG_FSYNC_INTERVAL if fsync_interval is None else fsync_interval
+        self._fd = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def log(self, data, user=None, referenced=True):
+        reply, dropped = build_reply(data, user)
+        if referenced:
+            self.save(reply, dropped)
+        record = {
+            'date_created': reply.date_created.isoformat(),
+            'reply_id': reply.pk,
+            'user_id': user.pk if user is not None else None,
+            'data': reply.data,
+        }
+        if dropped and settings.REPLY_LOG_ARCHIVE_DROPPED:
+            record['archived'] = dropped
+        self.write(record)
+        return reply
+
+    def write(self, record):
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            fd = self._open()
+            os.write(fd, line)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+            if self.max_bytes and os.fstat(fd).st_size >= self.max_bytes:
+                self._sync()
+                self._rotate()
+
+    def flush(self):
+        with self._lock:
+            if self._fd is not None and self._unsynced:
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._sync()
+                os.close(self._fd)
+                self._fd = None
+
+    def _open(self):
+        # Reopen the file if it's been rotated, by this or another process
+        if self._fd is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._fd).st_ino:
+                    return self._fd
+            except FileNotFoundError:
+                pass
+            self._sync()
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        return self._fd
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._fd)
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _rotate(self):
+        os.close(self._fd)
+        self._fd = None
+        if self.backup_count <= 0:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.replace(source, '%s.%d' % (self.path, i + 1))
+        if os.path.exists(self.path):
+            os.replace(self.path, '%s.1' % self.path)
+
+
+_backend = (None, None)
+
+
+def get_backend():
+    global _backend
+    path, backend = _backend
+    if path != settings.REPLY_LOG_BACKEND:
+        if backend is not None:
+            backend.flush()
+        backend = import_string(settings.REPLY_LOG_BACKEND)()
+        _backend = (settings.REPLY_LOG_BACKEND, backend)
+    return backend
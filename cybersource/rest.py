@@ -0,0 +1,114 @@
+"""
+Client for the CyberSource REST API, used for the server-side transactions which Secure Acceptance doesn't
+cover (captures and token authorizations).
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.http import http_date
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from . import settings
+import base64
+import hashlib
+import hmac
+import json
+import requests
+import threading
+
+
+def flatten(data, prefix=''):
+    """
+    Flatten a nested JSON response into string values, so that it can be stored in CyberSourceReply.data.
+    """
+    flat = {}
+    for key, value in data.items():
+        key = '%s%s' % (prefix, key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, '%s_' % key))
+        elif isinstance(value, list):
+            flat[key] = json.dumps(value)
+        else:
+            flat[key] = '' if value is None else str(value)
+    return flat
+
+
+class RESTClient(object):
+    """
+    Send requests to the CyberSource REST API, authenticated with an HTTP signature.
+
+    A single ``requests.Session`` is shared by every thread using the client. Its connection pool keeps up
+    to ``pool_size`` keep-alive connections open, so consecutive requests reuse the same TLS connections.
+    """
+    def __init__(self, endpoint=None, merchant_id=None, key_id=None, shared_secret=None, pool_size=None, timeout=None):
+        self.endpoint = (endpoint or settings.REST_ENDPOINT).rstrip('/')
+        self.merchant_id = merchant_id or settings.MERCHANT_ID
+        self.key_id = key_id or settings.REST_KEY_ID
+        self.shared_secret = shared_secret or settings.REST_SHARED_SECRET
+        self.pool_size = pool_size or settings.REST_POOL_SIZE
+        self.timeout = timeout or settings.REST_TIMEOUT
+        if not self.key_id or not self.shared_secret:
+            raise ImproperlyConfigured('CYBERSOURCE_REST_KEY_ID and CYBERSOURCE_REST_SHARED_SECRET must be defined in Django settings')
+
+        self.host = urlsplit(self.endpoint).netloc
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def get_headers(self, method, path, body):
+        digest = 'SHA-256=%s' % base64.b64encode(hashlib.sha256(body).digest()).decode()
+        headers = [
+            ('host', self.host),
+            ('date', http_date()),
+            ('(request-target)', '%s %s' % (method.lower(), path)),
+            ('digest', digest),
+            ('v-c-merchant-id', self.merchant_id),
+        ]
+        message = '\n'.join('%s: %s' % header for header in headers).encode('utf-8')
+        key = base64.b64decode(self.shared_secret)
+        sig = base64.b64encode(hmac.new(key, message, hashlib.sha256).digest()).decode()
+        return {
+            'Content-Type': 'application/json',
+            'Date': headers[1][1],
+            'Digest': digest,
+            'v-c-merchant-id': self.merchant_id,
+            'Signature': 'keyid="%s", algorithm="HmacSHA256", headers="%s", signature="%s"' % (
+                self.key_id, ' '.join(name for name, value in headers), sig),
+        }
+
+    def post(self, path, body, timeout=None):
+        """
+        POST a JSON body and return the response's status code and decoded JSON body. Network errors are
+        raised as ``requests.RequestException``.
+        """
+        payload = json.dumps(body, sort_keys=True).encode('utf-8')
+        resp = self.session.post(self.endpoint + path, data=payload, timeout=timeout or self.timeout,
+                                 headers=self.get_headers('POST', path, payload))
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {'status': 'ERROR', 'message': resp.text[:500]}
+        return resp.status_code, data
+
+
+_client = (None, None)
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the process-wide client, so that web requests share one connection pool. It's rebuilt if the
+    REST settings change.
+    """
+    global _client
+    config = (settings.REST_ENDPOINT, settings.MERCHANT_ID, settings.REST_KEY_ID, settings.REST_SHARED_SECRET)
+    with _client_lock:
+        current_config, client = _client
+        if current_config != config:
+            if client is not None:
+                client.close()
+            client = RESTClient()
+            _client = (config, client)
+        return client
@@ -0,0 +1,121 @@
+"""
+Send read-only reporting queries to a database replica.
+
+Set ``CYBERSOURCE_READ_REPLICA`` to the alias of a replica in ``DATABASES``. The admin listings, exports and
+statistics in this package then read from it, using ``replica``. Add ``ReplicaRouter`` to
+``DATABASE_ROUTERS`` to also send reads of the models matching ``CYBERSOURCE_READ_REPLICA_MODELS``, such as a
+"saved cards" page listing payment tokens, to the replica.
+
+Checkout requests are pinned to the primary, since they read what they've just written. After an order is
+placed the customer's session stays pinned for ``CYBERSOURCE_READ_YOUR_WRITES_WINDOW`` seconds, so that the
+thank-you page can't miss the order because of replication lag. That needs ``ReadYourWritesMiddleware``.
+"""
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from django.db import DEFAULT_DB_ALIAS, router
+from . import settings
+from .constants import CHECKOUT_PRIMARY_UNTIL
+import threading
+import time
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+_local = threading.local()
+
+
+def is_pinned():
+    return getattr(_local, 'pinned', 0) > 0
+
+
+@contextmanager
+def pin_to_primary():
+    """
+    Make the reads in this block, in this thread, go to the primary.
+    """
+    _local.pinned = getattr(_local, 'pinned', 0) + 1
+    try:
+        yield
+    finally:
+        _local.pinned -= 1
+
+
+def get_read_alias(model):
+    if not settings.READ_REPLICA or is_pinned():
+        return router.db_for_write(model)
+    return settings.READ_REPLICA
+
+
+def replica(queryset):
+    """
+    Run a read-only queryset on the replica, unless no replica is configured or the thread is pinned.
+    """
+    return queryset.using(get_read_alias(queryset.model))
+
+
+def primary(queryset):
+    """
+    Run a queryset on the primary, for reads which must see the latest writes.
+    """
+    return queryset.using(router.db_for_write(queryset.model))
+
+
+def pin_session(request):
+    """
+    Pin the session's requests to the primary for the next ``CYBERSOURCE_READ_YOUR_WRITES_WINDOW`` seconds.
+    """
+    request.session[CHECKOUT_PRIMARY_UNTIL] = time.time() + settings.READ_YOUR_WRITES_WINDOW
+
+
+def is_replica_model(model):
+    opts = model._meta
+    label = '%s.%s' % (opts.app_label, opts.object_name)
+    return any(fnmatchcase(label, pattern) for pattern in settings.READ_REPLICA_MODELS)
+
+
+class ReplicaRouter(object):
+    """
+    Read the models matching ``CYBERSOURCE_READ_REPLICA_MODELS`` from the replica, and write them to the
+    default database.
+    """
+    def db_for_read(self, model, **hints):
+        if settings.READ_REPLICA and not is_pinned() and is_replica_model(model):
+            return settings.READ_REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        if settings.READ_REPLICA and is_replica_model(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = (DEFAULT_DB_ALIAS, settings.READ_REPLICA)
+        if settings.READ_REPLICA and obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if settings.READ_REPLICA and db == settings.READ_REPLICA:
+            return False
+        return None
+
+
+class ReadYourWritesMiddleware(MiddlewareMixin):
+    """
+    Pin the requests of a session which has just placed an order to the primary. Must come after the
+    session middleware.
+    """
+    def process_request(self, request):
+        request._cybersource_pin = None
+        if request.session.get(CHECKOUT_PRIMARY_UNTIL, 0) > time.time():
+            request._cybersource_pin = pin_to_primary()
+            request._cybersource_pin.__enter__()
+
+    def process_response(self, request, response):
+        pin = getattr(request, '_cybersource_pin', None)
+        if pin is not None:
+            request._cybersource_pin = None
+            pin.__exit__(None, None, None)
+        return response
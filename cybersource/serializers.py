@@ -1,19 +1,118 @@
-from oscar.core.loading import get_model
-from oscarapi.serializers.checkout import CheckoutSerializer as OscarCheckoutSerializer
+from oscarapi.serializers.checkout import (
+    CheckoutSerializer as OscarCheckoutSerializer,
+    BillingAddressSerializer as OscarBillingAddressSerializer,
+    ShippingAddressSerializer as OscarShippingAddressSerializer,
+)
 from rest_framework import serializers
+from . import lookups
+from .loading import get_model
+from .orders import BulkOrderCreator
 
+Basket = get_model('basket', 'Basket')
 BillingAddress = get_model('order', 'BillingAddress')
+Country = get_model('address', 'Country')
+
+
+class ModelInstanceField(serializers.Field):
+    """
+    Accept an already loaded model instance instead of a hyperlink, skipping URL resolution and the lookup query.
+    """
+    default_error_messages = {
+        'invalid': 'Expected a %(model)s instance.',
+    }
+
+    def __init__(self, model, **kwargs):
+        self.model = model
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if not isinstance(data, self.model):
+            self.fail('invalid', model=self.model.__name__)
+        return data
+
+    def to_representation(self, value):
+        return value.pk
+
+
+class CachedCountryField(serializers.HyperlinkedRelatedField):
+    """
+    Country hyperlink field which resolves countries through the process-local lookup cache.
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('view_name', 'country-detail')
+        super().__init__(**kwargs)
+
+    def get_queryset(self):
+        return Country.objects.all()
+
+    def get_object(self, view_name, view_args, view_kwargs):
+        return lookups.get_country(view_kwargs[self.lookup_url_kwarg])
+
+
+class ShippingAddressSerializer(OscarShippingAddressSerializer):
+    country = CachedCountryField()
+
+
+class BillingAddressSerializer(OscarBillingAddressSerializer):
+    country = CachedCountryField()
 
 
 class CheckoutSerializer(OscarCheckoutSerializer):
+    order_creator_class = BulkOrderCreator
     order_number = None
+    shipping_address = ShippingAddressSerializer(many=False, required=False)
+    billing_address = BillingAddressSerializer(many=False, required=False)
 
     def create(self, validated_data):
-        if not isinstance(validated_data['billing_address'], BillingAddress):
-            validated_data['billing_address'] = BillingAddress(**validated_data['billing_address'])
+        billing_address = validated_data.get('billing_address')
+        if billing_address is not None and not isinstance(billing_address, BillingAddress):
+            validated_data['billing_address'] = BillingAddress(**billing_address)
         return super().create(validated_data)
 
+    def place_order(self, order_number, user, basket, shipping_address, shipping_method, shipping_charge,
+                    order_total, billing_address=None, **kwargs):
+        """
+        Same as OrderPlacementMixin.place_order, but writes the order lines out in bulk.
+        """
+        shipping_address = self.create_shipping_address(user, shipping_address)
+        billing_address = self.create_billing_address(billing_address, shipping_address, **kwargs)
+        if 'status' not in kwargs:
+            status = self.get_initial_order_status(basket)
+        else:
+            status = kwargs.pop('status')
+
+        order = self.order_creator_class().place_order(
+            user=user,
+            order_number=order_number,
+            basket=basket,
+            shipping_address=shipping_address,
+            shipping_method=shipping_method,
+            shipping_charge=shipping_charge,
+            total=order_total,
+            billing_address=billing_address,
+            status=status, **kwargs)
+        self.save_payment_details(order)
+        return order
+
     def generate_order_number(self, basket):
         if self.order_number:
             return self.order_number
         return super().generate_order_number(basket)
+
+
+class ReplyShippingAddressSerializer(OscarShippingAddressSerializer):
+    country = ModelInstanceField(Country)
+
+
+class ReplyBillingAddressSerializer(OscarBillingAddressSerializer):
+    country = ModelInstanceField(Country)
+
+
+class ReplyCheckoutSerializer(CheckoutSerializer):
+    """
+    Checkout serializer used when handling CyberSource replies. The basket and countries have already
+    been loaded by the reply view, so they're passed in as model instances instead of hyperlinks.
+    """
+    basket = ModelInstanceField(Basket)
+    shipping_address = ReplyShippingAddressSerializer(many=False, required=False)
+    billing_address = ReplyBillingAddressSerializer(many=False, required=False)
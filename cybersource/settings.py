@@ -1,11 +1,51 @@
+"""
+Settings are looked up, and required ones validated, the first time they're used rather than when this
+module is imported, so that commands and workers which never use them don't pay for them.
+"""
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+import sys
+import types
+
+
+class Setting(object):
+    def __init__(self, name, default=None, required=False):
+        self.name = name
+        self.default = default
+        self.required = required
+
+    def resolve(self):
+        if self.required:
+            if not hasattr(settings, self.name) or not getattr(settings, self.name):
+                raise ImproperlyConfigured("%s must be defined in Django settings" % self.name)
+        return getattr(settings, self.name, self.default)
+
+
+class SettingAttribute(object):
+    """
+    Class attribute which reads a setting each time it's used, rather than once when the class is defined.
+    """
+    def __init__(self, attr):
+        self.attr = attr
+
+    def __get__(self, instance, owner):
+        return getattr(sys.modules[__name__], self.attr)
+
+
+class SettingsModule(types.ModuleType):
+    def __getattr__(self, attr):
+        # Only called for settings which haven't been resolved yet
+        try:
+            setting = self._settings[attr]
+        except KeyError:
+            raise AttributeError("module %r has no attribute %r" % (self.__name__, attr))
+        value = setting.resolve()
+        setattr(self, attr, value)
+        return value
+
 
 def overridable(name, default=None, required=False):
-    if required:
-        if not hasattr(settings, name) or not getattr(settings, name):
-            raise ImproperlyConfigured("%s must be defined in Django settings" % name)
-    return getattr(settings, name, default)
+    return Setting(name, default, required)
 
 
 DEFAULT_CURRENCY = overridable('OSCAR_DEFAULT_CURRENCY', required=True)
@@ -31,3 +71,78 @@ FINGERPRINT_HOST = overridable('CYBERSOURCE_FINGERPRINT_HOST', 'h.online-metrix.
 
 SOURCE_TYPE = overridable('CYBERSOURCE_SOURCE_TYPE', 'CyberSource Secure Acceptance')
 CARD_REJECT_ERROR = overridable('CYBERSOURCE_CARD_REJECT_ERROR', 'Card was declined by the issuing bank. Please try a different card.')
+PAYMENT_UNKNOWN_ERROR = overridable('CYBERSOURCE_PAYMENT_UNKNOWN_ERROR', "We couldn't confirm your payment. Please wait a moment and try again.")
+
+LINE_ITEM_STRATEGY = overridable('CYBERSOURCE_LINE_ITEM_STRATEGY', 'full')
+LINE_ITEM_MAX = overridable('CYBERSOURCE_LINE_ITEM_MAX', 50)
+
+REPLY_LOG_FIELDS_INCLUDE = overridable('CYBERSOURCE_REPLY_LOG_FIELDS_INCLUDE', ['*'])
+REPLY_LOG_FIELDS_EXCLUDE = overridable('CYBERSOURCE_REPLY_LOG_FIELDS_EXCLUDE', [])
+REPLY_LOG_ARCHIVE_DROPPED = overridable('CYBERSOURCE_REPLY_LOG_ARCHIVE_DROPPED', False)
+REPLY_LOG_BACKEND = overridable('CYBERSOURCE_REPLY_LOG_BACKEND', 'cybersource.replylog.DatabaseBackend')
+REPLY_LOG_BUFFER_SIZE = overridable('CYBERSOURCE_REPLY_LOG_BUFFER_SIZE', 100)
+REPLY_LOG_FLUSH_INTERVAL = overridable('CYBERSOURCE_REPLY_LOG_FLUSH_INTERVAL', 5.0)
+REPLY_LOG_FILE = overridable('CYBERSOURCE_REPLY_LOG_FILE', 'cybersource-replies.jsonl')
+REPLY_LOG_FILE_MAX_BYTES = overridable('CYBERSOURCE_REPLY_LOG_FILE_MAX_BYTES', 100 * 1024 * 1024)
+REPLY_LOG_FILE_BACKUP_COUNT = overridable('CYBERSOURCE_REPLY_LOG_FILE_BACKUP_COUNT', 5)
+REPLY_LOG_FSYNC_EVERY = overridable('CYBERSOURCE_REPLY_LOG_FSYNC_EVERY', 50)
+REPLY_LOG_FSYNC_INTERVAL = overridable('CYBERSOURCE_REPLY_LOG_FSYNC_INTERVAL', 1.0)
+
+DECISION_STATS_ENABLED = overridable('CYBERSOURCE_DECISION_STATS_ENABLED', True)
+
+READ_REPLICA = overridable('CYBERSOURCE_READ_REPLICA', None)
+READ_REPLICA_MODELS = overridable('CYBERSOURCE_READ_REPLICA_MODELS', ['cybersource.*'])
+READ_YOUR_WRITES_WINDOW = overridable('CYBERSOURCE_READ_YOUR_WRITES_WINDOW', 60)
+
+LOOKUP_CACHE_SIZE = overridable('CYBERSOURCE_LOOKUP_CACHE_SIZE', 256)
+LOOKUP_CACHE_TTL = overridable('CYBERSOURCE_LOOKUP_CACHE_TTL', 3600)
+
+THROTTLE_CACHE = overridable('CYBERSOURCE_THROTTLE_CACHE', 'default')
+DECLINE_THROTTLE_LIMIT = overridable('CYBERSOURCE_DECLINE_THROTTLE_LIMIT', 10)
+DECLINE_THROTTLE_WINDOW = overridable('CYBERSOURCE_DECLINE_THROTTLE_WINDOW', 3600)
+SIGN_RATE_LIMITS = overridable('CYBERSOURCE_SIGN_RATE_LIMITS', {
+    'session': '10/min',
+    'ip': '60/min',
+    'global': None,
+})
+
+PROFILE_DIR = overridable('CYBERSOURCE_PROFILE_DIR', None)
+PROFILE_SAMPLE_RATE = overridable('CYBERSOURCE_PROFILE_SAMPLE_RATE', 0.0)
+PROFILE_HEADER = overridable('CYBERSOURCE_PROFILE_HEADER', 'HTTP_X_CYBERSOURCE_PROFILE')
+PROFILE_MAX_FILES = overridable('CYBERSOURCE_PROFILE_MAX_FILES', 200)
+
+TRACING_EXPORTER = overridable('CYBERSOURCE_TRACING_EXPORTER', None)
+TRACING_FILE = overridable('CYBERSOURCE_TRACING_FILE', 'cybersource-spans.jsonl')
+
+METRICS_DIR = overridable('CYBERSOURCE_METRICS_DIR', None)
+METRICS_FLUSH_INTERVAL = overridable('CYBERSOURCE_METRICS_FLUSH_INTERVAL', 1.0)
+METRICS_TOKEN = overridable('CYBERSOURCE_METRICS_TOKEN', None)
+
+REST_ENDPOINT = overridable('CYBERSOURCE_REST_ENDPOINT', 'https://apitest.cybersource.com')
+REST_KEY_ID = overridable('CYBERSOURCE_REST_KEY_ID', None)
+REST_SHARED_SECRET = overridable('CYBERSOURCE_REST_SHARED_SECRET', None)
+REST_POOL_SIZE = overridable('CYBERSOURCE_REST_POOL_SIZE', 10)
+REST_TIMEOUT = overridable('CYBERSOURCE_REST_TIMEOUT', 30)
+
+CAPTURE_CONCURRENCY = overridable('CYBERSOURCE_CAPTURE_CONCURRENCY', 8)
+CAPTURE_MAX_RETRIES = overridable('CYBERSOURCE_CAPTURE_MAX_RETRIES', 3)
+CAPTURE_RETRY_BACKOFF = overridable('CYBERSOURCE_CAPTURE_RETRY_BACKOFF', 0.5)
+
+# (connect, read) timeouts for token authorizations, which block a customer's checkout request
+TOKEN_AUTH_TIMEOUT = overridable('CYBERSOURCE_TOKEN_AUTH_TIMEOUT', (3.05, 10))
+
+
+def _make_lazy():
+    module = sys.modules[__name__]
+    lazy = SettingsModule(__name__, module.__doc__)
+    lazy._settings = {}
+    # Keep the original module, whose globals the functions above use, alive
+    lazy._module = module
+    for attr, value in vars(module).items():
+        if isinstance(value, Setting):
+            lazy._settings[attr] = value
+        else:
+            lazy.__dict__[attr] = value
+    sys.modules[__name__] = lazy
+
+_make_lazy()
@@ -6,26 +6,69 @@ import base64
 
 
 class SecureAcceptanceSigner(object):
-    secret_key = settings.SECRET
+    """
+    Sign and verify Secure Acceptance fields with a profile's secret key.
+
+    Signers are immutable, so a single instance can be shared by every thread of a worker. Use ``get_signer``
+    for the one matching ``CYBERSOURCE_SECRET``.
+    """
+    __slots__ = ('_secret_key', '_hmac')
+
+    def __init__(self, secret_key=None):
+        secret_key = settings.SECRET if secret_key is None else secret_key
+        object.__setattr__(self, '_secret_key', secret_key)
+        # Keyed once. Each signature starts from a copy, which skips hashing the key again.
+        object.__setattr__(self, '_hmac', hmac.new(secret_key.encode('utf-8'), digestmod=hashlib.sha256))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SecureAcceptanceSigner is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('SecureAcceptanceSigner is immutable')
+
+    @property
+    def secret_key(self):
+        return self._secret_key
 
     def sign(self, data, signed_fields):
-        key = self.secret_key.encode('utf-8')
         msg_raw = self._build_message(data, signed_fields).encode('utf-8')
-        msg_hmac = hmac.new(key, msg_raw, hashlib.sha256)
+        msg_hmac = self._hmac.copy()
+        msg_hmac.update(msg_raw)
         return base64.b64encode(msg_hmac.digest())
 
     def verify_request(self, request):
         # Ensure the signature is valid and that this request can be trusted
-        signed_field_names = request.POST.get('signed_field_names')
-        if not signed_field_names:
+        if not request.POST.get('signed_field_names'):
             raise SuspiciousOperation("Request has no fields to verify")
-        signed_field_names = signed_field_names.split(',')
-        signature_given = request.POST['signature'].encode('utf-8')
-        signature_calc = self.sign(request.POST, signed_field_names)
-        return (signature_given == signature_calc)
+        if not request.POST.get('signature'):
+            raise SuspiciousOperation("Request has no signature")
+        return self.verify_data(request.POST)
+
+    def verify_data(self, data):
+        signed_field_names = data.get('signed_field_names')
+        signature_given = data.get('signature')
+        if not signed_field_names or not signature_given:
+            return False
+        signature_calc = self.sign(data, signed_field_names.split(','))
+        return hmac.compare_digest(signature_given.encode('utf-8'), signature_calc)
 
     def _build_message(self, data, signed_fields):
         parts = []
         for field in signed_fields:
             parts.append( '%s=%s' % (field, data.get(field, '')) )
         return ','.join(parts)
+
+
+_signer = (None, None)
+
+
+def get_signer():
+    """
+    Return the shared signer for ``CYBERSOURCE_SECRET``, building a new one if the setting has changed.
+    """
+    global _signer
+    secret_key, signer = _signer
+    if signer is None or secret_key != settings.SECRET:
+        signer = SecureAcceptanceSigner(settings.SECRET)
+        _signer = (settings.SECRET, signer)
+    return signer
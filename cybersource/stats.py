@@ -0,0 +1,170 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import F, Max, Min, Sum
+from . import routers
+from .models import CyberSourceReply, CyberSourceReplyArchive, ReplyDecisionStat
+
+DIMENSIONS = ('decision', 'reason_code', 'avs_code', 'card_type', 'currency')
+
+REPLY_FIELDS = {
+    'decision': 'decision',
+    'reason_code': 'reason_code',
+    'avs_code': 'auth_avs_code',
+    'card_type': 'req_card_type',
+    'currency': 'req_currency',
+}
+
+
+def truncate_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _amount(data):
+    try:
+        return Decimal(data.get('auth_amount') or '0')
+    except InvalidOperation:
+        return Decimal('0')
+
+
+def _key(reply, data):
+    key = {'hour': truncate_hour(reply.date_created)}
+    for dimension in DIMENSIONS:
+        max_length = ReplyDecisionStat._meta.get_field(dimension).max_length
+        key[dimension] = (data.get(REPLY_FIELDS[dimension]) or '')[:max_length]
+    return key
+
+
+def record_reply(reply, data=None):
+    """
+    Add a freshly logged reply to the hourly decision statistics. Pass the full reply data if the
+    reply log field projection may have dropped some of the fields we count on.
+    """
+    data = reply.data if data is None else data
+    key = _key(reply, data)
+    amount = _amount(data)
+
+    stats = ReplyDecisionStat.objects.filter(**key)
+    if reply.pk is not None:
+        # A rebuild may have counted the reply while this increment waited for its lock
+        stats = stats.filter(rebuilt_through__lt=reply.pk)
+    if stats.update(count=F('count') + 1, amount=F('amount') + amount):
+        return
+    try:
+        with transaction.atomic():
+            ReplyDecisionStat.objects.create(count=1, amount=amount, **key)
+    except IntegrityError:
+        # Another process created the row in the meantime, or a rebuild has already counted the reply
+        stats.update(count=F('count') + 1, amount=F('amount') + amount)
+
+
+def _count(replies, counts, amounts):
+    """
+    Add the replies to the counts and amounts, by statistic key. Returns the ID of the last reply.
+    """
+    last_id = 0
+    for reply in replies.iterator():
+        data = dict(reply.data)
+        try:
+            data.update({k: v for k, v in reply.archive.get_data().items() if k not in data})
+        except CyberSourceReplyArchive.DoesNotExist:
+            pass
+        key = tuple(sorted(_key(reply, data).items()))
+        counts[key] += 1
+        amounts[key] += _amount(data)
+        last_id = max(last_id, reply.pk)
+    return last_id
+
+
+def _bounds(qs, field):
+    bounds = qs.order_by().aggregate(first=Min(field), last=Max(field))
+    return bounds['first'], bounds['last']
+
+
+def rebuild(start=None, end=None, batch_size=1000, chunk=timedelta(days=1)):
+    """
+    Recompute the hourly decision statistics from the reply log. Bounds are truncated to the hour, and
+    default to the first and last hours with replies or statistics.
+
+    The statistics are rebuilt ``chunk`` at a time. Each chunk's replies are counted first, then the
+    statistics table is locked only while the replies logged since are added and the chunk's rows replaced.
+    The new rows record the last reply ID at that point, so that the increments of replies already counted,
+    which were waiting for the lock, aren't added again.
+    """
+    using = router.db_for_write(ReplyDecisionStat)
+    replies = routers.primary(CyberSourceReply.objects.select_related('archive').order_by('id'))
+    stats = ReplyDecisionStat.objects.using(using)
+    if not start or not end:
+        first_reply, last_reply = _bounds(replies, 'date_created')
+        first_stat, last_stat = _bounds(stats, 'hour')
+        if not start:
+            start = min(filter(None, (first_reply, first_stat)), default=None)
+        if not end:
+            last = max(filter(None, (last_reply, last_stat)), default=None)
+            end = last + timedelta(hours=1) if last else None
+        if start is None or end is None:
+            return 0
+    start = truncate_hour(start)
+    end = truncate_hour(end)
+
+    num_rows = 0
+    while start < end:
+        chunk_end = min(start + chunk, end)
+        num_rows += _rebuild_range(
+            replies.filter(date_created__gte=start, date_created__lt=chunk_end),
+            stats.filter(hour__gte=start, hour__lt=chunk_end),
+            using, batch_size)
+        start = chunk_end
+    return num_rows
+
+
+def _rebuild_range(replies, stats, using, batch_size):
+    counts = defaultdict(int)
+    amounts = defaultdict(Decimal)
+    last_id = _count(replies, counts, amounts)
+
+    with transaction.atomic(using=using):
+        # Blocks the UPDATEs and INSERTs of record_reply, but not reads of the statistics
+        with connections[using].cursor() as cursor:
+            cursor.execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' % (
+                connections[using].ops.quote_name(ReplyDecisionStat._meta.db_table), ))
+        through = replies.order_by().aggregate(through=Max('id'))['through'] or 0
+        if through > last_id:
+            _count(replies.filter(id__gt=last_id, id__lte=through), counts, amounts)
+
+        stats.delete()
+        ReplyDecisionStat.objects.using(using).bulk_create([
+            ReplyDecisionStat(count=counts[key], amount=amounts[key], rebuilt_through=through, **dict(key))
+            for key in counts
+        ], batch_size=batch_size)
+    return len(counts)
+
+
+def summary(start=None, end=None, group_by=('decision', )):
+    """
+    Return reply counts and authorized amounts grouped by the given dimensions (plus ``hour`` if requested).
+    """
+    for dimension in group_by:
+        if dimension != 'hour' and dimension not in DIMENSIONS:
+            raise ValueError('Unknown dimension: %s' % dimension)
+    stats = routers.replica(ReplyDecisionStat.objects.all())
+    if start:
+        stats = stats.filter(hour__gte=truncate_hour(start))
+    if end:
+        stats = stats.filter(hour__lt=end)
+    return list(stats.values(*group_by)
+                     .annotate(count=Sum('count'), amount=Sum('amount'))
+                     .order_by(*group_by))
+
+
+def acceptance_rate(start=None, end=None):
+    """
+    Return the fraction of replies which were accepted, or None if there were no replies.
+    """
+    rows = summary(start, end, group_by=('decision', ))
+    total = sum(row['count'] for row in rows)
+    if not total:
+        return None
+    accepted = sum(row['count'] for row in rows if row['decision'] == 'ACCEPT')
+    return accepted / total
@@ -0,0 +1,17 @@
+"""
+Opt-in benchmarks. They're slow and only print timings, so they're skipped unless the
+``CYBERSOURCE_BENCHMARK`` environment variable is set::
+
+    $ CYBERSOURCE_BENCHMARK=1 ./test.sh
+"""
+import os
+import unittest
+
+ENABLED = bool(os.environ.get('CYBERSOURCE_BENCHMARK'))
+
+
+def benchmark(test):
+    """
+    Skip the test unless benchmarks are enabled.
+    """
+    return unittest.skipUnless(ENABLED, 'Set CYBERSOURCE_BENCHMARK=1 to run the benchmarks')(test)
@@ -1,6 +1,9 @@
 from datetime import datetime
+from decimal import Decimal
 from random import randrange
-from ..signature import SecureAcceptanceSigner
+from oscar.core.loading import get_model
+from ..models import CyberSourceReply, PaymentToken
+from ..signature import get_signer
 import uuid
 
 def build_accepted_reply_data(order_number):
@@ -143,7 +146,39 @@ def build_declined_reply_data(order_number):
 
 def sign_reply_data(data):
     fields = list(data.keys())
-    data['signature'] = SecureAcceptanceSigner().sign(data, fields).decode('utf8')
+    data['signature'] = get_signer().sign(data, fields).decode('utf8')
     data['signed_date_time'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
     data['signed_field_names'] = ','.join(fields)
     return data
+
+
+def create_transaction(order, data=None):
+    """Record an accepted authorization for the given order, the same way CyberSourceReplyView would"""
+    Source = get_model('payment', 'Source')
+    SourceType = get_model('payment', 'SourceType')
+    Transaction = get_model('payment', 'Transaction')
+
+    if data is None:
+        data = build_accepted_reply_data(order.number)
+        data['payment_token'] = str(randrange(1000000000000000000000, 9999999999999999999999))
+    log = CyberSourceReply.objects.create(data=data)
+    token = PaymentToken.objects.create(
+        log=log,
+        token=data['payment_token'],
+        masked_card_number=data['req_card_number'],
+        card_type=data['req_card_type'])
+    source_type, created = SourceType.objects.get_or_create(name='CyberSource Secure Acceptance')
+    source, created = Source.objects.get_or_create(order=order, source_type=source_type, defaults={
+        'currency': data['req_currency'],
+        'amount_allocated': Decimal(data['auth_amount']),
+    })
+    return Transaction.objects.create(
+        log=log,
+        source=source,
+        token=token,
+        txn_type=Transaction.AUTHORISE,
+        amount=Decimal(data['req_amount']),
+        reference=data['transaction_id'],
+        status=data['decision'],
+        request_token=data['request_token'],
+        processed_datetime=datetime.utcnow())
@@ -0,0 +1,56 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import threading
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status, payload = self.server.respond(self.path, self.headers, body)
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers, body))
+            self.server.connections.add(self.client_address)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the CyberSource REST API. ``responder(path, headers, body)`` returns the status code
+    and JSON body of each response.
+    """
+    daemon_threads = True
+
+    def __init__(self, responder):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.responder = responder
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    def respond(self, path, headers, body):
+        return self.responder(path, headers, json.loads(body.decode('utf-8')))
+
+    @property
+    def endpoint(self):
+        return 'http://%s:%s' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
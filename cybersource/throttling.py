@@ -0,0 +1,149 @@
+from django.core.cache import caches
+from django_statsd.clients import statsd
+from rest_framework.throttling import BaseThrottle
+from . import metrics, settings
+import time
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def get_cache():
+    return caches[settings.THROTTLE_CACHE]
+
+
+def _incr(cache, key, timeout):
+    # Atomically create the counter (if needed) and increment it
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The counter expired between add and incr
+        cache.add(key, 1, timeout)
+        return 1
+
+
+def _wait(capacity, period, now, current, previous):
+    """
+    Seconds until one more request fits in the bucket, given the requests counted in the current and
+    previous periods.
+    """
+    offset = now % period
+    if current < capacity:
+        # Wait for enough of the previous period's tokens to be refilled
+        if not previous:
+            return 0
+        return max(period * (1 - (capacity - current - 1) / previous) - offset, 0)
+    # Wait for the next period, and for enough of this period's tokens to be refilled in it
+    return period - offset + period * max(1 - (capacity - 1) / current, 0)
+
+
+def parse_rate(rate):
+    """
+    Parse a DRF style rate string, like ``10/min``, into a (number of requests, period in seconds) tuple.
+    """
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+class SignRateThrottle(BaseThrottle):
+    """
+    Token bucket limiting the rate of sign requests for a scope. The bucket holds as many tokens as the
+    rate's request count and refills over the rate's period. It's approximated using a pair of atomically
+    incremented cache counters for the current and previous periods, so no locking is needed. Refused
+    requests are taken back off the counter, so that a client retrying while it's throttled doesn't keep
+    itself throttled.
+    """
+    scope = None
+    timer = time.time
+
+    def get_ident_key(self, request):
+        raise NotImplementedError('.get_ident_key() must be overridden')
+
+    def allow_request(self, request, view):
+        self._wait = None
+        rate = settings.SIGN_RATE_LIMITS.get(self.scope)
+        if not rate:
+            return True
+        ident = self.get_ident_key(request)
+        if ident is None:
+            return True
+
+        capacity, period = parse_rate(rate)
+        now = self.timer()
+        window = int(now // period)
+        key = 'cybersource-sign-rate-%s-%s-%%s' % (self.scope, ident)
+        cache = get_cache()
+        current = _incr(cache, key % window, period * 2)
+        # Tokens spent last period which haven't been refilled yet
+        elapsed = (now % period) / period
+        previous = cache.get(key % (window - 1), 0)
+        if current + previous * (1 - elapsed) > capacity:
+            try:
+                current = cache.decr(key % window)
+            except ValueError:
+                # The counter expired in the meantime
+                current = 0
+            self._wait = _wait(capacity, period, now, current, previous)
+            statsd.incr('checkout.sign-auth-request.throttled.%s' % self.scope)
+            metrics.THROTTLED.inc(scope=self.scope)
+            return False
+        return True
+
+    def wait(self):
+        return self._wait
+
+
+class GlobalSignRateThrottle(SignRateThrottle):
+    scope = 'global'
+
+    def get_ident_key(self, request):
+        return 'all'
+
+
+class IPSignRateThrottle(SignRateThrottle):
+    scope = 'ip'
+
+    def get_ident_key(self, request):
+        return self.get_ident(request)
+
+
+class SessionSignRateThrottle(SignRateThrottle):
+    scope = 'session'
+
+    def get_ident_key(self, request):
+        return request.session.session_key
+
+
+class DeclineThrottle(BaseThrottle):
+    """
+    Refuse new sign requests from a session or IP address which has recently had too many card declines,
+    slowing down card testing attacks.
+    """
+    key_format = 'cybersource-declines-%s-%s'
+
+    def get_keys(self, request):
+        keys = [self.key_format % ('ip', self.get_ident(request))]
+        session_key = request.session.session_key
+        if session_key:
+            keys.append(self.key_format % ('session', session_key))
+        return keys
+
+    def record_decline(self, request):
+        if not settings.DECLINE_THROTTLE_LIMIT:
+            return
+        cache = get_cache()
+        for key in self.get_keys(request):
+            _incr(cache, key, settings.DECLINE_THROTTLE_WINDOW)
+
+    def allow_request(self, request, view):
+        if not settings.DECLINE_THROTTLE_LIMIT:
+            return True
+        counts = get_cache().get_many(self.get_keys(request))
+        if any(count >= settings.DECLINE_THROTTLE_LIMIT for count in counts.values()):
+            statsd.incr('checkout.sign-auth-request.throttled.declines')
+            metrics.THROTTLED.inc(scope='declines')
+            return False
+        return True
+
+    def wait(self):
+        return settings.DECLINE_THROTTLE_WINDOW
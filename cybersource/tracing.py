@@ -0,0 +1,232 @@
+"""
+Lightweight tracing for the sign and reply phases of an authorization.
+
+Spans use the same shape as OpenTelemetry's JSON span export. All the spans for an order share a trace ID
+derived from its reference number, so the sign request and the later reply can be correlated without
+storing anything.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from django.utils.module_loading import import_string
+from . import settings
+import binascii
+import hashlib
+import json
+import os
+import threading
+import time
+
+_local = threading.local()
+
+
+def new_id(num_bytes):
+    return binascii.hexlify(os.urandom(num_bytes)).decode()
+
+
+def trace_id_for(reference_number):
+    return hashlib.sha256(('cybersource:%s' % reference_number).encode('utf-8')).hexdigest()[:32]
+
+
+def _isoformat(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class Span(object):
+    def __init__(self, name, parent=None, kind='SpanKind.INTERNAL', start_time=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else None
+        self.span_id = new_id(8)
+        self.parent_id = parent.span_id if parent else None
+        self.start_time = start_time or time.time()
+        self.end_time = None
+        self.attributes = {}
+        self.status = 'UNSET'
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, end_time=None):
+        self.end_time = end_time or time.time()
+
+    @property
+    def duration(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'context': {
+                'trace_id': '0x%s' % self.trace_id,
+                'span_id': '0x%s' % self.span_id,
+                'trace_state': '[]',
+            },
+            'kind': self.kind,
+            'parent_id': ('0x%s' % self.parent_id) if self.parent_id else None,
+            'start_time': _isoformat(self.start_time),
+            'end_time': _isoformat(self.end_time) if self.end_time else None,
+            'status': {'status_code': self.status},
+            'attributes': self.attributes,
+            'events': [],
+            'links': [],
+            'resource': {'attributes': {'service.name': 'cybersource'}, 'schema_url': ''},
+        }
+
+
+class InMemorySpanExporter(object):
+    """
+    Keep finished spans in memory. Useful for tests and debugging.
+    """
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock:
+            self._spans.extend(spans)
+
+    def get_finished_spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans = []
+
+
+class FileSpanExporter(object):
+    """
+    Append finished spans to TRACING_FILE as JSON lines.
+    """
+    def __init__(self, path=None):
+        self.path = path or settings.TRACING_FILE
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.to_dict(), sort_keys=True) + '\n' for span in spans)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+
+
+_exporter = (None, None)
+
+
+def get_exporter():
+    global _exporter
+    path, exporter = _exporter
+    if path != settings.TRACING_EXPORTER:
+        exporter = import_string(settings.TRACING_EXPORTER)() if settings.TRACING_EXPORTER else None
+        _exporter = (settings.TRACING_EXPORTER, exporter)
+    return exporter
+
+
+def is_enabled():
+    return get_exporter() is not None
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+        _local.finished = []
+    return _local.stack
+
+
+def current_span():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def set_attribute(key, value):
+    """
+    Set an attribute on the root span of the current trace, if there is one.
+    """
+    stack = _stack()
+    if stack:
+        stack[0].set_attribute(key, value)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Record a span for a phase of the current trace. Does nothing if there isn't an active trace.
+    """
+    parent = current_span()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent=parent)
+    child.attributes.update(attributes)
+    _stack().append(child)
+    try:
+        yield child
+        child.status = 'OK'
+    except Exception:
+        child.status = 'ERROR'
+        raise
+    finally:
+        child.end()
+        _stack().pop()
+        _local.finished.append(child)
+
+
+@contextmanager
+def trace(name, **attributes):
+    """
+    Start the root span of a trace. When it ends, every span recorded in the trace is given a trace ID
+    based on the root's ``reference_number`` attribute and sent to the exporter.
+    """
+    exporter = get_exporter()
+    if exporter is None or current_span() is not None:
+        yield current_span()
+        return
+    root = Span(name, kind='SpanKind.SERVER')
+    root.attributes.update(attributes)
+    _stack().append(root)
+    _local.finished = []
+    try:
+        yield root
+        root.status = 'OK'
+    except Exception:
+        root.status = 'ERROR'
+        raise
+    finally:
+        root.end()
+        _stack().pop()
+        spans = _local.finished + [root]
+        _local.finished = []
+        reference_number = root.attributes.get('reference_number')
+        trace_id = trace_id_for(reference_number) if reference_number else new_id(16)
+        for s in spans:
+            s.trace_id = trace_id
+        exporter.export(spans)
+
+
+def traced(name):
+    """
+    Decorate a view method so that it runs inside a root span.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_span(name, start_time, end_time=None, **attributes):
+    """
+    Record an already finished span in the current trace, e.g. one which started in an earlier request.
+    """
+    parent = current_span()
+    if parent is None:
+        return None
+    s = Span(name, parent=parent, start_time=start_time)
+    s.attributes.update(attributes)
+    s.parent_id = None
+    s.status = 'OK'
+    s.end(end_time)
+    _local.finished.append(s)
+    return s
@@ -4,7 +4,10 @@ from rest_framework.urlpatterns import format_suffix_patterns
 from .views import (
     CyberSourceReplyView,
     FingerprintRedirectView,
-    SignAuthorizePaymentFormView
+    MetricsView,
+    SignAuthorizePaymentFormView,
+    TokenAuthorizePaymentView,
+    TransactionExportView,
 )
 
 
@@ -12,6 +15,9 @@ urlpatterns = patterns('',
     url(r'^cybersource-reply/$', csrf_exempt(CyberSourceReplyView.as_view()), name='cybersource-reply'),
     url(r'^fingerprint/(?P<url_type>.*)/$', FingerprintRedirectView.as_view(), name='cybersource-fingerprint-redirect'),
     url(r'^sign-auth-request/$', SignAuthorizePaymentFormView.as_view(), name='cybersource-sign-auth-request'),
+    url(r'^token-auth-request/$', TokenAuthorizePaymentView.as_view(), name='cybersource-token-auth-request'),
+    url(r'^metrics/$', MetricsView.as_view(), name='cybersource-metrics'),
+    url(r'^export/transactions/$', TransactionExportView.as_view(), name='cybersource-export-transactions'),
 )
 
 urlpatterns = format_suffix_patterns(urlpatterns)
@@ -1,43 +1,51 @@
 from datetime import datetime
 from decimal import Decimal
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import SuspiciousOperation
-from django.core.urlresolvers import reverse
 from django.db import transaction
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.utils.decorators import method_decorator
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
 from django_statsd.clients import statsd
 from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from oscar.core.loading import get_class, get_model
+from oscar.core import loading
 from oscarapi.basket.operations import assign_basket_strategy
 from oscarapi.views.utils import BasketPermissionMixin
-from . import actions, settings, signals, signature
+from . import actions, export, lookups, metrics, replylog, routers, settings, signals, signature, stats, tracing
 from .authentication import CSRFExemptSessionAuthentication
-from .constants import CHECKOUT_BASKET_ID, CHECKOUT_ORDER_ID, CHECKOUT_ORDER_NUM, CHECKOUT_SHIPPING_CODE, CHECKOUT_FINGERPRINT_SESSION_ID
-from .models import CyberSourceReply, PaymentToken
-from .serializers import CheckoutSerializer
+from .constants import CHECKOUT_BASKET_ID, CHECKOUT_ORDER_ID, CHECKOUT_ORDER_NUM, CHECKOUT_SHIPPING_CODE, CHECKOUT_FINGERPRINT_SESSION_ID, CHECKOUT_SIGN_STARTED, CHECKOUT_TOKEN_AUTH_ORDER_NUM
+from .decorators import reject_unsigned_post
+from .loading import get_class, get_model
+from .models import PaymentToken
+from .profiling import ProfilingMixin
+from .serializers import CheckoutSerializer, ReplyCheckoutSerializer
+from .throttling import DeclineThrottle, GlobalSignRateThrottle, IPSignRateThrottle, SessionSignRateThrottle
+import hmac
+import time
 import uuid
 import logging
 
+# Subclassed below, so it can't be loaded lazily
+OrderPlacementMixin = loading.get_class('checkout.mixins', 'OrderPlacementMixin')
+
 OrderNumberGenerator = get_class('order.utils', 'OrderNumberGenerator')
-OrderPlacementMixin = get_class('checkout.mixins', 'OrderPlacementMixin')
 OrderTotalCalculator = get_class('checkout.calculators', 'OrderTotalCalculator')
 
 Basket = get_model('basket', 'Basket')
 BillingAddress = get_model('order', 'BillingAddress')
 Country = get_model('address', 'Country')
-Order = get_model('order', 'Order')
-PaymentEventType = get_model('order', 'PaymentEventType')
 PaymentEvent = get_model('order', 'PaymentEvent')
 PaymentEventQuantity = get_model('order', 'PaymentEventQuantity')
 ShippingAddress = get_model('order', 'ShippingAddress')
 Source = get_model('payment', 'Source')
-SourceType = get_model('payment', 'SourceType')
 Transaction = get_model('payment', 'Transaction')
 
 
@@ -59,7 +67,7 @@ class FingerprintRedirectView(generic.View):
 
         sessid = request.session.get(CHECKOUT_FINGERPRINT_SESSION_ID)
         if not sessid:
-            sessid = str(uuid.uuid1())
+            sessid = self.get_fingerprint_session_id(request)
             request.session[CHECKOUT_FINGERPRINT_SESSION_ID] = sessid
 
         data = {
@@ -72,21 +80,99 @@ class FingerprintRedirectView(generic.View):
         url = self.url_types[url_type] % data
         return redirect(url)
 
+    def get_fingerprint_session_id(self, request):
+        """
+        The checkout page loads every fingerprint URL at once, so several of these requests usually arrive
+        concurrently for a fresh session. Derive the ID from the session key, so those requests agree on it
+        no matter which one saves the session last. A session is created if there isn't one yet, but requests
+        sent without a session cookie each get their own, so the checkout page should only be served once
+        the customer has a session (which their basket gives them).
+        """
+        if not request.session.session_key:
+            request.session.save()
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, 'cybersource-fingerprint:%s' % request.session.session_key))
+
+
+
+class TransactionExportView(generic.View):
+    """
+    Stream transactions, joined to their payment tokens and reply logs, as CSV or JSON lines.
+    """
+    @method_decorator(staff_member_required)
+    def dispatch(self, *args, **kwargs):
+        return super().dispatch(*args, **kwargs)
+
+    def get(self, request):
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in export.FORMATS:
+            return HttpResponseBadRequest('Unknown format')
+        try:
+            start = self._parse_date(request.GET.get('start'))
+            end = self._parse_date(request.GET.get('end'))
+        except ValueError:
+            return HttpResponseBadRequest('Dates must be formatted as YYYY-MM-DD')
+
+        writer, content_type = export.FORMATS[fmt]
+        rows = export.iter_transaction_rows(start, end)
+        response = StreamingHttpResponse(writer(rows), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="transactions.%s"' % fmt
+        return response
+
+    def _parse_date(self, value):
+        if not value:
+            return None
+        return datetime.strptime(value, '%Y-%m-%d')
+
+
+
+class MetricsView(generic.View):
+    """
+    Expose the in-process checkout metrics in the Prometheus text format. Available to staff users, or to
+    scrapers sending the CYBERSOURCE_METRICS_TOKEN as a bearer token.
+    """
+    def get(self, request):
+        if not self._is_authorized(request):
+            return redirect_to_login(request.get_full_path())
+        return HttpResponse(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def _is_authorized(self, request):
+        if settings.METRICS_TOKEN:
+            auth = request.META.get('HTTP_AUTHORIZATION', '')
+            if hmac.compare_digest(auth.encode('utf-8'), ('Bearer %s' % settings.METRICS_TOKEN).encode('utf-8')):
+                return True
+        return request.user.is_active and request.user.is_staff
+
 
 
 class BaseCheckoutView(BasketPermissionMixin, APIView):
-    def get_checkout_serializer(self, request, data):
+    def dispatch(self, request, *args, **kwargs):
+        # Checkout reads back what it has just written, so it never reads from the replica
+        with routers.pin_to_primary():
+            return super().dispatch(request, *args, **kwargs)
+
+    def get_checkout_serializer(self, request, data, serializer_class=CheckoutSerializer):
         context = {'request': request}
-        ser = CheckoutSerializer(data=data, context=context)
+        ser = serializer_class(data=data, context=context)
         ser.order_number = request.session.get(CHECKOUT_ORDER_NUM)
         return ser
 
+    def set_session_value(self, request, key, value):
+        # Assigning a session key marks the session as modified, even if the value is unchanged, which
+        # makes the session middleware write it back to the database
+        if key not in request.session or request.session[key] != value:
+            request.session[key] = value
+
 
 
-class SignAuthorizePaymentFormView(BaseCheckoutView):
+class SignAuthorizePaymentFormView(metrics.MetricsMixin, ProfilingMixin, BaseCheckoutView):
     """
     Provide the form fields needed to make a signed authorization transaction request to CyberSource.
     """
+    throttle_classes = (SessionSignRateThrottle, IPSignRateThrottle, GlobalSignRateThrottle, DeclineThrottle)
+    # The response is only ever read by the checkout JS, so skip negotiating the browsable API
+    renderer_classes = (JSONRenderer, )
+
+    @tracing.traced('cybersource.sign')
     def post(self, request, format=None):
         data_basket = self.get_data_basket(request.data, format)
         basket = self.check_basket_permission(request, basket_pk=data_basket.pk)
@@ -94,7 +180,9 @@ class SignAuthorizePaymentFormView(BaseCheckoutView):
 
         # Validate the shipping address, etc
         ser = self.get_checkout_serializer(request, request.data)
-        if not ser.is_valid():
+        with tracing.span('sign.validate'):
+            is_valid = ser.is_valid()
+        if not is_valid:
             return Response(ser.errors, status.HTTP_406_NOT_ACCEPTABLE)
 
         basket = ser.validated_data['basket']
@@ -109,17 +197,21 @@ class SignAuthorizePaymentFormView(BaseCheckoutView):
 
         # Freeze the basket so that the user can't modify it anymore, preventing any sort
         # of possible authorization / add product timing attack.
-        request.session[CHECKOUT_BASKET_ID] = basket.id
-        basket.freeze()
-
-        # Allow application to calculate taxes before the total is calculated
-        signals.pre_calculate_auth_total.send(
-            sender=self.__class__,
-            basket=basket,
-            shipping_address=shipping_address)
-
-        # Figure out the final total order price
-        order_total = OrderTotalCalculator().calculate(basket, shipping_charge)
+        self.set_session_value(request, CHECKOUT_BASKET_ID, basket.id)
+        with tracing.span('sign.freeze_basket'):
+            # Repeated sign requests for the same basket don't need to freeze it again
+            if basket.status != Basket.FROZEN:
+                basket.freeze()
+
+        with tracing.span('sign.calculate_total'):
+            # Allow application to calculate taxes before the total is calculated
+            signals.pre_calculate_auth_total.send(
+                sender=self.__class__,
+                basket=basket,
+                shipping_address=shipping_address)
+
+            # Figure out the final total order price
+            order_total = OrderTotalCalculator().calculate(basket, shipping_charge)
 
         # Generate an order number unless we already have one in the session
         order_number = request.session.get(CHECKOUT_ORDER_NUM)
@@ -127,9 +219,12 @@ class SignAuthorizePaymentFormView(BaseCheckoutView):
             order_number = OrderNumberGenerator().order_number(basket)
             order_number = str(order_number)
             request.session[CHECKOUT_ORDER_NUM] = order_number
+            if tracing.is_enabled():
+                request.session[CHECKOUT_SIGN_STARTED] = time.time()
+        tracing.set_attribute('reference_number', order_number)
 
         # Cache shipping method code in session
-        request.session[CHECKOUT_SHIPPING_CODE] = ser.validated_data['shipping_method'].code
+        self.set_session_value(request, CHECKOUT_SHIPPING_CODE, ser.validated_data['shipping_method'].code)
 
         # Allow application to include extra, arbitrary fields in the request to CS
         extra_fields = { 'bill_to_email': guest_email }
@@ -153,26 +248,77 @@ class SignAuthorizePaymentFormView(BaseCheckoutView):
 
         # Return form fields to the browser. The browser then needs to fill in the blank
         # fields (like billing data) and submit them as a POST to CyberSource.
-        data = dict(zip(('url', 'fields'), self._fields(operation)))
+        with tracing.span('sign.build_request'):
+            data = dict(zip(('url', 'fields'), self._fields(operation)))
         statsd.incr('checkout.complete-payment-authorize')
         return Response(data)
 
     def _fields(self, operation):
-        fields = []
         cs_fields = operation.fields()
-        editable_fields = cs_fields['unsigned_field_names'].split(',')
-        for key, value in cs_fields.items():
-            fields.append({
-                'key': key,
-                'value': value if isinstance(value, str) else value.decode(),
-                'editable': (key in editable_fields)
-            })
-
+        tracing.set_attribute('transaction_uuid', cs_fields.get('transaction_uuid'))
+        editable_fields = frozenset(cs_fields['unsigned_field_names'].split(','))
+        fields = [
+            {'key': key, 'value': value, 'editable': key in editable_fields}
+            for key, value in cs_fields.items()
+        ]
         return operation.url, fields
 
 
 
-class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
+class ReplyRecordingMixin(object):
+    """
+    Log authorization replies and record the resulting payments.
+    """
+    def log_reply(self, request, reply_data):
+        # Accepted replies are referenced by the payment token and transaction, so they must be saved now.
+        # The reply log backend may defer the others, or keep them out of the database.
+        log = replylog.get_backend().log(
+            reply_data,
+            user=request.user if request.user.is_authenticated() else None,
+            referenced=reply_data.get('decision') == 'ACCEPT')
+        if settings.DECISION_STATS_ENABLED:
+            stats.record_reply(log, reply_data)
+        return log
+
+
+    def _record_payment(self, order, token, data, reply_log_entry):
+        source_type = lookups.get_source_type(settings.SOURCE_TYPE)
+        source, created = Source.objects.get_or_create(order=order, source_type=source_type)
+        source.currency = data.get('req_currency')
+        source.amount_allocated += Decimal(data.get('auth_amount', '0'))
+        source.save()
+
+        transaction = Transaction()
+        transaction.log = reply_log_entry
+        transaction.source = source
+        transaction.token = token
+        transaction.txn_type = Transaction.AUTHORISE
+        transaction.amount = data.get('req_amount', 0)
+        transaction.reference = data.get('transaction_id')
+        transaction.status = data.get('decision')
+        transaction.request_token = data.get('request_token')
+        transaction.processed_datetime = datetime.strptime(data.get('signed_date_time'), settings.DATE_FORMAT)
+        transaction.save()
+
+        event = PaymentEvent()
+        event.order = order
+        event.amount = data.get('auth_amount', 0)
+        event.reference = data.get('transaction_id')
+        event.event_type = lookups.get_payment_event_type(Transaction.AUTHORISE)
+        event.save()
+
+        for line in order.lines.all():
+            line_event = PaymentEventQuantity()
+            line_event.event = event
+            line_event.line = line
+            line_event.quantity = line.quantity
+            line_event.save()
+
+        return transaction
+
+
+
+class CyberSourceReplyView(metrics.MetricsMixin, ProfilingMixin, ReplyRecordingMixin, OrderPlacementMixin, BaseCheckoutView):
     """
     Handle a CyberSource reply.
     """
@@ -181,32 +327,49 @@ class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
     # Default code for the email to send after successful checkout
     communication_type_code = 'ORDER_PLACED'
     DECISION_ACCEPT = 'ACCEPT'
+    DECISION_DECLINE = 'DECLINE'
 
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Cheaply reject forged replies before DRF loads the session and user
+        return reject_unsigned_post(super().as_view(**initkwargs))
+
+    @tracing.traced('cybersource.reply')
     def post(self, request, format=None):
-        if not self.is_request_valid(request):
+        with tracing.span('reply.verify'):
+            is_valid = self.is_request_valid(request)
+        if not is_valid:
+            metrics.SIGNATURE_FAILURES.inc(reason='bad-signature')
             raise SuspiciousOperation('Bad Signature')
+        metrics.DECISIONS.inc(decision=request.data.get('decision'), reason_code=request.data.get('reason_code'))
+        tracing.set_attribute('reference_number', request.data.get('req_reference_number'))
+        tracing.set_attribute('transaction_uuid', request.data.get('req_transaction_uuid'))
+        tracing.set_attribute('decision', request.data.get('decision'))
+        sign_started = request.session.get(CHECKOUT_SIGN_STARTED)
 
         # Record in reply log
-        log = self.log_response(request)
+        with tracing.span('reply.log'):
+            log = self.log_response(request)
 
         # Invoke handler for transaction type
         trans_type = request.data.get('req_transaction_type')
         handler = self.get_handler_fn(trans_type)
-        with transaction.atomic():
+        with tracing.span('reply.handle'), transaction.atomic():
             resp = handler(request, format, log)
+
+        # Measure the customer perceived time from first signing the request to getting the reply handled
+        if sign_started:
+            tracing.record_span('cybersource.authorization', sign_started,
+                decision=request.data.get('decision'))
         return resp
 
 
     def is_request_valid(self, request):
-        return signature.SecureAcceptanceSigner().verify_request(request)
+        return signature.get_signer().verify_request(request)
 
 
     def log_response(self, request):
-        log = CyberSourceReply(
-            user=request.user if request.user.is_authenticated() else None,
-            data=request.data)
-        log.save()
-        return log
+        return self.log_reply(request, request.data)
 
 
     def get_handler_fn(self, trans_type):
@@ -220,7 +383,7 @@ class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
 
     def record_authorization(self, request, format, reply_log_entry):
         # If the transaction already exists, do nothing
-        if Transaction.objects.filter(reference=request.data.get('transaction_id')).exists():
+        if routers.primary(Transaction.objects.filter(reference=request.data.get('transaction_id'))).exists():
             logger.warning('Duplicate transaction_id received from CyberSource: %s' % request.data.get('transaction_id'))
             return redirect(settings.REDIRECT_SUCCESS)
 
@@ -228,6 +391,10 @@ class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
         if request.data.get('req_reference_number') != request.session.get(CHECKOUT_ORDER_NUM):
             raise SuspiciousOperation("req_reference_number doesn't match user session")
 
+        # Check if the authorization was declined before doing any of the work needed to place an order
+        if request.data.get('decision') != self.DECISION_ACCEPT:
+            return self._handle_decline(request)
+
         # Get the (currently frozen) basket from the session reference
         try:
             basket = Basket.objects.get(id=request.session.get(CHECKOUT_BASKET_ID))
@@ -237,50 +404,60 @@ class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
 
         # Get the basket and serializer prepared to place an order
         data = self._build_checkout_data(request, basket)
-        ser = self.get_checkout_serializer(request, data)
+        ser = self.get_checkout_serializer(request, data, ReplyCheckoutSerializer)
         if not ser.is_valid():
             return Response(ser.errors, status.HTTP_400_BAD_REQUEST)
 
-        # Check if the authorization was declined
-        if request.data.get('decision') != self.DECISION_ACCEPT:
-            messages.add_message(request._request, messages.ERROR, settings.CARD_REJECT_ERROR)
-            basket.thaw()
-            return redirect(settings.REDIRECT_FAIL)
-
         # Everything checks out. Place the order and record the transaction.
-        order = ser.save()
+        with tracing.span('reply.place_order'):
+            order = ser.save()
 
-        # Save the payment token. We'll need to send this to PnP so they can complete the transaction
-        token = self._record_payment_token(request, reply_log_entry)
+        with tracing.span('reply.record_payment'):
+            # Save the payment token. We'll need to send this to PnP so they can complete the transaction
+            token = self._record_payment_token(request, reply_log_entry)
 
-        # Record the transaction information and, if it was declined, make the user try again
-        self._record_payment(order, token, request, reply_log_entry)
+            # Record the transaction information and, if it was declined, make the user try again
+            self._record_payment(order, token, request.data, reply_log_entry)
 
         # Mark order as authorized since we've successfully auth'd the card
         order.set_status(settings.ORDER_STATUS_SUCCESS)
 
         # Run post order placement tasks
-        self.send_confirmation_message(order, self.communication_type_code)
-        signals.order_placed.send(
-            sender=self.__class__,
-            order=order)
+        with tracing.span('reply.notify'):
+            self.send_confirmation_message(order, self.communication_type_code)
+            signals.order_placed.send(
+                sender=self.__class__,
+                order=order)
 
         # Clean up the session
-        for key in (CHECKOUT_BASKET_ID, CHECKOUT_ORDER_NUM, CHECKOUT_SHIPPING_CODE):
+        for key in (CHECKOUT_BASKET_ID, CHECKOUT_ORDER_NUM, CHECKOUT_SHIPPING_CODE, CHECKOUT_SIGN_STARTED):
             if key in request.session:
                 del request.session[key]
                 request.session.modified = True
 
         request.session[CHECKOUT_ORDER_ID] = order.id
+        routers.pin_session(request)
         return redirect(settings.REDIRECT_SUCCESS)
 
 
+    def _handle_decline(self, request):
+        # Thaw the basket with a single UPDATE, without loading it
+        basket_id = request.session.get(CHECKOUT_BASKET_ID)
+        if not Basket.objects.filter(id=basket_id).update(status=Basket.OPEN):
+            raise SuspiciousOperation("no basket in session")
+
+        if request.data.get('decision') == self.DECISION_DECLINE:
+            DeclineThrottle().record_decline(request)
+        messages.add_message(request._request, messages.ERROR, settings.CARD_REJECT_ERROR)
+        return redirect(settings.REDIRECT_FAIL)
+
+
     def _build_checkout_data(self, request, basket):
-        # Convert the request data from CS into something the CheckoutSerializer can understand
+        # Convert the request data from CS into something the ReplyCheckoutSerializer can understand
         ship_country = request.data.get('req_ship_to_address_country')
         bill_country = request.data.get('req_bill_to_address_country')
         data = {
-            'basket': reverse('basket-detail', args=(basket.id, )),
+            'basket': basket,
             'guest_email': request.data.get('req_bill_to_email'),
             'shipping_method_code': request.session.get(CHECKOUT_SHIPPING_CODE),
             'shipping_address': None if not ship_country else {
@@ -291,7 +468,7 @@ class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
                 'line4': request.data.get('req_ship_to_address_city'),
                 'postcode': request.data.get('req_ship_to_address_postal_code'),
                 'state': request.data.get('req_ship_to_address_state'),
-                'country': reverse('country-detail', args=(ship_country, )),
+                'country': self._get_country(ship_country),
                 'phone_number': '+%s' % request.data.get('req_ship_to_phone'),
             },
             'billing_address': None if not bill_country else {
@@ -302,14 +479,21 @@ class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
                 'line4': request.data.get('req_bill_to_address_city'),
                 'postcode': request.data.get('req_bill_to_address_postal_code'),
                 'state': request.data.get('req_bill_to_address_state'),
-                'country': reverse('country-detail', args=(bill_country, )),
+                'country': self._get_country(bill_country),
             }
         }
         return data
 
 
+    def _get_country(self, code):
+        try:
+            return lookups.get_country(code)
+        except Country.DoesNotExist:
+            return None
+
+
     def _record_payment_token(self, request, reply_log_entry):
-        tokens = PaymentToken.objects.filter(token=request.data.get('payment_token'))
+        tokens = routers.primary(PaymentToken.objects.filter(token=request.data.get('payment_token')))
         if tokens.exists():
             return tokens.first()
 
@@ -322,37 +506,168 @@ class CyberSourceReplyView(OrderPlacementMixin, BaseCheckoutView):
         return token
 
 
-    def _record_payment(self, order, token, request, reply_log_entry):
-        source_type, created = SourceType.objects.get_or_create(name=settings.SOURCE_TYPE)
-        source, created = Source.objects.get_or_create(order=order, source_type=source_type)
-        source.currency = request.data.get('req_currency')
-        source.amount_allocated += Decimal(request.data.get('auth_amount', '0'))
-        source.save()
 
-        transaction = Transaction()
-        transaction.log = reply_log_entry
-        transaction.source = source
-        transaction.token = token
-        transaction.txn_type = Transaction.AUTHORISE
-        transaction.amount = request.data.get('req_amount', 0)
-        transaction.reference = request.data.get('transaction_id')
-        transaction.status = request.data.get('decision')
-        transaction.request_token = request.data.get('request_token')
-        transaction.processed_datetime = datetime.strptime(request.data.get('signed_date_time'), settings.DATE_FORMAT)
-        transaction.save()
+class TokenAuthorizePaymentView(metrics.MetricsMixin, ReplyRecordingMixin, OrderPlacementMixin, BaseCheckoutView):
+    """
+    One-click checkout for returning customers. Authorize one of the user's saved payment tokens server-side
+    and place the order, all in a single request.
+    """
+    permission_classes = (IsAuthenticated, )
+    throttle_classes = (SessionSignRateThrottle, IPSignRateThrottle, GlobalSignRateThrottle, DeclineThrottle)
 
-        event = PaymentEvent()
-        event.order = order
-        event.amount = request.data.get('auth_amount', 0)
-        event.reference = request.data.get('transaction_id')
-        event.event_type = PaymentEventType.objects.get_or_create(name=Transaction.AUTHORISE)[0]
-        event.save()
+    # Default code for the email to send after successful checkout
+    communication_type_code = 'ORDER_PLACED'
+    DECISION_ACCEPT = 'ACCEPT'
+    DECISION_DECLINE = 'DECLINE'
+    DECISION_ERROR = 'ERROR'
+    DECISION_REVIEW = 'REVIEW'
 
-        for line in order.lines.all():
-            line_event = PaymentEventQuantity()
-            line_event.event = event
-            line_event.line = line
-            line_event.quantity = line.quantity
-            line_event.save()
+    # Errors after which the card may or may not have been authorized
+    TIMEOUT_REASON_CODES = ('151', '152')
+    DUPLICATE_REASON_CODE = '104'
 
-        return transaction
+    @tracing.traced('cybersource.token_auth')
+    def post(self, request, format=None):
+        data_basket = self.get_data_basket(request.data, format)
+        basket = self.check_basket_permission(request, basket_pk=data_basket.pk)
+        assert(data_basket == basket)
+
+        # The token must belong to the user
+        token = PaymentToken.objects\
+            .filter(token=request.data.get('payment_token'), log__user=request.user)\
+            .first()
+        if token is None:
+            return Response({'payment_token': ['Unknown payment token.']}, status.HTTP_406_NOT_ACCEPTABLE)
+
+        # Validate the shipping address, etc
+        ser = self.get_checkout_serializer(request, request.data)
+        with tracing.span('token_auth.validate'):
+            is_valid = ser.is_valid()
+        if not is_valid:
+            return Response(ser.errors, status.HTTP_406_NOT_ACCEPTABLE)
+
+        basket = ser.validated_data['basket']
+        shipping_address = None
+        if ser.validated_data.get('shipping_address'):
+            shipping_address = ShippingAddress(**ser.validated_data['shipping_address'])
+        billing_address = None
+        if ser.validated_data.get('billing_address'):
+            billing_address = BillingAddress(**ser.validated_data['billing_address'])
+
+        # Freeze the basket while the card is being authorized
+        basket.freeze()
+
+        # Allow application to calculate taxes before the total is calculated
+        signals.pre_calculate_auth_total.send(
+            sender=self.__class__,
+            basket=basket,
+            shipping_address=shipping_address)
+        order_total = OrderTotalCalculator().calculate(basket, ser.validated_data['shipping_charge'])
+        ser.validated_data['total'] = order_total
+
+        # Reuse the order number of an earlier attempt whose outcome is unknown, so that CyberSource
+        # rejects the retry as a duplicate rather than authorizing the card twice. It's kept apart from the
+        # Secure Acceptance flow's order number, which a sign request may have left in the session.
+        pending_order_number = request.session.get(CHECKOUT_TOKEN_AUTH_ORDER_NUM)
+        ser.order_number = pending_order_number or str(OrderNumberGenerator().order_number(basket))
+        tracing.set_attribute('reference_number', ser.order_number)
+
+        operation = actions.AuthorizePaymentToken(
+            order_number=ser.order_number,
+            order_total=order_total,
+            basket=basket,
+            token=token,
+            shipping_address=shipping_address,
+            billing_address=billing_address,
+            email=request.user.email,
+            customer_ip_address=request.META['REMOTE_ADDR'],
+            fingerprint_session_id=request.session.get(CHECKOUT_FINGERPRINT_SESSION_ID))
+        with tracing.span('token_auth.authorize'):
+            reply_data = operation.authorize()
+        decision = reply_data['decision']
+        metrics.DECISIONS.inc(decision=decision, reason_code=reply_data['reason_code'])
+        tracing.set_attribute('decision', decision)
+
+        with tracing.span('token_auth.log'):
+            log = self.log_reply(request, reply_data)
+
+        reason_code = reply_data['reason_code']
+        outcome_unknown = decision == self.DECISION_ERROR and (
+            reason_code in self.TIMEOUT_REASON_CODES or
+            (reason_code == self.DUPLICATE_REASON_CODE and pending_order_number))
+        if outcome_unknown:
+            # The card may have been authorized. Keep the basket frozen and the order number, so that a
+            # retry can't authorize it again under a new one.
+            request.session[CHECKOUT_TOKEN_AUTH_ORDER_NUM] = ser.order_number
+            statsd.incr('checkout.token-payment-authorize.unknown')
+            data = {
+                'decision': decision,
+                'reason_code': reason_code,
+                'message': settings.PAYMENT_UNKNOWN_ERROR,
+            }
+            return Response(data, status.HTTP_504_GATEWAY_TIMEOUT)
+
+        if decision != self.DECISION_ACCEPT:
+            if decision == self.DECISION_REVIEW:
+                # The card was authorized, but the order isn't placed without a review. Release the hold.
+                self._reverse_authorization(request, ser.order_number, reply_data, 'Order pending review')
+            basket.thaw()
+            self._clear_order_number(request)
+            if decision == self.DECISION_DECLINE:
+                DeclineThrottle().record_decline(request)
+            statsd.incr('checkout.token-payment-authorize.%s' % decision.lower())
+            data = {
+                'decision': decision,
+                'reason_code': reply_data['reason_code'],
+                'message': settings.CARD_REJECT_ERROR,
+            }
+            code = status.HTTP_502_BAD_GATEWAY if decision == self.DECISION_ERROR else status.HTTP_402_PAYMENT_REQUIRED
+            return Response(data, code)
+
+        # Place the order and record the transaction. If that fails, reverse the authorization so that the
+        # customer isn't left with a hold on their card for an order which doesn't exist.
+        try:
+            with tracing.span('token_auth.place_order'), transaction.atomic():
+                order = ser.save()
+                self._record_payment(order, token, reply_data, log)
+                order.set_status(settings.ORDER_STATUS_SUCCESS)
+        except Exception:
+            logger.exception('Failed to place order %s after authorizing it. Reversing the authorization.', ser.order_number)
+            self._reverse_authorization(request, ser.order_number, reply_data, 'Order could not be placed')
+            basket.thaw()
+            self._clear_order_number(request)
+            statsd.incr('checkout.token-payment-authorize.place-order-failed')
+            return Response({'message': 'The order could not be placed.'}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self._clear_order_number(request)
+
+        # Run post order placement tasks
+        with tracing.span('token_auth.notify'):
+            self.send_confirmation_message(order, self.communication_type_code)
+            signals.order_placed.send(
+                sender=self.__class__,
+                order=order)
+
+        request.session[CHECKOUT_ORDER_ID] = order.id
+        routers.pin_session(request)
+        statsd.incr('checkout.token-payment-authorize.accept')
+        return Response({
+            'order_number': order.number,
+            'redirect_url': settings.REDIRECT_SUCCESS,
+        })
+
+    def _clear_order_number(self, request):
+        if CHECKOUT_TOKEN_AUTH_ORDER_NUM in request.session:
+            del request.session[CHECKOUT_TOKEN_AUTH_ORDER_NUM]
+
+    def _reverse_authorization(self, request, order_number, reply_data, reason):
+        operation = actions.ReverseAuthorization(
+            order_number=order_number,
+            amount=reply_data['req_amount'],
+            transaction_id=reply_data['transaction_id'],
+            reason=reason)
+        with tracing.span('token_auth.reverse'):
+            reversal_data = operation.reverse()
+        if reversal_data['decision'] != self.DECISION_ACCEPT:
+            logger.error('Failed to reverse the authorization of order %s: %s %s', order_number,
+                reversal_data['http_status'], reversal_data.get('reason', ''))
+        replylog.get_backend().log(reversal_data, user=request.user, referenced=False)
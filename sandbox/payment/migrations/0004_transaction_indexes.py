@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from cybersource.indexes import create_index
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('payment', '0003_auto_20160404_1250'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='transaction',
+                    name='processed_datetime',
+                    field=models.DateTimeField(db_index=True),
+                ),
+                migrations.AlterField(
+                    model_name='transaction',
+                    name='request_token',
+                    field=models.CharField(max_length=200, db_index=True),
+                ),
+                migrations.AlterIndexTogether(
+                    name='transaction',
+                    index_together=set([('reference',)]),
+                ),
+            ],
+            database_operations=[
+                create_index('payment', 'Transaction', 'reference'),
+                create_index('payment', 'Transaction', 'request_token'),
+                create_index('payment', 'Transaction', 'processed_datetime'),
+            ],
+        ),
+    ]
@@ -38,6 +38,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.flatpages.middleware.FlatpageFallbackMiddleware',
     'oscar.apps.basket.middleware.BasketMiddleware',
+    'cybersource.routers.ReadYourWritesMiddleware',
 )
 
 
@@ -63,6 +64,8 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = ['cybersource.routers.ReplicaRouter']
+
 HAYSTACK_CONNECTIONS = {
     'default': {
         'ENGINE': 'haystack.backends.simple_backend.SimpleEngine',
@@ -0,0 +1,220 @@
+from cybersource import capture
+from cybersource.tests.factories import create_transaction
+from cybersource.tests.servers import StandInServer
+from decimal import Decimal
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from mock import patch
+from oscar.core.loading import get_model
+from oscar.test import factories
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+PaymentEvent = get_model('order', 'PaymentEvent')
+Transaction = get_model('payment', 'Transaction')
+
+SHARED_SECRET = base64.b64encode(b'capture-test-secret').decode()
+
+
+def accept(path, headers, body):
+    return 201, {
+        'id': 'capture-%s' % path.split('/')[4],
+        'status': 'PENDING',
+        'submitTimeUtc': '2016-04-07T14:06:37Z',
+        'orderInformation': {'amountDetails': body['orderInformation']['amountDetails']},
+    }
+
+
+class CaptureTest(TestCase):
+    def start_server(self, responder=accept):
+        server = StandInServer(responder).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def get_client(self, server, **kwargs):
+        kwargs.setdefault('concurrency', 4)
+        kwargs.setdefault('backoff', 0)
+        client = capture.CaptureClient(endpoint=server.endpoint, key_id='test-key', shared_secret=SHARED_SECRET, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def create_authorized_orders(self, count):
+        authorizations = []
+        for i in range(count):
+            order = factories.create_order()
+            order.status = settings.CYBERSOURCE_ORDER_STATUS_SUCCESS
+            order.save()
+            authorizations.append(create_transaction(order))
+        return authorizations
+
+    def test_capture_orders(self):
+        authorizations = self.create_authorized_orders(10)
+        server = self.start_server()
+
+        results = capture.capture_orders(client=self.get_client(server))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(capture.summarize(results), {'captured': 10, 'failed': 0, 'unknown': 0, 'amount': Decimal('999.90')})
+        self.assertEqual(len(server.requests), 10)
+        # Connections are kept alive and reused, never more than one per worker
+        self.assertLessEqual(len(server.connections), 4)
+
+        for authorization in authorizations:
+            debit = Transaction.objects.get(source=authorization.source, txn_type=Transaction.DEBIT)
+            self.assertEqual(debit.status, 'PENDING')
+            self.assertEqual(debit.reference, 'capture-%s' % authorization.reference)
+            self.assertEqual(debit.amount, Decimal('99.99'))
+            self.assertEqual(debit.token, authorization.token)
+            self.assertEqual(debit.log_field('req_reference_number'), authorization.source.order.number)
+            self.assertEqual(debit.log_field('orderInformation_amountDetails_totalAmount'), '99.99')
+            authorization.source.refresh_from_db()
+            self.assertEqual(authorization.source.amount_debited, Decimal('99.99'))
+            event = PaymentEvent.objects.get(order=authorization.source.order, event_type__name=Transaction.DEBIT)
+            self.assertEqual(event.line_quantities.count(), authorization.source.order.lines.count())
+
+        # Captured orders aren't captured again
+        self.assertEqual(capture.capture_orders(client=self.get_client(server)), [])
+
+    def test_request_signature(self):
+        authorization = self.create_authorized_orders(1)[0]
+        server = self.start_server()
+        capture.capture_orders(client=self.get_client(server))
+
+        path, headers, body = server.requests[0]
+        self.assertEqual(path, '/pts/v2/payments/%s/captures' % authorization.reference)
+        self.assertEqual(json.loads(body.decode('utf-8'))['clientReferenceInformation']['code'], authorization.source.order.number)
+        self.assertEqual(headers['Digest'], 'SHA-256=%s' % base64.b64encode(hashlib.sha256(body).digest()).decode())
+
+        signature = dict(part.split('=', 1) for part in headers['Signature'].split(', '))
+        signed_headers = signature['headers'].strip('"').split(' ')
+        self.assertEqual(signed_headers, ['host', 'date', '(request-target)', 'digest', 'v-c-merchant-id'])
+        values = {
+            'host': headers['Host'],
+            'date': headers['Date'],
+            '(request-target)': 'post %s' % path,
+            'digest': headers['Digest'],
+            'v-c-merchant-id': headers['v-c-merchant-id'],
+        }
+        message = '\n'.join('%s: %s' % (name, values[name]) for name in signed_headers).encode('utf-8')
+        expected = base64.b64encode(hmac.new(base64.b64decode(SHARED_SECRET), message, hashlib.sha256).digest()).decode()
+        self.assertEqual(signature['signature'].strip('"'), expected)
+
+    def test_retry_with_backoff(self):
+        self.create_authorized_orders(3)
+        seen = set()
+
+        def flaky(path, headers, body):
+            if path not in seen:
+                seen.add(path)
+                return 503, {'status': 'SERVER_ERROR'}
+            return accept(path, headers, body)
+
+        server = self.start_server(flaky)
+        results = capture.capture_orders(client=self.get_client(server))
+        self.assertEqual([r.attempts for r in results], [2, 2, 2])
+        self.assertEqual(capture.summarize(results)['captured'], 3)
+        self.assertEqual(Transaction.objects.filter(txn_type=Transaction.DEBIT).count(), 3)
+
+    def test_failures_recorded_and_retried_later(self):
+        authorization = self.create_authorized_orders(1)[0]
+        server = self.start_server(lambda path, headers, body: (400, {'status': 'INVALID_REQUEST', 'reason': 'AUTH_ALREADY_REVERSED'}))
+
+        results = capture.capture_orders(client=self.get_client(server))
+        self.assertEqual(results[0].attempts, 1)
+        self.assertEqual(capture.summarize(results), {'captured': 0, 'failed': 1, 'unknown': 0, 'amount': Decimal('0.00')})
+        debit = Transaction.objects.get(source=authorization.source, txn_type=Transaction.DEBIT)
+        self.assertEqual(debit.status, 'INVALID_REQUEST')
+        authorization.source.refresh_from_db()
+        self.assertEqual(authorization.source.amount_debited, Decimal('0.00'))
+
+        # Failed captures are picked up by the next run
+        self.assertEqual(list(capture.get_authorizations()), [authorization])
+
+    def test_unknown_outcomes_not_retried(self):
+        authorizations = self.create_authorized_orders(2)
+        timeout_path = '/pts/v2/payments/%s/captures' % authorizations[1].reference
+
+        def respond(path, headers, body):
+            if path == timeout_path:
+                time.sleep(0.5)
+                return accept(path, headers, body)
+            return 504, {'status': 'SERVER_ERROR'}
+
+        server = self.start_server(respond)
+        results = capture.capture_orders(client=self.get_client(server, timeout=0.2))
+        self.assertEqual([r.attempts for r in results], [1, 1])
+        self.assertEqual(results[1].data['reason'], 'ReadTimeout')
+        self.assertEqual(capture.summarize(results), {'captured': 0, 'failed': 0, 'unknown': 2, 'amount': Decimal('0.00')})
+        debits = Transaction.objects.filter(txn_type=Transaction.DEBIT)
+        self.assertEqual(sorted(debits.values_list('status', flat=True)), ['UNKNOWN', 'UNKNOWN'])
+
+        # They may have been captured, so they're left for reconciliation
+        self.assertEqual(list(capture.get_authorizations()), [])
+
+    def test_results_recorded_as_they_arrive(self):
+        self.create_authorized_orders(2)
+        client = self.get_client(self.start_server(), concurrency=2)
+        send = client.capture
+        record_capture = capture.record_capture
+        recorded = threading.Event()
+        lock = threading.Lock()
+        calls = []
+        waited = []
+
+        def record(result):
+            record_capture(result)
+            recorded.set()
+
+        def send_after_first_recorded(authorization_id, body):
+            with lock:
+                calls.append(authorization_id)
+                is_second = len(calls) == 2
+            if is_second:
+                waited.append(recorded.wait(5))
+            return send(authorization_id, body)
+
+        with patch.object(client, 'capture', send_after_first_recorded), patch('cybersource.capture.record_capture', record):
+            results = capture.capture_orders(client=client)
+        self.assertEqual(waited, [True])
+        self.assertEqual(capture.summarize(results)['captured'], 2)
+
+    def test_concurrent_runs(self):
+        authorization = self.create_authorized_orders(1)[0]
+        server = self.start_server()
+        other = type(connection)(dict(connection.settings_dict), alias='other')
+        self.addCleanup(other.close)
+        with other.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', [capture.CAPTURE_LOCK_ID])
+            with self.assertRaises(capture.CaptureInProgress):
+                capture.capture_orders([authorization], client=self.get_client(server))
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [capture.CAPTURE_LOCK_ID])
+        self.assertEqual(server.requests, [])
+
+        # Authorizations which another run has captured in the meantime are skipped
+        capture.capture_orders([authorization], client=self.get_client(server))
+        self.assertEqual(capture.capture_orders([authorization], client=self.get_client(server)), [])
+        self.assertEqual(len(server.requests), 1)
+
+    def test_connection_errors(self):
+        self.create_authorized_orders(1)
+        server = self.start_server()
+        endpoint = server.endpoint
+        server.stop()
+
+        client = capture.CaptureClient(endpoint=endpoint, key_id='test-key', shared_secret=SHARED_SECRET, max_retries=2, backoff=0)
+        self.addCleanup(client.close)
+        results = capture.capture_orders(client=client)
+        self.assertEqual(results[0].status_code, None)
+        self.assertEqual(results[0].attempts, 3)
+        self.assertEqual(Transaction.objects.get(txn_type=Transaction.DEBIT).status, 'ERROR')
+
+    def test_skips_other_statuses(self):
+        authorization = self.create_authorized_orders(1)[0]
+        order = authorization.source.order
+        order.status = 'Pending'
+        order.save()
+        self.assertEqual(list(capture.get_authorizations()), [])
@@ -1,25 +1,45 @@
 from bs4 import BeautifulSoup
-from cybersource.constants import CHECKOUT_BASKET_ID, CHECKOUT_ORDER_NUM, CHECKOUT_SHIPPING_CODE, CHECKOUT_ORDER_ID
+from cybersource.constants import CHECKOUT_BASKET_ID, CHECKOUT_ORDER_NUM, CHECKOUT_SHIPPING_CODE, CHECKOUT_ORDER_ID, CHECKOUT_PRIMARY_UNTIL, CHECKOUT_TOKEN_AUTH_ORDER_NUM
+from cybersource import lookups, settings, tracing
+from cybersource.models import CyberSourceReply, PaymentToken
+from cybersource.serializers import CheckoutSerializer, ReplyCheckoutSerializer
 from cybersource.tests import factories as cs_factories
+from cybersource.tests.servers import StandInServer
+from cybersource.views import CyberSourceReplyView
 from decimal import Decimal as D
+from django.contrib.auth.models import AnonymousUser, User
 from django.core import mail
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from mock import patch
 from oscar.core.loading import get_class, get_model
 from oscar.test import factories
 from random import randrange
 from rest_framework.test import APITestCase
+import base64
 import datetime
+import json
 import requests # Needed for external calls!
+import time
 
 Basket = get_model('basket', 'Basket')
 Product = get_model('catalogue', 'Product')
 Order = get_model('order', 'Order')
+Transaction = get_model('payment', 'Transaction')
 
 
 class BaseCheckoutTest(APITestCase):
     fixtures = ['cybersource-test.yaml']
 
+    def setUp(self):
+        # Cached lookups may refer to rows rolled back at the end of the previous test
+        lookups.clear_all()
+        # Don't let decline counters leak between tests
+        cache.clear()
+
     def create_product(self, price=D('10.00')):
         product = factories.create_product(
             title='My Product',
@@ -285,6 +305,35 @@ class CheckoutIntegrationTest(BaseCheckoutTest):
         self.check_finished_order(cs_data['reference_number'], product.id)
 
 
+    @patch('cybersource.settings.TRACING_EXPORTER', 'cybersource.tracing.InMemorySpanExporter')
+    def test_checkout_process_traced(self):
+        """Sign and reply spans should share a trace and measure the whole authorization"""
+        tracing.get_exporter().clear()
+        product = self.create_product()
+        res = self.do_get_basket()
+        basket_id = res.data['id']
+        self.do_add_to_basket(product.id)
+
+        cs_url, cs_data = self.do_sign_auth_request(basket_id)
+        res = self.do_cybersource_post(cs_url, cs_data)
+        self.assertEqual(res.status_code, 302)
+
+        spans = tracing.get_exporter().get_finished_spans()
+        names = [s.name for s in spans]
+        for name in ('cybersource.sign', 'sign.validate', 'sign.freeze_basket', 'sign.build_request',
+                     'cybersource.reply', 'reply.verify', 'reply.log', 'reply.place_order',
+                     'reply.record_payment', 'cybersource.authorization'):
+            self.assertIn(name, names)
+        trace_id = tracing.trace_id_for(cs_data['reference_number'])
+        for s in spans:
+            self.assertEqual(s.trace_id, trace_id)
+        sign = spans[names.index('cybersource.sign')]
+        self.assertEqual(sign.attributes['transaction_uuid'], cs_data['transaction_uuid'])
+        authorization = spans[names.index('cybersource.authorization')]
+        self.assertEqual(authorization.attributes['decision'], 'ACCEPT')
+        self.assertLessEqual(authorization.start_time, sign.end_time)
+
+
 
 class CSReplyViewTest(BaseCheckoutTest):
     """Test the CybersourceReplyView with fixtured requests"""
@@ -325,6 +374,27 @@ class CSReplyViewTest(BaseCheckoutTest):
         self.assertEqual(Order.objects.count(), 0, 'Should not make order')
 
 
+    @patch('django_statsd.clients.statsd.incr')
+    def test_forged_reply_rejected_without_queries(self, statsd_incr):
+        """Unsigned or badly signed replies should be rejected before touching the session or database"""
+        session, basket_id, order_number = self.prepare_basket()
+        url = reverse('cybersource-reply')
+
+        data = cs_factories.build_accepted_reply_data(order_number)
+        with self.assertNumQueries(0):
+            resp = self.client.post(url, data)
+        self.assertEqual(resp.status_code, 400)
+        statsd_incr.assert_called_with('checkout.cybersource-reply.rejected.unsigned')
+
+        data = cs_factories.sign_reply_data(data)
+        data['req_amount'] = '0.01'
+        with self.assertNumQueries(0):
+            resp = self.client.post(url, data)
+        self.assertEqual(resp.status_code, 400)
+        statsd_incr.assert_called_with('checkout.cybersource-reply.rejected.bad-signature')
+        self.assertEqual(Order.objects.count(), 0)
+
+
     @patch('cybersource.signals.order_placed.send')
     def test_invalid_request_type(self, order_placed):
         """Bad request type should result in 400 Bad Request"""
@@ -407,6 +477,21 @@ class CSReplyViewTest(BaseCheckoutTest):
         self.assertEqual(Order.objects.count(), 0, 'Should not make order')
 
 
+    @patch('cybersource.views.CyberSourceReplyView._build_checkout_data')
+    def test_declined_card_skips_checkout_work(self, build_checkout_data):
+        """Declined card should thaw the basket without building or validating the checkout data"""
+        session, basket_id, order_number = self.prepare_basket()
+        Basket.objects.filter(id=basket_id).update(status=Basket.FROZEN)
+        data = cs_factories.build_declined_reply_data(order_number)
+        data = cs_factories.sign_reply_data(data)
+        url = reverse('cybersource-reply')
+
+        resp = self.client.post(url, data)
+        self.assertRedirects(resp, reverse('checkout:index'), fetch_redirect_response=False)
+        self.assertEqual(build_checkout_data.call_count, 0)
+        self.assertEqual(Basket.objects.get(id=basket_id).status, Basket.OPEN)
+
+
     @patch('cybersource.signals.order_placed.send')
     def test_success(self, order_placed):
         """Successful authorization should create an order and redirect to the success page"""
@@ -429,6 +514,7 @@ class CSReplyViewTest(BaseCheckoutTest):
 
         session = self.client.session
         self.assertEquals(session[CHECKOUT_ORDER_ID], order.id, 'Should save order_id in session')
+        self.assertGreater(session[CHECKOUT_PRIMARY_UNTIL], time.time(), 'Should read the thank-you page from the primary')
 
         self.assertEqual(order.sources.count(), 1, 'Should save pPaymentSource')
         source = order.sources.first()
@@ -555,3 +641,352 @@ class AuthPaymentFormViewTest(BaseCheckoutTest):
         self.assertEquals(data['ship_to_phone'], '17174671111')
         self.assertEquals(data['ship_to_surname'], 'fad')
         self.assertEquals(data['transaction_type'], 'authorization,create_payment_token')
+
+
+    def test_repeated_sign_request_writes_nothing(self):
+        basket_id = self.prepare_basket()
+        self.do_sign_auth_request(basket_id=basket_id)
+
+        # The basket is already frozen and the session already holds the same values
+        with CaptureQueriesContext(connection) as queries:
+            self.do_sign_auth_request(basket_id=basket_id)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].lstrip().upper().startswith('UPDATE')]
+        self.assertEqual(updates, [])
+
+        session = self.client.session
+        self.assertEqual(session[CHECKOUT_BASKET_ID], basket_id)
+        self.assertFalse(Basket.objects.get(id=basket_id).can_be_edited)
+
+
+    @patch('cybersource.settings.DECLINE_THROTTLE_LIMIT', 2)
+    def test_throttle_after_declines(self):
+        basket_id = self.prepare_basket()
+        for i in range(2):
+            order_number = '1000004%s' % i
+            session = self.client.session
+            session[CHECKOUT_BASKET_ID] = basket_id
+            session[CHECKOUT_ORDER_NUM] = order_number
+            session.save()
+            data = cs_factories.build_declined_reply_data(order_number)
+            data = cs_factories.sign_reply_data(data)
+            resp = self.client.post(reverse('cybersource-reply'), data)
+            self.assertRedirects(resp, reverse('checkout:index'), fetch_redirect_response=False)
+
+        url = reverse('cybersource-sign-auth-request')
+        data = {
+            "guest_email": "herp@example.com",
+            "basket": reverse('basket-detail', args=[basket_id]),
+        }
+        res = self.client.post(url, data, format='json')
+        self.assertEqual(res.status_code, 429)
+
+
+
+class ReplyCheckoutSerializerTest(BaseCheckoutTest):
+    """Test the ReplyCheckoutSerializer used by CyberSourceReplyView"""
+
+    def build_request(self, order_number):
+        data = cs_factories.build_accepted_reply_data(order_number)
+        request = RequestFactory().post(reverse('cybersource-reply'), data)
+        request.user = AnonymousUser()
+        request.session = {CHECKOUT_SHIPPING_CODE: 'free-shipping'}
+        request.data = data
+        return request
+
+    def test_fewer_queries_than_hyperlinks(self):
+        product = self.create_product()
+        basket = factories.create_basket(empty=True)
+        basket.add_product(product)
+        request = self.build_request('10000042')
+        context = {'request': request}
+
+        # Baseline: build hyperlinks and let the serializer resolve them back into models
+        data = CyberSourceReplyView()._build_checkout_data(request, basket)
+        data['basket'] = reverse('basket-detail', args=(basket.id, ))
+        data['shipping_address']['country'] = reverse('country-detail', args=('US', ))
+        data['billing_address']['country'] = reverse('country-detail', args=('US', ))
+        with CaptureQueriesContext(connection) as hyperlinked_queries:
+            ser = CheckoutSerializer(data=data, context=context)
+            self.assertTrue(ser.is_valid(), ser.errors)
+
+        # Pass the already loaded basket and countries directly
+        with CaptureQueriesContext(connection) as direct_queries:
+            data = CyberSourceReplyView()._build_checkout_data(request, basket)
+            ser = ReplyCheckoutSerializer(data=data, context=context)
+            self.assertTrue(ser.is_valid(), ser.errors)
+
+        self.assertEqual(ser.validated_data['basket'], basket)
+        self.assertEqual(ser.validated_data['shipping_address']['country'].code, 'US')
+        self.assertEqual(ser.validated_data['billing_address']['country'].code, 'US')
+        self.assertLess(len(direct_queries), len(hyperlinked_queries))
+
+    def test_rejects_missing_country(self):
+        product = self.create_product()
+        basket = factories.create_basket(empty=True)
+        basket.add_product(product)
+        request = self.build_request('10000042')
+        request.data['req_ship_to_address_country'] = 'XX'
+
+        data = CyberSourceReplyView()._build_checkout_data(request, basket)
+        ser = ReplyCheckoutSerializer(data=data, context={'request': request})
+        self.assertFalse(ser.is_valid())
+        self.assertIn('shipping_address', ser.errors)
+
+    def place_order(self, num_lines):
+        basket = factories.create_basket(empty=True)
+        for i in range(num_lines):
+            basket.add_product(self.create_product(), quantity=(i % 3) + 1)
+        order_number = str(10000000 + num_lines)
+        request = self.build_request(order_number)
+        data = CyberSourceReplyView()._build_checkout_data(request, basket)
+        ser = ReplyCheckoutSerializer(data=data, context={'request': request})
+        ser.order_number = order_number
+        self.assertTrue(ser.is_valid(), ser.errors)
+        with CaptureQueriesContext(connection) as queries:
+            order = ser.save()
+        return order, len(queries)
+
+    def test_bulk_line_creation(self):
+        order, num_queries = self.place_order(20)
+        lines = list(order.lines.select_related('stockrecord').prefetch_related('prices'))
+        self.assertEqual(len(lines), 20)
+        for line in lines:
+            self.assertEqual(line.stockrecord.product_id, line.product_id)
+            self.assertEqual(line.stockrecord.num_allocated, line.quantity)
+            prices = list(line.prices.all())
+            self.assertEqual(len(prices), 1)
+            self.assertEqual(prices[0].quantity, line.quantity)
+            self.assertEqual(prices[0].price_incl_tax * line.quantity, line.line_price_incl_tax)
+
+    def test_query_count_flat_in_line_count(self):
+        small, small_queries = self.place_order(1)
+        large, large_queries = self.place_order(50)
+        self.assertEqual(large.lines.count(), 50)
+        self.assertEqual(large_queries, small_queries)
+
+
+
+class TokenAuthorizePaymentViewTest(BaseCheckoutTest):
+    """Test the TokenAuthorizePaymentView"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('bob', 'bob@example.com', 'password')
+        self.client.login(username='bob', password='password')
+        log = CyberSourceReply.objects.create(user=self.user, data=cs_factories.build_accepted_reply_data('10000001'))
+        self.token = PaymentToken.objects.create(log=log, token='4600379961546299901519',
+            masked_card_number='xxxxxxxxxxxx1111', card_type='001')
+
+        self.response = None
+        self.server = StandInServer(self.respond).start()
+        self.addCleanup(self.server.stop)
+        for name, value in (('REST_ENDPOINT', self.server.endpoint),
+                            ('REST_KEY_ID', 'test-key'),
+                            ('REST_SHARED_SECRET', base64.b64encode(b'token-test-secret').decode())):
+            patcher = patch('cybersource.settings.%s' % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def respond(self, path, headers, body):
+        if self.response:
+            return self.response
+        return 201, {
+            'id': '4609794713436306201519',
+            'status': 'AUTHORIZED',
+            'submitTimeUtc': '2016-04-07T14:06:37Z',
+            'processorInformation': {'approvalCode': '888888', 'avs': {'code': 'X'}},
+            'orderInformation': {'amountDetails': {
+                'authorizedAmount': body['orderInformation']['amountDetails']['totalAmount'],
+                'currency': 'USD',
+            }},
+        }
+
+    def prepare_basket(self):
+        product = self.create_product()
+        res = self.do_get_basket()
+        self.assertEqual(res.status_code, 200)
+        basket_id = res.data['id']
+        res = self.do_add_to_basket(product.id)
+        self.assertEqual(res.status_code, 200)
+        return product, basket_id
+
+    def do_token_auth_request(self, basket_id, token=None):
+        data = {
+            "basket": reverse('basket-detail', args=[basket_id]),
+            "payment_token": token or self.token.token,
+            "shipping_address": {
+                "first_name": "fadsf",
+                "last_name": "fad",
+                "line1": "234 5th Ave",
+                "line4": "Manhattan",
+                "postcode": "10001",
+                "state": "NY",
+                "country": reverse('country-detail', args=['US']),
+                "phone_number": "+1 (717) 467-1111",
+            }
+        }
+        return self.client.post(reverse('cybersource-token-auth-request'), data, format='json')
+
+    def test_success(self):
+        product, basket_id = self.prepare_basket()
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 200, res.data)
+
+        self.check_finished_order(res.data['order_number'], product.id)
+        order = Order.objects.get()
+        self.assertEqual(self.client.session[CHECKOUT_ORDER_ID], order.id)
+        transaction = Transaction.objects.get()
+        self.assertEqual(transaction.reference, '4609794713436306201519')
+        self.assertEqual(transaction.token, self.token)
+        self.assertEqual(transaction.log.user, self.user)
+        self.assertEqual(transaction.log_field('decision'), 'ACCEPT')
+        self.assertEqual(transaction.log_field('auth_code'), '888888')
+
+        # A single server-side request authorized the stored token
+        self.assertEqual(len(self.server.requests), 1)
+        path, headers, body = self.server.requests[0]
+        self.assertEqual(path, '/pts/v2/payments')
+        body = json.loads(body.decode('utf-8'))
+        self.assertEqual(body['clientReferenceInformation']['code'], order.number)
+        self.assertEqual(body['paymentInformation']['customer']['customerId'], self.token.token)
+        self.assertEqual(body['orderInformation']['amountDetails'], {'totalAmount': '10.00', 'currency': 'USD'})
+        self.assertEqual(body['orderInformation']['shipTo']['phoneNumber'], '17174671111')
+
+    def test_declined(self):
+        product, basket_id = self.prepare_basket()
+        self.response = (201, {
+            'id': '4609794713436306201520',
+            'status': 'DECLINED',
+            'errorInformation': {'reason': 'PROCESSOR_DECLINED', 'message': 'Decline - General decline of the card.'},
+        })
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 402)
+        self.assertEqual(res.data['decision'], 'DECLINE')
+        self.assertEqual(res.data['reason_code'], '203')
+
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertTrue(Basket.objects.get(id=basket_id).can_be_edited)
+        log = CyberSourceReply.objects.latest('id')
+        self.assertEqual(log.data['decision'], 'DECLINE')
+        self.assertEqual(log.data['errorInformation_reason'], 'PROCESSOR_DECLINED')
+
+    @patch('cybersource.settings.TOKEN_AUTH_TIMEOUT', (1, 0.2))
+    def test_timeout_not_retried(self):
+        product, basket_id = self.prepare_basket()
+
+        def slow(path, headers, body):
+            time.sleep(0.5)
+            return 201, {'status': 'AUTHORIZED'}
+        self.server.responder = slow
+
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 504)
+        self.assertEqual(res.data['decision'], 'ERROR')
+        self.assertEqual(res.data['reason_code'], '151')
+        self.assertEqual(res.data['message'], settings.PAYMENT_UNKNOWN_ERROR)
+        self.assertEqual(Order.objects.count(), 0)
+        time.sleep(0.5)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # The card may have been authorized, so the basket stays frozen and a retry reuses the order number
+        self.assertFalse(Basket.objects.get(id=basket_id).can_be_edited)
+        order_number = self.client.session[CHECKOUT_TOKEN_AUTH_ORDER_NUM]
+        self.server.responder = self.respond
+        self.response = (400, {
+            'status': 'INVALID_REQUEST',
+            'reason': 'DUPLICATE_REQUEST',
+            'message': 'Duplicate order',
+        })
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 504)
+        self.assertEqual(res.data['reason_code'], '104')
+        path, headers, body = self.server.requests[1]
+        self.assertEqual(json.loads(body.decode('utf-8'))['clientReferenceInformation']['code'], order_number)
+        self.assertFalse(Basket.objects.get(id=basket_id).can_be_edited)
+
+    def test_error(self):
+        product, basket_id = self.prepare_basket()
+        self.response = (400, {'status': 'INVALID_REQUEST', 'reason': 'MISSING_FIELD', 'message': 'Missing field'})
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 502)
+        self.assertEqual(res.data['reason_code'], '101')
+        self.assertTrue(Basket.objects.get(id=basket_id).can_be_edited)
+        self.assertNotIn(CHECKOUT_TOKEN_AUTH_ORDER_NUM, self.client.session)
+
+    def test_leaves_secure_acceptance_order_number(self):
+        product, basket_id = self.prepare_basket()
+        session = self.client.session
+        session[CHECKOUT_ORDER_NUM] = '10000042'
+        session.save()
+
+        # A duplicate of a Secure Acceptance request is an ordinary error, and its order number is kept
+        self.response = (400, {'status': 'INVALID_REQUEST', 'reason': 'DUPLICATE_REQUEST', 'message': 'Duplicate order'})
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 502)
+        self.assertTrue(Basket.objects.get(id=basket_id).can_be_edited)
+        self.assertEqual(self.client.session[CHECKOUT_ORDER_NUM], '10000042')
+        path, headers, body = self.server.requests[0]
+        self.assertNotEqual(json.loads(body.decode('utf-8'))['clientReferenceInformation']['code'], '10000042')
+
+    def test_review_reversed(self):
+        product, basket_id = self.prepare_basket()
+        review = (201, {'id': '4609794713436306201521', 'status': 'AUTHORIZED_PENDING_REVIEW'})
+
+        def respond(path, headers, body):
+            if path.endswith('/reversals'):
+                return 201, {'id': '4609794713436306201599', 'status': 'REVERSED'}
+            return review
+        self.server.responder = respond
+
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 402)
+        self.assertEqual(res.data['decision'], 'REVIEW')
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertTrue(Basket.objects.get(id=basket_id).can_be_edited)
+        self.assertEqual([path for path, headers, body in self.server.requests],
+            ['/pts/v2/payments', '/pts/v2/payments/4609794713436306201521/reversals'])
+
+    def test_reversed_when_order_placement_fails(self):
+        product, basket_id = self.prepare_basket()
+        reversed_response = (201, {'id': '4609794713436306201599', 'status': 'REVERSED'})
+
+        def respond(path, headers, body):
+            if path.endswith('/reversals'):
+                return reversed_response
+            return self.respond(path, headers, body)
+        self.server.responder = respond
+
+        with patch('cybersource.serializers.CheckoutSerializer.save', side_effect=RuntimeError('Boom')):
+            res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertTrue(Basket.objects.get(id=basket_id).can_be_edited)
+
+        self.assertEqual(len(self.server.requests), 2)
+        path, headers, body = self.server.requests[1]
+        self.assertEqual(path, '/pts/v2/payments/4609794713436306201519/reversals')
+        body = json.loads(body.decode('utf-8'))
+        self.assertEqual(body['reversalInformation']['amountDetails'], {'totalAmount': '10.00'})
+        log = CyberSourceReply.objects.latest('id')
+        self.assertEqual(log.data['req_transaction_type'], 'authorization_reversal')
+        self.assertEqual(log.data['decision'], 'ACCEPT')
+
+    def test_other_users_token(self):
+        product, basket_id = self.prepare_basket()
+        other = User.objects.create_user('alice', 'alice@example.com', 'password')
+        log = CyberSourceReply.objects.create(user=other, data={})
+        token = PaymentToken.objects.create(log=log, token='4600379961546299901520',
+            masked_card_number='xxxxxxxxxxxx1111', card_type='001')
+
+        res = self.do_token_auth_request(basket_id, token=token.token)
+        self.assertEqual(res.status_code, 406)
+        self.assertEqual(self.server.requests, [])
+        self.assertTrue(Basket.objects.get(id=basket_id).can_be_edited)
+
+    def test_requires_login(self):
+        product, basket_id = self.prepare_basket()
+        self.client.logout()
+        res = self.do_token_auth_request(basket_id)
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(self.server.requests, [])
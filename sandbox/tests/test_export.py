@@ -0,0 +1,93 @@
+from cybersource import export
+from cybersource.tests.factories import create_transaction
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from io import StringIO
+from oscar.test import factories
+import csv
+import json
+import tracemalloc
+
+
+class TransactionExportTest(TestCase):
+    def create_transactions(self, count):
+        order = factories.create_order()
+        return [create_transaction(order) for i in range(count)]
+
+    def export_peak_memory(self, batch_size):
+        tracemalloc.start()
+        try:
+            for chunk in export.iter_csv(export.iter_transaction_rows(batch_size=batch_size)):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_rows(self):
+        transactions = self.create_transactions(3)
+        rows = list(export.iter_transaction_rows(batch_size=2))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual([row['id'] for row in rows], [t.id for t in transactions])
+        self.assertEqual(rows[0]['reference'], transactions[0].reference)
+        self.assertEqual(rows[0]['token'], transactions[0].token.token)
+        self.assertEqual(rows[0]['card_type'], '001')
+        self.assertEqual(rows[0]['decision'], 'ACCEPT')
+        self.assertEqual(rows[0]['auth_code'], '888888')
+        self.assertEqual(rows[0]['currency'], 'USD')
+
+    def test_date_filter(self):
+        self.create_transactions(2)
+        self.assertEqual(len(list(export.iter_transaction_rows(start='2000-01-01'))), 2)
+        self.assertEqual(len(list(export.iter_transaction_rows(end='2000-01-01'))), 0)
+
+    def test_command_csv(self):
+        transactions = self.create_transactions(2)
+        out = StringIO()
+        call_command('cybersource_export_transactions', stdout=out)
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['reference'], transactions[1].reference)
+        self.assertEqual(rows[1]['amount'], '99.99')
+
+    def test_command_jsonl(self):
+        transactions = self.create_transactions(2)
+        out = StringIO()
+        call_command('cybersource_export_transactions', format='jsonl', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['id'], transactions[0].id)
+        self.assertEqual(rows[0]['amount'], '99.99')
+
+    def test_view_requires_staff(self):
+        url = reverse('cybersource-export-transactions')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 302)
+
+    def test_view_streams(self):
+        self.create_transactions(2)
+        User.objects.create_user('admin', 'admin@example.com', 'password', is_staff=True)
+        self.client.login(username='admin', password='password')
+
+        url = reverse('cybersource-export-transactions')
+        resp = self.client.get(url, {'format': 'jsonl', 'start': '2000-01-01'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(resp.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+
+        resp = self.client.get(url, {'format': 'xml'})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(url, {'start': 'yesterday'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_constant_memory(self):
+        self.create_transactions(50)
+        small_peak = self.export_peak_memory(batch_size=25)
+        self.create_transactions(350)
+        large_peak = self.export_peak_memory(batch_size=25)
+
+        # Memory use is bounded by the batch size, not by the number of exported rows
+        self.assertLess(large_peak, small_peak * 2)
@@ -1,6 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import Client, TestCase, override_settings
+from cybersource.tests import factories as cs_factories
+from cybersource.tests.benchmark import benchmark
+from urllib.parse import parse_qs, urlparse
+import time
+import uuid
 
 
 class FingerprintRedirectViewTest(TestCase):
@@ -64,3 +70,78 @@ class FingerprintRedirectViewTest(TestCase):
         url = reverse('cybersource-fingerprint-redirect', args=['something'])
         response = self.client.get(url)
         self.assertEqual(response.status_code, 404)
+
+    def test_concurrent_requests_share_id(self):
+        session = self.client.session
+        session['foo'] = 'bar'
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+        self.client.get(reverse('cybersource-fingerprint-redirect', args=['img-1']))
+        first_id = self.client.session['cybersource_fingerprint_session_id']
+
+        # Simulate a second request which loaded the session before the first one saved it
+        session = self.client.session
+        del session['cybersource_fingerprint_session_id']
+        session.save()
+        self.client.get(reverse('cybersource-fingerprint-redirect', args=['js']))
+        self.assertEqual(self.client.session['cybersource_fingerprint_session_id'], first_id)
+
+    def test_fresh_session(self):
+        self.client.get(reverse('cybersource-fingerprint-redirect', args=['img-1']))
+        session = self.client.session
+        self.assertIsNotNone(session.session_key)
+        self.assertEqual(session['cybersource_fingerprint_session_id'],
+            str(uuid.uuid5(uuid.NAMESPACE_URL, 'cybersource-fingerprint:%s' % session.session_key)))
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cache')
+    def test_concurrent_requests(self):
+        # Cached sessions, so that the request threads see the session without the test's transaction
+        session = self.client.session
+        session['foo'] = 'bar'
+        session.save()
+
+        def fetch(url_type):
+            client = Client()
+            client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+            return client.get(reverse('cybersource-fingerprint-redirect', args=[url_type]))
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(fetch, ['img-1', 'img-2', 'flash', 'js'] * 5))
+        self.assertEqual({r.status_code for r in responses}, {302})
+        session_ids = {parse_qs(urlparse(r.url).query)['session_id'][0] for r in responses}
+        self.assertEqual(len(session_ids), 1)
+
+
+@benchmark
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class LightweightViewThroughputTest(TestCase):
+    """
+    Compare sequential and threaded throughput of the views which do no database work: the fingerprint
+    redirect (with cookie based sessions) and the rejection of unsigned CyberSource replies.
+    """
+    num_requests = 200
+
+    def _fingerprint(self, i):
+        return Client().get(reverse('cybersource-fingerprint-redirect', args=['img-1'])).status_code
+
+    def _forged_reply(self, i):
+        data = cs_factories.build_accepted_reply_data('10000042')
+        return Client().post(reverse('cybersource-reply'), data).status_code
+
+    def _measure(self, fn, workers):
+        start = time.perf_counter()
+        if workers == 1:
+            codes = [fn(i) for i in range(self.num_requests)]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                codes = list(executor.map(fn, range(self.num_requests)))
+        return codes, self.num_requests / (time.perf_counter() - start)
+
+    def test_throughput(self):
+        for name, fn, expected_status in (('Fingerprint redirect', self._fingerprint, 302),
+                                          ('Forged reply rejection', self._forged_reply, 400)):
+            for workers in (1, 8):
+                codes, rate = self._measure(fn, workers)
+                self.assertEqual(set(codes), {expected_status})
+                print('\n%s: %d requests, %d worker(s), %.0f req/s' % (name, self.num_requests, workers, rate))
@@ -0,0 +1,97 @@
+from cybersource.tests.benchmark import benchmark
+from django.test import SimpleTestCase
+import json
+import os
+import subprocess
+import sys
+
+SANDBOX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(SANDBOX_DIR)
+
+# Import the URLs in a fresh interpreter, the way a worker or management command does on startup
+IMPORT_SCRIPT = """
+import django
+import json
+import sys
+import time
+django.setup()
+
+# Record the calls this package makes to Oscar's class loader while it's imported
+from oscar.core import loading
+loader_calls = []
+
+def recording(loader):
+    def wrapped(*args):
+        if sys._getframe(1).f_globals.get('__name__', '').startswith('cybersource'):
+            loader_calls.append(list(args))
+        return loader(*args)
+    return wrapped
+
+loading.get_class = recording(loading.get_class)
+loading.get_model = recording(loading.get_model)
+
+start = time.perf_counter()
+import cybersource.urls
+elapsed = time.perf_counter() - start
+
+from cybersource import views
+from cybersource.loading import LazyClass
+settings = sys.modules['cybersource.settings']
+print(json.dumps({
+    'elapsed': elapsed,
+    'resolved_settings': sorted(name for name in settings._settings if name in settings.__dict__),
+    'resolved_classes': sorted(name for name, value in vars(views).items()
+                               if isinstance(value, LazyClass) and value._class is not None),
+    'loader_calls': sorted(loader_calls),
+}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Parse ``python -X importtime`` output into {module: (self_us, cumulative_us)}.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+class ImportTimeTest(SimpleTestCase):
+    def import_urls(self, importtime=False):
+        # -X importtime needs Python 3.7. Older versions only get the total.
+        args = [sys.executable]
+        if importtime and sys.version_info >= (3, 7):
+            args += ['-X', 'importtime']
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [SANDBOX_DIR, REPO_DIR, env.get('PYTHONPATH')]))
+        proc = subprocess.Popen(args + ['-c', IMPORT_SCRIPT], cwd=SANDBOX_DIR, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0, stderr)
+        return json.loads(stdout.strip().splitlines()[-1]), parse_importtime(stderr)
+
+    def test_import_urls(self):
+        result, times = self.import_urls()
+
+        # Nothing is resolved until a request or command uses it
+        self.assertEqual(result['resolved_settings'], [])
+        self.assertEqual(result['resolved_classes'], [])
+        # Only the classes this package subclasses go through Oscar's loader
+        self.assertEqual(result['loader_calls'], [
+            ['checkout.mixins', 'OrderPlacementMixin'],
+            ['order.utils', 'OrderCreator'],
+        ])
+
+    @benchmark
+    def test_import_time(self):
+        result, times = self.import_urls(importtime=True)
+        print('\nImport cybersource.urls: %.1fms' % (result['elapsed'] * 1000))
+        slowest = sorted(((self_us, name) for name, (self_us, cumulative_us) in times.items()
+                          if name.startswith('cybersource')), reverse=True)[:5]
+        for self_us, name in slowest:
+            print('    %s: %.1fms self, %.1fms cumulative' % (name, self_us / 1000, times[name][1] / 1000))
@@ -0,0 +1,56 @@
+from cybersource import indexes
+from cybersource.models import CyberSourceReply
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from io import StringIO
+from oscar.core.loading import get_model
+from mock import patch
+
+Transaction = get_model('payment', 'Transaction')
+
+
+class IndexesTest(TestCase):
+    def drop_index(self, model, field_name):
+        opts = model._meta
+        column = opts.get_field(field_name).column
+        with connection.cursor() as cursor:
+            for name, constraint in connection.introspection.get_constraints(cursor, opts.db_table).items():
+                if constraint['index'] and constraint['columns'] and constraint['columns'][0] == column:
+                    cursor.execute('DROP INDEX %s' % connection.ops.quote_name(name))
+
+    def test_migrations_create_indexes(self):
+        self.assertEqual(indexes.find_missing_indexes(), [])
+        out = StringIO()
+        call_command('cybersource_check_indexes', stdout=out)
+        self.assertIn('All indexes exist', out.getvalue())
+
+    def test_reports_missing_index(self):
+        self.drop_index(Transaction, 'request_token')
+        self.drop_index(CyberSourceReply, 'date_created')
+        missing = indexes.find_missing_indexes()
+        self.assertEqual(sorted((m.table, m.column) for m in missing), [
+            (CyberSourceReply._meta.db_table, 'date_created'),
+            (Transaction._meta.db_table, 'request_token'),
+        ])
+        for index in missing:
+            self.assertIn('CREATE INDEX CONCURRENTLY', index.sql)
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('cybersource_check_indexes', stdout=out)
+        self.assertIn('Missing btree index on %s.request_token' % Transaction._meta.db_table, out.getvalue())
+
+    def test_create_index_skips_existing(self):
+        operation = indexes.create_index('payment', 'Transaction', 'request_token')
+        with connection.schema_editor() as editor:
+            with patch.object(editor, 'execute') as execute:
+                operation.code(apps, editor)
+        self.assertFalse(execute.called)
+
+        self.drop_index(Transaction, 'request_token')
+        with connection.schema_editor() as editor:
+            operation.code(apps, editor)
+        self.assertEqual(indexes.find_missing_indexes(), [])
@@ -0,0 +1,93 @@
+from cybersource import actions
+from decimal import Decimal
+from django.test import TestCase
+from mock import MagicMock, patch
+import json
+
+
+def build_basket(num_lines):
+    lines = []
+    for i in range(num_lines):
+        line = MagicMock()
+        line.product.title = 'Product %s' % i
+        line.stockrecord.partner_sku = 'SKU-%05d' % i
+        line.quantity = (i % 3) + 1
+        line.unit_price_incl_tax = Decimal('1.00') + i
+        line.line_price_incl_tax = line.unit_price_incl_tax * line.quantity
+        lines.append(line)
+    basket = MagicMock()
+    basket.all_lines.return_value = lines
+    return basket
+
+
+def build_action(basket):
+    total = MagicMock()
+    total.currency = 'USD'
+    total.incl_tax = sum(line.line_price_incl_tax for line in basket.all_lines())
+    return actions.CreateAndAuthorizePaymentToken(
+        order_number='10000042',
+        order_total=total,
+        basket=basket,
+        customer_ip_address='127.0.0.1',
+        extra_fields={})
+
+
+def item_total(fields):
+    count = int(fields['line_item_count'])
+    return sum(Decimal(fields['item_%s_unit_price' % i]) * int(fields['item_%s_quantity' % i]) for i in range(count))
+
+
+class LineItemStrategyTest(TestCase):
+    def test_full(self):
+        basket = build_basket(5)
+        items = list(actions.FullLineItems().line_items(basket))
+        self.assertEqual(len(items), 5)
+        self.assertEqual(items[0], ('Product 0', 'SKU-00000', 1, Decimal('1.00')))
+
+    def test_top_small_basket(self):
+        basket = build_basket(5)
+        self.assertEqual(list(actions.TopLineItems(10).line_items(basket)), list(actions.FullLineItems().line_items(basket)))
+
+    def test_top_rolls_up_the_rest(self):
+        basket = build_basket(200)
+        items = list(actions.TopLineItems(10).line_items(basket))
+        self.assertEqual(len(items), 10)
+        # The most expensive lines come first
+        self.assertEqual(items[0][0], 'Product 197')
+        name, sku, quantity, unit_price = items[-1]
+        rolled_up = sum(line.quantity for line in basket.all_lines()) - sum(item[2] for item in items[:-1])
+        self.assertEqual(name, 'Other items (%s)' % rolled_up)
+        self.assertEqual(quantity, 1)
+        self.assertEqual(
+            sum(price * qty for name, sku, qty, price in items),
+            sum(line.line_price_incl_tax for line in basket.all_lines()))
+
+    def test_totals_only(self):
+        self.assertEqual(list(actions.TotalsOnly().line_items(build_basket(5))), [])
+
+    def test_fields(self):
+        basket = build_basket(200)
+        for strategy, count in (('full', 200), ('top', 50), ('totals', 0)):
+            with patch('cybersource.settings.LINE_ITEM_STRATEGY', strategy):
+                fields = build_action(basket).fields()
+            self.assertEqual(fields['line_item_count'], str(count))
+            self.assertEqual(fields['amount'], str(sum(line.line_price_incl_tax for line in basket.all_lines())))
+            if count:
+                self.assertEqual(item_total(fields), Decimal(fields['amount']))
+
+    @patch('cybersource.settings.LINE_ITEM_STRATEGY', 'cybersource.actions.TotalsOnly')
+    def test_dotted_path(self):
+        self.assertIsInstance(actions.get_line_item_strategy(), actions.TotalsOnly)
+
+    def test_payload_size(self):
+        basket = build_basket(200)
+        counts, sizes = {}, {}
+        for strategy in ('full', 'top', 'totals'):
+            with patch('cybersource.settings.LINE_ITEM_STRATEGY', strategy):
+                fields = build_action(basket).fields()
+            counts[strategy] = len(fields)
+            sizes[strategy] = len(json.dumps({key: value if isinstance(value, str) else value.decode() for key, value in fields.items()}))
+        self.assertLess(counts['top'], counts['full'])
+        self.assertLess(counts['totals'], counts['top'])
+        self.assertLess(sizes['top'], sizes['full'])
+        self.assertLess(sizes['totals'], sizes['top'])
@@ -0,0 +1,73 @@
+from cybersource import lookups
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+from oscar.core.loading import get_model
+
+Country = get_model('address', 'Country')
+SourceType = get_model('payment', 'SourceType')
+
+
+class LRUCacheTest(TestCase):
+    def test_get_set(self):
+        cache = lookups.LRUCache('test', maxsize=2, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_evicts_least_recently_used(self):
+        cache = lookups.LRUCache('test', maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl(self):
+        cache = lookups.LRUCache('test', maxsize=2, ttl=60)
+        with patch('time.monotonic', return_value=1000):
+            cache.set('a', 1)
+        with patch('time.monotonic', return_value=1059):
+            self.assertEqual(cache.get('a'), 1)
+        with patch('time.monotonic', return_value=1061):
+            self.assertIsNone(cache.get('a'))
+
+
+class LookupsTest(TestCase):
+    fixtures = ['cybersource-test.yaml']
+
+    def setUp(self):
+        lookups.clear_all()
+
+    def test_country(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(lookups.get_country('US').printable_name, 'United States')
+            self.assertEqual(lookups.get_country('US').printable_name, 'United States')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(lookups.stats()['countries']['hits'], 1)
+
+        with self.assertRaises(Country.DoesNotExist):
+            lookups.get_country('XX')
+
+    def test_invalidate_on_save(self):
+        country = Country.objects.get(pk='US')
+        lookups.get_country('US')
+        country.printable_name = 'USA'
+        country.save()
+        self.assertEqual(lookups.get_country('US').printable_name, 'USA')
+
+    def test_source_type(self):
+        # Newly created rows aren't cached until they're fetched again, in case the transaction rolls back
+        source_type = lookups.get_source_type('CyberSource')
+        self.assertEqual(lookups.stats()['source_types']['size'], 0)
+        self.assertEqual(lookups.get_source_type('CyberSource'), source_type)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(lookups.get_source_type('CyberSource'), source_type)
+        self.assertEqual(len(queries), 0)
+
+        SourceType.objects.filter(pk=source_type.pk).get().delete()
+        self.assertEqual(lookups.stats()['source_types']['size'], 0)
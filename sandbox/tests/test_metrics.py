@@ -0,0 +1,110 @@
+from cybersource import metrics
+from cybersource.tests import factories as cs_factories
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from mock import patch
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+
+def _increment_in_child(registry, counter, histogram):
+    for i in range(10):
+        counter.inc(decision='ACCEPT')
+    histogram.observe(0.3)
+    registry.flush()
+
+
+class RegistryTest(TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.counter = metrics.Counter('test_total', 'Test counter', ('decision', ), registry=self.registry)
+        self.histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0), registry=self.registry)
+
+    def test_render(self):
+        self.counter.inc(decision='ACCEPT')
+        self.counter.inc(decision='ACCEPT')
+        self.counter.inc(decision='DECLINE')
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+
+        text = self.registry.render()
+        self.assertIn('# TYPE test_total counter\n', text)
+        self.assertIn('test_total{decision="ACCEPT"} 2.0\n', text)
+        self.assertIn('test_total{decision="DECLINE"} 1.0\n', text)
+        self.assertIn('# TYPE test_seconds histogram\n', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0\n', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0\n', text)
+        self.assertIn('test_seconds_sum 5.55\n', text)
+        self.assertIn('test_seconds_count 3.0\n', text)
+
+    def test_label_escaping(self):
+        self.counter.inc(decision='A"B')
+        self.assertIn('test_total{decision="A\\"B"} 1.0', self.registry.render())
+
+    def test_multiprocess(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        with patch('cybersource.settings.METRICS_DIR', metrics_dir):
+            self.counter.inc(decision='ACCEPT')
+            children = [
+                multiprocessing.Process(target=_increment_in_child, args=(self.registry, self.counter, self.histogram))
+                for i in range(3)
+            ]
+            for child in children:
+                child.start()
+            for child in children:
+                child.join()
+                self.assertEqual(child.exitcode, 0)
+
+            text = self.registry.render()
+            # The files of the exited children are merged into one, and the totals stay the same
+            for child in children:
+                self.assertFalse([f for f in os.listdir(metrics_dir) if f.startswith('metrics-%s-' % child.pid)])
+            self.assertIn(metrics.AGGREGATE_FILENAME, os.listdir(metrics_dir))
+            self.assertEqual(self.registry.render(), text)
+        self.assertIn('test_total{decision="ACCEPT"} 31.0\n', text)
+        self.assertIn('test_seconds_count 3.0\n', text)
+
+    def test_recycled_pid(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        with patch('cybersource.settings.METRICS_DIR', metrics_dir):
+            # Registries started with the same pid, as a worker given the pid of an exited one would be
+            for i in range(2):
+                registry = metrics.Registry()
+                metrics.Counter('test_total', 'Test counter', ('decision', ), registry=registry).inc(decision='ACCEPT')
+                registry.flush()
+            self.assertEqual(len(os.listdir(metrics_dir)), 2)
+            text = self.registry.render()
+        self.assertIn('test_total{decision="ACCEPT"} 2.0\n', text)
+
+
+class MetricsViewTest(TestCase):
+    def test_requires_staff(self):
+        resp = self.client.get(reverse('cybersource-metrics'))
+        self.assertEqual(resp.status_code, 302)
+
+        User.objects.create_user('admin', 'admin@example.com', 'password', is_staff=True)
+        self.client.login(username='admin', password='password')
+        resp = self.client.get(reverse('cybersource-metrics'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'# TYPE cybersource_requests_total counter', resp.content)
+
+    @patch('cybersource.settings.METRICS_TOKEN', 's3cret')
+    def test_bearer_token(self):
+        resp = self.client.get(reverse('cybersource-metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(resp.status_code, 302)
+        resp = self.client.get(reverse('cybersource-metrics'), HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_signature_failures_counted(self):
+        metrics.REGISTRY.reset()
+        data = cs_factories.build_accepted_reply_data('10000042')
+        self.client.post(reverse('cybersource-reply'), data)
+        values = metrics.REGISTRY.collect()
+        self.assertEqual(values['cybersource_signature_failures_total'][('unsigned', )], 1)
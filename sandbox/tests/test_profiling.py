@@ -0,0 +1,53 @@
+from cybersource import profiling
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from io import StringIO
+from mock import patch
+import os
+import shutil
+import tempfile
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+
+    def test_should_profile(self):
+        rf = RequestFactory()
+        request = rf.get('/')
+        request.user = AnonymousUser()
+        self.assertFalse(profiling.should_profile(request))
+
+        with patch('cybersource.settings.PROFILE_DIR', self.profile_dir):
+            with patch('cybersource.settings.PROFILE_SAMPLE_RATE', 1.0):
+                self.assertTrue(profiling.should_profile(request))
+
+            # The profile header is only honored for staff users
+            request = rf.get('/', HTTP_X_CYBERSOURCE_PROFILE='1')
+            request.user = AnonymousUser()
+            self.assertFalse(profiling.should_profile(request))
+            request.user = User(username='admin', is_staff=True)
+            self.assertTrue(profiling.should_profile(request))
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'ip': '0/min'})
+    def test_profile_and_report(self):
+        url = reverse('cybersource-sign-auth-request')
+        with patch('cybersource.settings.PROFILE_DIR', self.profile_dir), \
+                patch('cybersource.settings.PROFILE_SAMPLE_RATE', 1.0), \
+                patch('cybersource.settings.PROFILE_MAX_FILES', 2):
+            for i in range(3):
+                self.client.post(url, {})
+
+        view_dir = os.path.join(self.profile_dir, 'SignAuthorizePaymentFormView')
+        self.assertEqual(len(os.listdir(view_dir)), 2)
+
+        out = StringIO()
+        call_command('cybersource_profile_report', dir=self.profile_dir, top=5, stdout=out)
+        self.assertIn('SignAuthorizePaymentFormView: 2 profiled requests', out.getvalue())
+        self.assertIn('dispatch', out.getvalue())
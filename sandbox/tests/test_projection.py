@@ -0,0 +1,75 @@
+from cybersource.models import CyberSourceReply, CyberSourceReplyArchive, PaymentToken
+from cybersource.projection import FieldProjection, get_projection
+from cybersource.tests.factories import build_accepted_reply_data
+from django.core.management import call_command
+from django.test import TestCase
+from mock import patch
+from io import StringIO
+
+
+class FieldProjectionTest(TestCase):
+    def test_default_keeps_everything(self):
+        proj = FieldProjection()
+        data = build_accepted_reply_data('S123456789')
+        kept, dropped = proj.split(data)
+        self.assertEqual(kept, data)
+        self.assertEqual(dropped, {})
+
+    def test_glob_patterns(self):
+        proj = FieldProjection(include=['req_*', 'decision', 'transaction_id'], exclude=['req_item_*'])
+        self.assertTrue(proj.keeps('req_amount'))
+        self.assertTrue(proj.keeps('decision'))
+        self.assertTrue(proj.keeps('transaction_id'))
+        self.assertFalse(proj.keeps('req_item_0_sku'))
+        self.assertFalse(proj.keeps('score_rcode'))
+        self.assertFalse(proj.keeps('decision_rcode'))
+
+    def test_split(self):
+        proj = FieldProjection(exclude=['score_*', 'utf8'])
+        data = build_accepted_reply_data('S123456789')
+        kept, dropped = proj.split(data)
+        self.assertEqual(set(kept) | set(dropped), set(data))
+        self.assertIn('utf8', dropped)
+        self.assertIn('score_rcode', dropped)
+        self.assertNotIn('score_rcode', kept)
+        self.assertEqual(kept['req_amount'], '99.99')
+
+    def test_get_projection_follows_settings(self):
+        with patch('cybersource.settings.REPLY_LOG_FIELDS_EXCLUDE', ['score_*']):
+            self.assertFalse(get_projection().keeps('score_rcode'))
+        self.assertTrue(get_projection().keeps('score_rcode'))
+
+
+class ReplyArchiveTest(TestCase):
+    def test_log_field_falls_back_to_archive(self):
+        data = build_accepted_reply_data('S123456789')
+        kept, dropped = FieldProjection(exclude=['req_bill_to_*']).split(data)
+        log = CyberSourceReply.objects.create(data=kept)
+        CyberSourceReplyArchive.objects.create(reply=log, data=CyberSourceReplyArchive.compress(dropped))
+        token = PaymentToken.objects.create(
+            log=log,
+            token=data['payment_token'],
+            masked_card_number=data['req_card_number'],
+            card_type=data['req_card_type'])
+
+        token = PaymentToken.objects.get(id=token.id)
+        self.assertEqual(token.billing_zip_code, '10001')
+        self.assertEqual(token.card_holder, 'Bob Smith')
+        self.assertEqual(token.log.archive.get_data(), dropped)
+
+    def test_log_field_without_archive(self):
+        log = CyberSourceReply.objects.create(data={'decision': 'ACCEPT'})
+        self.assertEqual(log.get_field('decision'), 'ACCEPT')
+        self.assertEqual(log.get_field('req_amount', 'missing'), 'missing')
+
+
+class ReplyFieldReportTest(TestCase):
+    def test_report(self):
+        CyberSourceReply.objects.create(data=build_accepted_reply_data('S123456789'))
+        out = StringIO()
+        with patch('cybersource.settings.REPLY_LOG_FIELDS_EXCLUDE', ['score_*']):
+            call_command('cybersource_reply_field_report', stdout=out)
+        report = out.getvalue()
+        self.assertIn('Replies inspected: 1', report)
+        self.assertIn('score_ip_city', report)
+        self.assertNotIn('Bytes saved by projection: 0 ', report)
@@ -0,0 +1,150 @@
+from cybersource import actions, reconcile
+from cybersource.models import CyberSourceReply
+from cybersource.tests.factories import create_transaction
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.core.management import call_command
+from django.test import TestCase
+from io import BytesIO, StringIO
+from oscar.core.loading import get_model
+from oscar.test import factories
+import csv
+import os
+import tempfile
+import tracemalloc
+
+Transaction = get_model('payment', 'Transaction')
+
+CSV_REPORT = '''Transaction Detail Report,1.0,"Mar 01 2016 to Mar 02 2016"
+Request ID,Merchant Reference Number,Amount,Currency,Decision
+%s
+'''
+
+XML_REPORT = '''<?xml version="1.0" encoding="utf-8"?>
+<Report xmlns="https://ebc.cybersource.com/ebc/reports/dtd/tdr_1_7.dtd" Name="Transaction Detail">
+  <Requests>
+    <Request RequestID="%(reference)s" MerchantReferenceNumber="%(order_number)s">
+      <PaymentData>
+        <Amount>%(amount)s</Amount>
+        <CurrencyCode>USD</CurrencyCode>
+      </PaymentData>
+      <ApplicationReplies>
+        <ApplicationReply Name="ics_auth">
+          <RCode>1</RCode>
+          <RFlag>%(rflag)s</RFlag>
+        </ApplicationReply>
+      </ApplicationReplies>
+    </Request>
+  </Requests>
+</Report>
+'''
+
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        order = factories.create_order()
+        self.matching, self.wrong_amount, self.wrong_status, self.unreported = [create_transaction(order) for i in range(4)]
+
+    def build_csv(self):
+        lines = [
+            '%s,%s,99.99,USD,ACCEPT' % (self.matching.reference, self.matching.source.order.number),
+            '%s,%s,100.00,USD,ACCEPT' % (self.wrong_amount.reference, self.wrong_amount.source.order.number),
+            '%s,%s,99.99,USD,DECLINE' % (self.wrong_status.reference, self.wrong_status.source.order.number),
+            '123456789,10009999,5.00,USD,ACCEPT',
+        ]
+        return CSV_REPORT % '\n'.join(lines)
+
+    def test_parse_csv(self):
+        rows = list(reconcile.iter_csv_report(StringIO(self.build_csv())))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0].reference, self.matching.reference)
+        self.assertEqual(rows[0].amount, Decimal('99.99'))
+        self.assertEqual(rows[2].status, 'DECLINE')
+
+    def test_parse_xml(self):
+        report = XML_REPORT % {'reference': '123', 'order_number': '10000042', 'amount': '12.50', 'rflag': 'DCARDREFUSED'}
+        rows = list(reconcile.iter_xml_report(BytesIO(report.encode('utf-8'))))
+        self.assertEqual(rows, [reconcile.ReportRow('123', '10000042', Decimal('12.50'), 'USD', 'DECLINE')])
+
+    def test_mismatches(self):
+        rows = reconcile.iter_csv_report(StringIO(self.build_csv()))
+        mismatches = {(m.mismatch, m.reference): m for m in reconcile.reconcile(rows, batch_size=2)}
+        self.assertEqual(set(mismatches.keys()), {
+            (reconcile.AMOUNT, self.wrong_amount.reference),
+            (reconcile.STATUS, self.wrong_status.reference),
+            (reconcile.MISSING, '123456789'),
+        })
+        amount = mismatches[(reconcile.AMOUNT, self.wrong_amount.reference)]
+        self.assertEqual(amount.report_amount, Decimal('100.00'))
+        self.assertEqual(amount.amount, Decimal('99.99'))
+        status = mismatches[(reconcile.STATUS, self.wrong_status.reference)]
+        self.assertEqual((status.report_status, status.status), ('DECLINE', 'ACCEPT'))
+
+    def test_unreported(self):
+        rows = reconcile.iter_csv_report(StringIO(self.build_csv()))
+        start = datetime.now() - timedelta(days=1)
+        mismatches = [m for m in reconcile.reconcile(rows, start=start) if m.mismatch == reconcile.UNREPORTED]
+        self.assertEqual([m.reference for m in mismatches], [self.unreported.reference])
+        self.assertEqual(mismatches[0].order_number, self.unreported.source.order.number)
+
+    def test_reversals_and_captures_without_reference(self):
+        # A token authorization reversed because its order was never placed, and a capture which failed
+        # before CyberSource assigned it a request ID
+        CyberSourceReply.objects.create(data={
+            'decision': 'ACCEPT',
+            'transaction_id': '5000000000000000000001',
+            'req_authorization_id': '5000000000000000000000',
+            'req_reference_number': '10009998',
+            'req_transaction_type': actions.ReverseAuthorization.transaction_type,
+        })
+        Transaction.objects.create(
+            log=self.matching.log,
+            source=self.matching.source,
+            txn_type=Transaction.DEBIT,
+            amount=self.matching.amount,
+            reference='',
+            status='ERROR',
+            request_token='',
+            processed_datetime=datetime.utcnow())
+
+        lines = [
+            '%s,%s,99.99,USD,ACCEPT' % (txn.reference, txn.source.order.number)
+            for txn in (self.matching, self.wrong_amount, self.wrong_status, self.unreported)
+        ] + [
+            '5000000000000000000000,10009998,99.99,USD,ACCEPT',
+            '5000000000000000000001,10009998,99.99,USD,ACCEPT',
+        ]
+        rows = reconcile.iter_csv_report(StringIO(CSV_REPORT % '\n'.join(lines)))
+        start = datetime.now() - timedelta(days=1)
+        mismatches = [(m.mismatch, m.reference) for m in reconcile.reconcile(rows, start=start)]
+        self.assertEqual(mismatches, [])
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as report:
+            report.write(self.build_csv())
+        self.addCleanup(os.remove, report.name)
+
+        out = StringIO()
+        call_command('cybersource_reconcile', report.name, stdout=out, stderr=StringIO())
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(sorted(row['mismatch'] for row in rows), [reconcile.AMOUNT, reconcile.MISSING, reconcile.STATUS])
+
+    def test_bounded_memory(self):
+        def report(count):
+            yield 'Request ID,Merchant Reference Number,Amount,Currency,Decision\n'
+            for i in range(count):
+                yield '9%012d,%d,10.00,USD,ACCEPT\n' % (i, i)
+
+        def peak(count):
+            tracemalloc.start()
+            try:
+                found = sum(1 for m in reconcile.reconcile(reconcile.iter_csv_report(report(count)), batch_size=1000))
+                self.assertEqual(found, count)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        small = peak(2000)
+        large = peak(20000)
+        # Ten times the rows shouldn't need anywhere near ten times the memory
+        self.assertLess(large, small * 3)
@@ -0,0 +1,152 @@
+from cybersource import replylog
+from cybersource.models import CyberSourceReply
+from cybersource.tests.factories import build_accepted_reply_data, build_declined_reply_data
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+class DatabaseBackendTest(TestCase):
+    def test_saves_every_reply(self):
+        backend = replylog.DatabaseBackend()
+        reply = backend.log(build_declined_reply_data('10000042'), referenced=False)
+        self.assertIsNotNone(reply.pk)
+        self.assertEqual(CyberSourceReply.objects.get().data['req_reference_number'], '10000042')
+
+    @patch('cybersource.settings.REPLY_LOG_FIELDS_EXCLUDE', ['score_*'])
+    @patch('cybersource.settings.REPLY_LOG_ARCHIVE_DROPPED', True)
+    def test_archives_dropped_fields(self):
+        data = build_accepted_reply_data('10000042')
+        data['score_host_severity'] = '1'
+        reply = replylog.DatabaseBackend().log(data)
+        self.assertNotIn('score_host_severity', reply.data)
+        self.assertEqual(reply.archive.get_data(), {'score_host_severity': '1'})
+
+    def test_get_backend_follows_settings(self):
+        self.assertIsInstance(replylog.get_backend(), replylog.DatabaseBackend)
+        with patch('cybersource.settings.REPLY_LOG_BACKEND', 'cybersource.replylog.BufferedDatabaseBackend'):
+            self.assertIsInstance(replylog.get_backend(), replylog.BufferedDatabaseBackend)
+        self.assertIs(type(replylog.get_backend()), replylog.DatabaseBackend)
+
+
+class BufferedDatabaseBackendTest(TestCase):
+    def test_referenced_replies_saved_immediately(self):
+        backend = replylog.BufferedDatabaseBackend(buffer_size=10, flush_interval=3600)
+        reply = backend.log(build_accepted_reply_data('10000042'), referenced=True)
+        self.assertEqual(CyberSourceReply.objects.get(), reply)
+
+    def fill_buffer(self, size):
+        backend = replylog.BufferedDatabaseBackend(buffer_size=size, flush_interval=3600)
+        for i in range(size - 1):
+            backend.log(build_declined_reply_data(str(10000000 + i)), referenced=False)
+        self.assertEqual(CyberSourceReply.objects.count(), 0)
+
+        # The last reply fills the buffer, which is then written out
+        with CaptureQueriesContext(connection) as queries:
+            backend.log(build_declined_reply_data(str(10000000 + size - 1)), referenced=False)
+        numbers = sorted(reply.data['req_reference_number'] for reply in CyberSourceReply.objects.all())
+        self.assertEqual(numbers, [str(10000000 + i) for i in range(size)])
+        CyberSourceReply.objects.all().delete()
+        return len(queries)
+
+    def test_buffers_unreferenced_replies(self):
+        self.assertEqual(self.fill_buffer(5), self.fill_buffer(50))
+
+    def test_flushed_after_interval(self):
+        backend = replylog.BufferedDatabaseBackend(buffer_size=10, flush_interval=0.2)
+        flushed = threading.Event()
+        with patch.object(backend, 'flush', side_effect=flushed.set):
+            backend.log(build_declined_reply_data('10000042'), referenced=False)
+            # Written out without another reply being logged
+            self.assertTrue(flushed.wait(5))
+
+    @patch('cybersource.settings.REPLY_LOG_FIELDS_EXCLUDE', ['score_*'])
+    @patch('cybersource.settings.REPLY_LOG_ARCHIVE_DROPPED', True)
+    def test_archives_dropped_fields(self):
+        backend = replylog.BufferedDatabaseBackend(buffer_size=10, flush_interval=3600)
+        data = build_declined_reply_data('10000042')
+        data['score_host_severity'] = '1'
+        reply = backend.log(data, referenced=False)
+        backend.flush()
+        saved = CyberSourceReply.objects.get()
+        self.assertEqual(saved.pk, reply.pk)
+        self.assertEqual(saved.get_field('score_host_severity'), '1')
+
+
+class FileBackendTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'replies.jsonl')
+
+    def get_backend(self, **kwargs):
+        backend = replylog.FileBackend(path=self.path, **kwargs)
+        self.addCleanup(backend.close)
+        return backend
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_only_referenced_replies_saved_to_database(self):
+        backend = self.get_backend()
+        accepted = backend.log(build_accepted_reply_data('10000042'), referenced=True)
+        backend.log(build_declined_reply_data('10000043'), referenced=False)
+        self.assertEqual(list(CyberSourceReply.objects.all()), [accepted])
+
+        records = self.read()
+        self.assertEqual([r['data']['req_reference_number'] for r in records], ['10000042', '10000043'])
+        self.assertEqual([r['reply_id'] for r in records], [accepted.pk, None])
+
+    @patch('cybersource.settings.REPLY_LOG_FIELDS_EXCLUDE', ['signature', 'req_bill_to_*'])
+    def test_projection(self):
+        backend = self.get_backend()
+        backend.log(build_declined_reply_data('10000043'), referenced=False)
+        with patch('cybersource.settings.REPLY_LOG_ARCHIVE_DROPPED', True):
+            backend.log(build_declined_reply_data('10000044'), referenced=False)
+
+        records = self.read()
+        for record in records:
+            self.assertNotIn('signature', record['data'])
+            self.assertFalse([k for k in record['data'] if k.startswith('req_bill_to_')])
+        self.assertNotIn('archived', records[0])
+        self.assertIn('signature', records[1]['archived'])
+
+    def test_fsync_batching(self):
+        backend = self.get_backend(fsync_every=10, fsync_interval=3600)
+        with patch('os.fsync') as fsync:
+            for i in range(25):
+                backend.log(build_declined_reply_data(str(i)), referenced=False)
+            self.assertEqual(fsync.call_count, 2)
+            backend.flush()
+            self.assertEqual(fsync.call_count, 3)
+        self.assertEqual(len(self.read()), 25)
+
+    def test_rotation(self):
+        backend = self.get_backend(max_bytes=4096, backup_count=2)
+        for i in range(100):
+            backend.log(build_declined_reply_data(str(i)), referenced=False)
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        for path in (self.path + '.1', self.path + '.2'):
+            self.assertLess(os.path.getsize(path), 4096 * 2)
+
+        # The newest replies are in the current file, the older ones in the backups
+        records = self.read(self.path + '.1') + (self.read() if os.path.exists(self.path) else [])
+        numbers = [r['data']['req_reference_number'] for r in records]
+        self.assertEqual(numbers[-1], '99')
+        self.assertEqual(numbers, sorted(numbers, key=int))
+
+    def test_reopens_after_external_rotation(self):
+        backend = self.get_backend()
+        backend.log(build_declined_reply_data('1'), referenced=False)
+        os.rename(self.path, self.path + '.old')
+        backend.log(build_declined_reply_data('2'), referenced=False)
+        self.assertEqual([r['data']['req_reference_number'] for r in self.read()], ['2'])
@@ -0,0 +1,105 @@
+from cybersource import export, routers
+from cybersource.admin import ReplicaChangeList
+from cybersource.constants import CHECKOUT_PRIMARY_UNTIL
+from cybersource.models import CyberSourceReply, PaymentToken, ReplyDecisionStat
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import patch
+from oscar.core.loading import get_model
+import time
+
+Order = get_model('order', 'Order')
+Transaction = get_model('payment', 'Transaction')
+
+
+class ReplicaHelpersTest(TestCase):
+    def test_without_replica(self):
+        self.assertEqual(routers.replica(CyberSourceReply.objects.all()).db, 'default')
+        self.assertEqual(export.get_transactions().db, 'default')
+
+    @patch('cybersource.settings.READ_REPLICA', 'replica')
+    def test_replica(self):
+        self.assertEqual(routers.replica(CyberSourceReply.objects.all()).db, 'replica')
+        self.assertEqual(routers.primary(CyberSourceReply.objects.all()).db, 'default')
+        self.assertEqual(export.get_transactions().db, 'replica')
+
+    @patch('cybersource.settings.READ_REPLICA', 'replica')
+    def test_pinned(self):
+        with routers.pin_to_primary():
+            with routers.pin_to_primary():
+                self.assertEqual(routers.replica(CyberSourceReply.objects.all()).db, 'default')
+            self.assertTrue(routers.is_pinned())
+        self.assertFalse(routers.is_pinned())
+        self.assertEqual(routers.replica(CyberSourceReply.objects.all()).db, 'replica')
+
+
+class ReplicaRouterTest(TestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+
+    def test_without_replica(self):
+        self.assertIsNone(self.router.db_for_read(PaymentToken))
+        self.assertIsNone(self.router.db_for_write(PaymentToken))
+        self.assertIsNone(self.router.allow_migrate('default', 'cybersource'))
+
+    @patch('cybersource.settings.READ_REPLICA', 'replica')
+    def test_routes_matching_models(self):
+        self.assertEqual(self.router.db_for_read(PaymentToken), 'replica')
+        self.assertEqual(self.router.db_for_read(ReplyDecisionStat), 'replica')
+        self.assertEqual(self.router.db_for_write(PaymentToken), 'default')
+        self.assertIsNone(self.router.db_for_read(Order))
+        self.assertIsNone(self.router.db_for_read(Transaction))
+        with routers.pin_to_primary():
+            self.assertIsNone(self.router.db_for_read(PaymentToken))
+
+    @patch('cybersource.settings.READ_REPLICA', 'replica')
+    @patch('cybersource.settings.READ_REPLICA_MODELS', ['cybersource.*', 'order.*'])
+    def test_extra_models(self):
+        self.assertEqual(self.router.db_for_read(Order), 'replica')
+        self.assertIsNone(self.router.db_for_read(Transaction))
+
+    @patch('cybersource.settings.READ_REPLICA', 'replica')
+    def test_no_migrations_on_replica(self):
+        self.assertFalse(self.router.allow_migrate('replica', 'cybersource'))
+        self.assertIsNone(self.router.allow_migrate('default', 'cybersource'))
+
+
+class ReadYourWritesMiddlewareTest(TestCase):
+    def get_request(self, primary_until=None):
+        request = RequestFactory().get('/checkout/thank-you/')
+        request.session = {}
+        if primary_until is not None:
+            request.session[CHECKOUT_PRIMARY_UNTIL] = primary_until
+        return request
+
+    def process(self, request):
+        middleware = routers.ReadYourWritesMiddleware()
+        middleware.process_request(request)
+        pinned = routers.is_pinned()
+        middleware.process_response(request, None)
+        self.assertFalse(routers.is_pinned())
+        return pinned
+
+    def test_pins_after_order_placed(self):
+        request = self.get_request()
+        routers.pin_session(request)
+        self.assertTrue(self.process(request))
+
+    def test_window_expires(self):
+        self.assertFalse(self.process(self.get_request(time.time() - 1)))
+        self.assertFalse(self.process(self.get_request()))
+
+
+class ReplicaAdminTest(TestCase):
+    def test_changelists(self):
+        request = RequestFactory().get('/')
+        for model in (CyberSourceReply, PaymentToken, ReplyDecisionStat):
+            self.assertIs(site._registry[model].get_changelist(request), ReplicaChangeList)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        resp = self.client.get(reverse('admin:cybersource_paymenttoken_changelist'))
+        self.assertEqual(resp.status_code, 200)
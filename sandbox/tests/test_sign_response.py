@@ -0,0 +1,126 @@
+from cybersource import actions, settings, signature
+from cybersource.views import SignAuthorizePaymentFormView
+from datetime import datetime
+from django.test import TestCase
+from mock import patch
+from rest_framework.renderers import JSONRenderer
+import base64
+import hashlib
+import hmac
+import json
+
+
+def build_action_class(num_fields):
+    # The base request data, signature and signed field lists add another 10 fields
+    num_fields -= 10
+    signed = set('signed_%s' % i for i in range(num_fields // 2))
+    unsigned = set('unsigned_%s' % i for i in range(num_fields - len(signed)))
+    return type('Action%s' % num_fields, (actions.SecureAcceptanceAction, ), {
+        'signed_field_names': signed,
+        'unsigned_field_names': unsigned,
+        'url': 'https://testsecureacceptance.cybersource.com/silent/pay',
+    })
+
+
+class CachedFields(object):
+    """
+    Hand out the same signed fields every time, so that responses built from them can be compared.
+    """
+    def __init__(self, operation):
+        self.url = operation.url
+        self.cs_fields = operation.fields()
+
+    def fields(self):
+        return self.cs_fields
+
+
+def legacy_fields(operation):
+    fields = []
+    cs_fields = operation.fields()
+    editable_fields = cs_fields['unsigned_field_names'].split(',')
+    for key, value in cs_fields.items():
+        fields.append({
+            'key': key,
+            'value': value if isinstance(value, str) else value.decode(),
+            'editable': (key in editable_fields)
+        })
+    return operation.url, fields
+
+
+def legacy_request_fields(operation):
+    """
+    Build the signed fields the way every request used to: reading the profile settings and keying a new
+    signer each time.
+    """
+    fields = dict.fromkeys(operation.get_schema().names, '')
+    data = {
+        'access_key': settings.ACCESS,
+        'currency': settings.DEFAULT_CURRENCY,
+        'locale': settings.LOCALE,
+        'profile_id': settings.PROFILE,
+        'transaction_type': operation.transaction_type,
+        'transaction_uuid': operation.generate_uuid(),
+    }
+    data.update(operation.build_signed_data())
+    signed_fields = operation.get_schema().signed_field_names | set(data.keys())
+    data.update(operation.build_unsigned_data())
+    fields.update(data)
+
+    signed_fields = signed_fields | actions.SIGNATURE_FIELDS
+    unsigned_fields = set(fields.keys()) - signed_fields
+    fields['signed_date_time'] = datetime.utcnow().strftime(settings.DATE_FORMAT)
+    fields['signed_field_names'] = ','.join(signed_fields)
+    fields['unsigned_field_names'] = ','.join(unsigned_fields)
+    msg = ','.join('%s=%s' % (field, fields.get(field, '')) for field in signed_fields)
+    msg_hmac = hmac.new(settings.SECRET.encode('utf-8'), msg.encode('utf-8'), hashlib.sha256)
+    fields['signature'] = base64.b64encode(msg_hmac.digest()).decode()
+    return fields
+
+
+class SignResponseTest(TestCase):
+    def test_schema_computed_once_per_class(self):
+        Action = build_action_class(20)
+        schema = Action.get_schema()
+        self.assertIs(Action.get_schema(), schema)
+        self.assertEqual(schema.names, frozenset(Action.signed_field_names | Action.unsigned_field_names))
+        # Subclasses get their own schema
+        self.assertEqual(actions.SecureAcceptanceAction.get_schema().names, frozenset())
+        self.assertIn('bill_to_forename', actions.CreateAndAuthorizePaymentToken.get_schema().names)
+
+    def test_fields(self):
+        fields = build_action_class(20)().fields()
+        self.assertEqual(len(fields), 20)
+        self.assertIsInstance(fields['signature'], str)
+        self.assertEqual(set(fields['unsigned_field_names'].split(',')), set(build_action_class(20).unsigned_field_names))
+
+    def test_response_build(self):
+        view = SignAuthorizePaymentFormView()
+        renderer = JSONRenderer()
+        for num_fields in (20, 800):
+            operation = CachedFields(build_action_class(num_fields)())
+            url, fields = view._fields(operation)
+            self.assertEqual(len(fields), num_fields)
+            self.assertEqual(
+                sorted(fields, key=lambda f: f['key']),
+                sorted(legacy_fields(operation)[1], key=lambda f: f['key']))
+            editable = [f['key'] for f in fields if f['editable']]
+            self.assertEqual(set(editable), set(operation.cs_fields['unsigned_field_names'].split(',')))
+
+            content = renderer.render({'url': url, 'fields': fields})
+            legacy_url, legacy = legacy_fields(operation)
+            self.assertEqual(len(json.loads(content.decode('utf-8'))['fields']), num_fields)
+            # The response is unchanged, only quicker to build
+            self.assertEqual(content, renderer.render({'url': legacy_url, 'fields': legacy}))
+
+    def test_request_setup_shared(self):
+        operation = build_action_class(20)()
+        operation.get_template()
+        with patch.object(signature.SecureAcceptanceSigner, '__init__') as init:
+            for i in range(10):
+                fields = operation.fields()
+        self.assertFalse(init.called)
+        self.assertTrue(signature.get_signer().verify_data(fields))
+        # The same fields are signed as when every request read the settings and keyed its own signer
+        legacy = legacy_request_fields(operation)
+        self.assertEqual(set(fields), set(legacy))
+        self.assertEqual(set(fields['signed_field_names'].split(',')), set(legacy['signed_field_names'].split(',')))
@@ -1,14 +1,39 @@
+from cybersource import actions, signature
 from cybersource.signature import SecureAcceptanceSigner
 from django.test import TestCase
 from django.test.client import RequestFactory
+from mock import patch
+import base64
+import hashlib
+import hmac
+import sys
+import threading
+
+
+def expected_signature(secret_key, data, signed_fields):
+    msg = ','.join('%s=%s' % (field, data.get(field, '')) for field in signed_fields)
+    return base64.b64encode(hmac.new(secret_key.encode('utf-8'), msg.encode('utf-8'), hashlib.sha256).digest())
+
+
+class OrderAction(actions.SecureAcceptanceAction):
+    signed_field_names = set(['reference_number', 'amount'])
+    unsigned_field_names = set(['bill_to_forename'])
+    transaction_type = 'authorization'
+    url = 'https://testsecureacceptance.cybersource.com/silent/pay'
+
+    def __init__(self, reference_number, amount):
+        self.reference_number = reference_number
+        self.amount = amount
+
+    def build_signed_data(self):
+        return {'reference_number': self.reference_number, 'amount': self.amount}
 
 
 class SignerTest(TestCase):
     def test_sign(self):
-        signer = SecureAcceptanceSigner()
+        signer = SecureAcceptanceSigner('FOO')
 
         # Baseline
-        signer.secret_key = 'FOO'
         signature = signer.sign({ 'foo': 'bar', 'baz': 'bat' }, ('foo', 'baz'))
         self.assertEqual(signature, b'IVMC7Aj8pDKwLx+0eNfIfoQAHvViiLeavLyYatCtB+c=')
 
@@ -17,16 +42,15 @@ class SignerTest(TestCase):
         self.assertEqual(signature, b'5Gw1ffUlVU9Cm0tTa/nzhQ81Bc6/SDqz/tEP5VyMzkk=')
 
         # Change key
-        signer.secret_key = 'SECRET'
+        signer = SecureAcceptanceSigner('SECRET')
         signature = signer.sign({ 'foo': 'bar', 'baz': 'bat' }, ('foo', 'baz'))
         self.assertEqual(signature, b'FvjC1PIhxuaLipTbRDw9UXL6F58t9Hyj12HLHiYoOD0=')
 
     def test_verify(self):
         rf = RequestFactory()
-        signer = SecureAcceptanceSigner()
+        signer = SecureAcceptanceSigner('FOO')
 
         # Baseline
-        signer.secret_key = 'FOO'
         request = rf.post('/', {
             'signed_field_names': 'foo,baz',
             'signature': 'IVMC7Aj8pDKwLx+0eNfIfoQAHvViiLeavLyYatCtB+c=',
@@ -43,3 +67,108 @@ class SignerTest(TestCase):
             'baz': 'bat',
         })
         self.assertFalse( signer.verify_request(request) )
+
+    def test_verify_data(self):
+        signer = SecureAcceptanceSigner('FOO')
+        data = {
+            'signed_field_names': 'foo,baz',
+            'signature': 'IVMC7Aj8pDKwLx+0eNfIfoQAHvViiLeavLyYatCtB+c=',
+            'foo': 'bar',
+            'baz': 'bat',
+        }
+        self.assertTrue( signer.verify_data(data) )
+
+        data['foo'] = 'baz'
+        self.assertFalse( signer.verify_data(data) )
+
+        del data['signature']
+        self.assertFalse( signer.verify_data(data) )
+
+    def test_immutable(self):
+        signer = SecureAcceptanceSigner('FOO')
+        with self.assertRaises(AttributeError):
+            signer.secret_key = 'BAR'
+        with self.assertRaises(AttributeError):
+            del signer.secret_key
+        self.assertEqual(signer.secret_key, 'FOO')
+
+    def test_get_signer(self):
+        signer = signature.get_signer()
+        self.assertIs(signature.get_signer(), signer)
+        with patch('cybersource.settings.SECRET', 'BAR'):
+            self.assertEqual(signature.get_signer().secret_key, 'BAR')
+        self.assertEqual(signature.get_signer().secret_key, signer.secret_key)
+
+    def test_action_template_shared(self):
+        template = OrderAction.get_template()
+        self.assertIs(OrderAction('1', '10.00').get_template(), template)
+        self.assertIs(template.signer, signature.get_signer())
+        with self.assertRaises(TypeError):
+            template.base_data['access_key'] = 'BAR'
+
+        # A new profile gets a new template
+        with patch('cybersource.settings.ACCESS', 'BAR'):
+            self.assertEqual(OrderAction.get_template().base_data['access_key'], 'BAR')
+        self.assertEqual(OrderAction.get_template().base_data['access_key'], template.base_data['access_key'])
+
+
+
+class SignerThreadingTest(TestCase):
+    num_threads = 16
+    iterations = 300
+
+    def run_threads(self, work):
+        barrier = threading.Barrier(self.num_threads)
+        errors = []
+
+        def run(n):
+            try:
+                barrier.wait()
+                for i in range(self.iterations):
+                    work(n, i)
+            except Exception as e:
+                errors.append('Thread %d: %r' % (n, e))
+
+        # Switch threads as often as possible, to interleave the signing steps
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=run, args=(n, )) for n in range(self.num_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
+    def test_shared_signers(self):
+        signers = [SecureAcceptanceSigner('FOO'), SecureAcceptanceSigner('SECRET')]
+
+        def work(n, i):
+            signer = signers[(n + i) % 2]
+            data = {'reference_number': '%d-%d' % (n, i), 'amount': str(i)}
+            fields = ('reference_number', 'amount')
+            sig = signer.sign(data, fields)
+            assert sig == expected_signature(signer.secret_key, data, fields), (n, i)
+            data['signed_field_names'] = ','.join(fields)
+            data['signature'] = sig.decode()
+            assert signer.verify_data(data), (n, i)
+
+        self.run_threads(work)
+
+    def test_shared_action_template(self):
+        templates = set([id(OrderAction.get_template())])
+        signer = signature.get_signer()
+
+        def work(n, i):
+            reference_number = '%d-%d' % (n, i)
+            fields = OrderAction(reference_number, str(i)).fields()
+            templates.add(id(OrderAction.get_template()))
+            assert fields['reference_number'] == reference_number, (n, i)
+            signed_fields = fields['signed_field_names'].split(',')
+            assert fields['signature'].encode() == expected_signature(signer.secret_key, fields, signed_fields), (n, i)
+            assert signer.verify_data(fields), (n, i)
+
+        self.run_threads(work)
+        self.assertEqual(len(templates), 1)
@@ -0,0 +1,87 @@
+from cybersource import stats
+from cybersource.models import CyberSourceReply, ReplyDecisionStat
+from cybersource.tests.factories import build_accepted_reply_data, build_declined_reply_data
+from decimal import Decimal as D
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
+
+
+class DecisionStatsTest(TestCase):
+    def log_reply(self, data):
+        reply = CyberSourceReply.objects.create(data=data)
+        stats.record_reply(reply)
+        return reply
+
+    def test_record_reply(self):
+        self.log_reply(build_accepted_reply_data('S1'))
+        self.log_reply(build_accepted_reply_data('S2'))
+        self.log_reply(build_declined_reply_data('S3'))
+
+        self.assertEqual(ReplyDecisionStat.objects.count(), 2)
+        accepted = ReplyDecisionStat.objects.get(decision='ACCEPT')
+        self.assertEqual(accepted.count, 2)
+        self.assertEqual(accepted.amount, D('199.98'))
+        self.assertEqual(accepted.reason_code, '100')
+        self.assertEqual(accepted.avs_code, 'X')
+        self.assertEqual(accepted.card_type, '001')
+        self.assertEqual(accepted.currency, 'USD')
+        declined = ReplyDecisionStat.objects.get(decision='DECLINE')
+        self.assertEqual(declined.count, 1)
+        self.assertEqual(declined.reason_code, '203')
+        self.assertEqual(declined.amount, D('0.00'))
+
+    def test_summary(self):
+        self.log_reply(build_accepted_reply_data('S1'))
+        self.log_reply(build_declined_reply_data('S2'))
+        self.log_reply(build_declined_reply_data('S3'))
+
+        rows = stats.summary(group_by=('decision', 'reason_code'))
+        self.assertEqual(rows, [
+            {'decision': 'ACCEPT', 'reason_code': '100', 'count': 1, 'amount': D('99.99')},
+            {'decision': 'DECLINE', 'reason_code': '203', 'count': 2, 'amount': D('0.00')},
+        ])
+        self.assertAlmostEqual(stats.acceptance_rate(), 1 / 3)
+        with self.assertRaises(ValueError):
+            stats.summary(group_by=('foo', ))
+
+    def test_acceptance_rate_without_data(self):
+        self.assertIsNone(stats.acceptance_rate())
+
+    def test_rebuild(self):
+        CyberSourceReply.objects.create(data=build_accepted_reply_data('S1'))
+        CyberSourceReply.objects.create(data=build_declined_reply_data('S2'))
+        self.assertEqual(ReplyDecisionStat.objects.count(), 0)
+
+        out = StringIO()
+        call_command('cybersource_rebuild_decision_stats', stdout=out)
+        self.assertIn('Rebuilt 2 decision statistic rows', out.getvalue())
+        self.assertEqual(ReplyDecisionStat.objects.get(decision='ACCEPT').count, 1)
+        self.assertEqual(ReplyDecisionStat.objects.get(decision='DECLINE').count, 1)
+
+        # Rebuilding again should replace, not add to, the existing rows
+        stats.rebuild()
+        self.assertEqual(ReplyDecisionStat.objects.get(decision='ACCEPT').count, 1)
+
+    def test_rebuild_locks_stats(self):
+        CyberSourceReply.objects.create(data=build_accepted_reply_data('S1'))
+        with CaptureQueriesContext(connection) as queries:
+            stats.rebuild()
+        sql = [q['sql'] for q in queries.captured_queries]
+        # The replies are counted before the table is locked, and the rows replaced while it is
+        lock = next(i for i, q in enumerate(sql) if q.startswith('LOCK TABLE'))
+        self.assertIn('SHARE ROW EXCLUSIVE', sql[lock])
+        self.assertTrue(any('cybersourcereplyarchive' in q for q in sql[:lock]))
+        self.assertTrue(any(q.startswith('DELETE') for q in sql[lock:]))
+
+    def test_rebuild_counts_replies_once(self):
+        counted = CyberSourceReply.objects.create(data=build_accepted_reply_data('S1'))
+        stats.rebuild()
+        # The increment of a reply the rebuild counted, which was waiting for its lock, isn't added again
+        stats.record_reply(counted)
+        self.assertEqual(ReplyDecisionStat.objects.get(decision='ACCEPT').count, 1)
+        # Later replies still are
+        self.log_reply(build_accepted_reply_data('S2'))
+        self.assertEqual(ReplyDecisionStat.objects.get(decision='ACCEPT').count, 2)
@@ -0,0 +1,90 @@
+from cybersource.orders import BulkOrderCreator
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import connections, transaction
+from django.test import TransactionTestCase
+from oscar.core.loading import get_class, get_model
+from oscar.test import factories
+import multiprocessing
+import queue
+import random
+
+Basket = get_model('basket', 'Basket')
+Order = get_model('order', 'Order')
+StockRecord = get_model('partner', 'StockRecord')
+
+Default = get_class('partner.strategy', 'Default')
+Free = get_class('shipping.methods', 'Free')
+OrderTotalCalculator = get_class('checkout.calculators', 'OrderTotalCalculator')
+
+
+def _close_connections():
+    for conn in connections.all():
+        conn.close()
+
+
+def _place_orders_in_child(basket_ids, barrier, errors):
+    try:
+        barrier.wait()
+        for basket_id in basket_ids:
+            try:
+                with transaction.atomic():
+                    basket = Basket.objects.get(pk=basket_id)
+                    basket.strategy = Default()
+                    shipping_method = Free()
+                    shipping_charge = shipping_method.calculate(basket)
+                    BulkOrderCreator().place_order(
+                        basket=basket,
+                        total=OrderTotalCalculator().calculate(basket, shipping_charge),
+                        shipping_method=shipping_method,
+                        shipping_charge=shipping_charge,
+                        order_number=str(100000 + basket_id))
+            except Exception as e:
+                errors.put('%s: %s' % (e.__class__.__name__, e))
+    finally:
+        _close_connections()
+
+
+class ConcurrentStockAllocationTest(TransactionTestCase):
+    num_processes = 8
+    orders_per_process = 5
+
+    def setUp(self):
+        # TransactionTestCase flushes the database, including the site created by migrations
+        Site.objects.get_or_create(pk=settings.SITE_ID, defaults={'domain': 'example.com', 'name': 'example.com'})
+
+    def test_overlapping_orders(self):
+        # Every basket holds the same popular products, added in a different order
+        stockrecords = [factories.create_stockrecord(num_in_stock=1000) for i in range(10)]
+        basket_ids = []
+        for i in range(self.num_processes * self.orders_per_process):
+            basket = factories.create_basket(empty=True)
+            for record in random.sample(stockrecords, len(stockrecords)):
+                basket.add_product(record.product)
+            basket_ids.append(basket.id)
+
+        # Each child process has to open its own database connection
+        _close_connections()
+        barrier = multiprocessing.Barrier(self.num_processes)
+        errors = multiprocessing.Queue()
+        children = [
+            multiprocessing.Process(target=_place_orders_in_child, args=(basket_ids[i::self.num_processes], barrier, errors))
+            for i in range(self.num_processes)
+        ]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+            self.assertEqual(child.exitcode, 0)
+
+        failures = []
+        while True:
+            try:
+                failures.append(errors.get(timeout=0.1))
+            except queue.Empty:
+                break
+        self.assertEqual(failures, [])
+
+        self.assertEqual(Order.objects.count(), len(basket_ids))
+        for record in StockRecord.objects.filter(pk__in=[r.pk for r in stockrecords]):
+            self.assertEqual(record.num_allocated, len(basket_ids))
@@ -0,0 +1,119 @@
+from cybersource.throttling import (
+    DeclineThrottle,
+    GlobalSignRateThrottle,
+    IPSignRateThrottle,
+    SessionSignRateThrottle,
+    parse_rate,
+)
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import patch
+
+
+class SignRateThrottleTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def build_request(self, ip='8.8.8.8', session_key='abcdefgh12345678'):
+        request = RequestFactory().post('/', REMOTE_ADDR=ip)
+        request.session = SessionStore(session_key=session_key)
+        return request
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('10/min'), (10, 60))
+        self.assertEqual(parse_rate('5/s'), (5, 1))
+        self.assertEqual(parse_rate('100/hour'), (100, 3600))
+        self.assertEqual(parse_rate('1000/day'), (1000, 86400))
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'ip': '3/min'})
+    def test_ip_bucket(self):
+        throttle = IPSignRateThrottle()
+        throttle.timer = lambda: 6000.0
+        for i in range(3):
+            self.assertTrue(throttle.allow_request(self.build_request(), None))
+        self.assertFalse(throttle.allow_request(self.build_request(), None))
+        # At the start of the next period all 3 tokens are still spent, a third of the way through 1 is back
+        self.assertAlmostEqual(throttle.wait(), 80)
+
+        # Other IPs have their own bucket
+        self.assertTrue(throttle.allow_request(self.build_request(ip='8.8.4.4'), None))
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'ip': '4/min'})
+    def test_bucket_refills(self):
+        throttle = IPSignRateThrottle()
+        throttle.timer = lambda: 6000.0
+        for i in range(4):
+            self.assertTrue(throttle.allow_request(self.build_request(), None))
+
+        # Half way through the next period, half the tokens are back
+        throttle.timer = lambda: 6090.0
+        self.assertTrue(throttle.allow_request(self.build_request(), None))
+        self.assertTrue(throttle.allow_request(self.build_request(), None))
+        self.assertFalse(throttle.allow_request(self.build_request(), None))
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'ip': '3/min'})
+    def test_refused_requests_not_counted(self):
+        throttle = IPSignRateThrottle()
+        throttle.timer = lambda: 6000.0
+        for i in range(3):
+            self.assertTrue(throttle.allow_request(self.build_request(), None))
+        # Retrying on every refusal doesn't push back the time the client is let in again
+        for i in range(20):
+            self.assertFalse(throttle.allow_request(self.build_request(), None))
+        wait = throttle.wait()
+        throttle.timer = lambda: 6000.0 + wait - 1
+        self.assertFalse(throttle.allow_request(self.build_request(), None))
+        throttle.timer = lambda: 6000.0 + wait
+        self.assertTrue(throttle.allow_request(self.build_request(), None))
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'session': '1/min'})
+    def test_session_bucket(self):
+        throttle = SessionSignRateThrottle()
+        self.assertTrue(throttle.allow_request(self.build_request(session_key='abcdefgh12345678'), None))
+        self.assertFalse(throttle.allow_request(self.build_request(session_key='abcdefgh12345678'), None))
+        self.assertTrue(throttle.allow_request(self.build_request(session_key='ijklmnop12345678'), None))
+        # Requests without a session are left to the IP bucket
+        self.assertTrue(throttle.allow_request(self.build_request(session_key=None), None))
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'global': '2/s'})
+    @patch('django_statsd.clients.statsd.incr')
+    def test_global_bucket(self, statsd_incr):
+        throttle = GlobalSignRateThrottle()
+        throttle.timer = lambda: 6000.0
+        self.assertTrue(throttle.allow_request(self.build_request(ip='1.1.1.1'), None))
+        self.assertTrue(throttle.allow_request(self.build_request(ip='2.2.2.2'), None))
+        self.assertFalse(throttle.allow_request(self.build_request(ip='3.3.3.3'), None))
+        statsd_incr.assert_called_once_with('checkout.sign-auth-request.throttled.global')
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'session': None, 'ip': None, 'global': None})
+    def test_disabled(self):
+        for throttle_class in (GlobalSignRateThrottle, IPSignRateThrottle, SessionSignRateThrottle):
+            for i in range(100):
+                self.assertTrue(throttle_class().allow_request(self.build_request(), None))
+
+    @patch('cybersource.settings.DECLINE_THROTTLE_LIMIT', 2)
+    def test_decline_throttle(self):
+        throttle = DeclineThrottle()
+        throttle.record_decline(self.build_request())
+        self.assertTrue(throttle.allow_request(self.build_request(), None))
+        throttle.record_decline(self.build_request(ip='8.8.4.4'))
+        # The session has now seen two declines, from different IPs
+        self.assertFalse(throttle.allow_request(self.build_request(ip='1.1.1.1'), None))
+        self.assertTrue(throttle.allow_request(self.build_request(ip='1.1.1.1', session_key='ijklmnop12345678'), None))
+
+
+class SignViewThrottleTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @patch('cybersource.settings.SIGN_RATE_LIMITS', {'ip': '0/min'})
+    @patch('cybersource.views.OrderNumberGenerator')
+    def test_throttled_before_basket_work(self, order_number_generator):
+        url = reverse('cybersource-sign-auth-request')
+        res = self.client.post(url, {}, format='json')
+        self.assertEqual(res.status_code, 429)
+        self.assertIn('Retry-After', res)
+        self.assertEqual(order_number_generator.call_count, 0)
@@ -0,0 +1,73 @@
+from cybersource import tracing
+from django.test import TestCase
+from mock import patch
+import json
+import os
+import tempfile
+
+
+@patch('cybersource.settings.TRACING_EXPORTER', 'cybersource.tracing.InMemorySpanExporter')
+class TracingTest(TestCase):
+    def setUp(self):
+        tracing.get_exporter().clear()
+
+    def test_disabled(self):
+        with patch('cybersource.settings.TRACING_EXPORTER', None):
+            self.assertFalse(tracing.is_enabled())
+            with tracing.trace('root') as root:
+                self.assertIsNone(root)
+                with tracing.span('child') as child:
+                    self.assertIsNone(child)
+                tracing.set_attribute('foo', 'bar')
+
+    def test_spans(self):
+        with tracing.trace('root', foo='bar'):
+            with tracing.span('child'):
+                with tracing.span('grandchild'):
+                    pass
+            tracing.set_attribute('reference_number', '10000042')
+
+        spans = tracing.get_exporter().get_finished_spans()
+        self.assertEqual([s.name for s in spans], ['grandchild', 'child', 'root'])
+        grandchild, child, root = spans
+        self.assertEqual(root.attributes, {'foo': 'bar', 'reference_number': '10000042'})
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(child.parent_id, root.span_id)
+        self.assertEqual(grandchild.parent_id, child.span_id)
+        for s in spans:
+            self.assertEqual(s.trace_id, tracing.trace_id_for('10000042'))
+            self.assertEqual(s.status, 'OK')
+            self.assertGreaterEqual(s.end_time, s.start_time)
+
+    def test_error_status(self):
+        with self.assertRaises(ValueError):
+            with tracing.trace('root'):
+                with tracing.span('child'):
+                    raise ValueError()
+        child, root = tracing.get_exporter().get_finished_spans()
+        self.assertEqual(child.status, 'ERROR')
+        self.assertEqual(root.status, 'ERROR')
+        self.assertEqual(len(root.trace_id), 32)
+
+    def test_to_dict(self):
+        with tracing.trace('root', reference_number='10000042') as root:
+            pass
+        data = root.to_dict()
+        self.assertEqual(data['name'], 'root')
+        self.assertEqual(data['kind'], 'SpanKind.SERVER')
+        self.assertEqual(data['context']['trace_id'], '0x%s' % tracing.trace_id_for('10000042'))
+        self.assertEqual(data['status'], {'status_code': 'OK'})
+        self.assertIsNone(data['parent_id'])
+
+    def test_file_exporter(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with patch('cybersource.settings.TRACING_EXPORTER', 'cybersource.tracing.FileSpanExporter'), \
+                patch('cybersource.settings.TRACING_FILE', path):
+            with tracing.trace('root', reference_number='1'):
+                with tracing.span('child'):
+                    pass
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['name'] for line in lines], ['child', 'root'])
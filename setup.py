@@ -7,6 +7,8 @@ from versiontag import get_version, cache_git_tag
 
 packages = [
     'cybersource',
+    'cybersource.management',
+    'cybersource.management.commands',
     'cybersource.migrations',
     'cybersource.tests',
 ]
@@ -21,6 +23,7 @@ requires = [
     'django-oscar>=1.1.1',
     'django-oscar-api>=1.0.4',
     'django-statsd-mozilla>=0.3.16',
+    'requests>=2.9.1',
 ]
 
 def fpath(name):